@@ -0,0 +1,178 @@
+"""
+Load benchmark: thread-per-request (`run_in_executor(app.invoke)`) vs. async (`app.ainvoke`).
+
+The agent model is replaced with a fake that sleeps for a configurable LLM latency and
+the database with one that sleeps for a DB latency. Each request runs the graph's real
+tool loop (LLM -> `--parallel-calls` query_database calls in one ToolNode step -> LLM),
+so no Discord token, Gemini key or MySQL server is needed. Every request is traced, and
+the per-span p50/p99 shows where the time goes. Run from the repository root:
+
+    python -m benchmarks.bench_async_pipeline --requests 500 --llm-latency 0.8 --db-latency 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import statistics
+import threading
+import time
+from typing import List
+
+# Keep the benchmark's conversation checkpoints out of the real store.
+os.environ["CONVERSATION_DB_PATH"] = ":memory:"
+
+from langchain_core.messages import AIMessage, HumanMessage  # noqa: E402
+from langgraph.checkpoint.memory import InMemorySaver  # noqa: E402
+
+import lang.tools.tools as tools  # noqa: E402
+from lang.db.cache import get_query_cache  # noqa: E402
+from lang.db.guard import get_query_guard  # noqa: E402
+from lang.db.schema import SchemaCatalog, set_schema_catalog  # noqa: E402
+from lang.graph.graph import workflow  # noqa: E402
+from registry import registry  # noqa: E402
+from telemetry import span_duration, start_trace, trace  # noqa: E402
+
+# An in-memory checkpointer serves both invoke and ainvoke in the same process.
+app = workflow.compile(checkpointer=InMemorySaver())
+
+
+class _FakeAgentModel:
+    """First step asks for `parallel_calls` queries at once; the step after the results answers."""
+
+    def __init__(self, llm_latency: float, parallel_calls: int):
+        self.llm_latency = llm_latency
+        self.parallel_calls = parallel_calls
+
+    def _respond(self, inputs: dict) -> AIMessage:
+        last = inputs["messages"][-1]
+        if not isinstance(last, HumanMessage):
+            return AIMessage(content="42 rows matched.")
+        calls = [
+            {"name": "query_database", "args": {"query": f"SELECT {k} AS n FROM orders WHERE note = '{last.content}'"}, "id": f"call_{k}"}
+            for k in range(self.parallel_calls)
+        ]
+        return AIMessage(content="", tool_calls=calls)
+
+    def invoke(self, inputs):
+        time.sleep(self.llm_latency)
+        return self._respond(inputs)
+
+    async def ainvoke(self, inputs):
+        await asyncio.sleep(self.llm_latency)
+        return self._respond(inputs)
+
+
+def _fake_database(db_latency: float) -> None:
+    """Replaces the sync and async query helpers with ones that only sleep."""
+
+    def run_query(query, dictionary=True):
+        with trace("db.query"):
+            time.sleep(db_latency)
+        return [{"n": 42}] if dictionary else [(42,)]
+
+    async def arun_query(query, dictionary=True):
+        with trace("db.query"):
+            await asyncio.sleep(db_latency)
+        return [{"n": 42}] if dictionary else [(42,)]
+
+    tools._run_query = run_query
+    tools._arun_query = arun_query
+    # There is no real server to EXPLAIN against.
+    get_query_guard().enabled = False
+
+
+def _inputs(i: int) -> dict:
+    return {"messages": [HumanMessage(content=f"how many orders did customer {i} place?")]}
+
+
+def _config(mode: str, i: int) -> dict:
+    return {"configurable": {"thread_id": f"{mode}-{i}"}}
+
+
+async def _timed(coro) -> float:
+    started = time.perf_counter()
+    await coro
+    return time.perf_counter() - started
+
+
+def _invoke(i: int):
+    with start_trace("request"):
+        return app.invoke(_inputs(i), _config("threads", i))
+
+
+async def _ainvoke(i: int):
+    with start_trace("request"):
+        return await app.ainvoke(_inputs(i), _config("async", i))
+
+
+async def _run_threads(n: int) -> List[float]:
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(_timed(loop.run_in_executor(None, _invoke, i)) for i in range(n)))
+
+
+async def _run_async(n: int) -> List[float]:
+    return await asyncio.gather(*(_timed(_ainvoke(i)) for i in range(n)))
+
+
+def _report(mode: str, latencies: List[float], wall: float, peak_threads: int) -> None:
+    ordered = sorted(latencies)
+    p95 = ordered[max(0, int(len(ordered) * 0.95) - 1)]
+    print(
+        f"{mode:>8} | requests={len(latencies):5d} | wall={wall:7.2f}s | "
+        f"throughput={len(latencies) / wall:8.1f} req/s | p50={statistics.median(ordered):6.2f}s | "
+        f"p95={p95:6.2f}s | max={ordered[-1]:6.2f}s | peak threads={peak_threads}"
+    )
+
+
+def _measure(mode: str, runner, n: int) -> None:
+    peak = threading.active_count()
+    stop = threading.Event()
+
+    def sample_threads():
+        nonlocal peak
+        while not stop.is_set():
+            peak = max(peak, threading.active_count())
+            time.sleep(0.01)
+
+    # Both modes send the same SQL; without this the second one is served from the result cache.
+    with contextlib.redirect_stdout(io.StringIO()):
+        get_query_cache().clear()
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    # The graph logs every routing decision; keep the benchmark output readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies = asyncio.run(runner(n))
+    wall = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+    _report(mode, latencies, wall, peak)
+    for labels, count, total in span_duration.series():
+        name = labels["span"]
+        print(
+            f"{'':>8} | {name:<24} n={count:5d} | avg={total / count:6.3f}s | "
+            f"p50={span_duration.quantile(0.5, span=name):6.3f}s | p99={span_duration.quantile(0.99, span=name):6.3f}s"
+        )
+    span_duration.clear()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Concurrent conversations to simulate.")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per mocked LLM call.")
+    parser.add_argument("--db-latency", type=float, default=0.05, help="Seconds per mocked DB query.")
+    parser.add_argument("--parallel-calls", type=int, default=1, help="Tool calls the model requests in one step.")
+    args = parser.parse_args()
+
+    registry.override("agent_model", _FakeAgentModel(args.llm_latency, args.parallel_calls))
+    _fake_database(args.db_latency)
+    set_schema_catalog(SchemaCatalog(loader=dict))
+    print(f"Simulating {args.requests} concurrent requests "
+          f"(LLM {args.llm_latency}s x2, {args.parallel_calls} parallel DB call(s) of {args.db_latency}s per request)")
+    _measure("threads", _run_threads, args.requests)
+    _measure("async", _run_async, args.requests)
+
+
+if __name__ == "__main__":
+    main()
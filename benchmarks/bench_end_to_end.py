@@ -0,0 +1,486 @@
+"""
+End-to-end benchmark and traffic replay, fully offline.
+
+Gemini is replaced with a scripted fake chat model (`benchmarks/fakes.py`) that asks for
+real tool calls after a configurable latency, MySQL with a synthetic SQLite database of
+`--rows` orders served through the `DATA_SOURCES` stand-in path, and Discord with fake
+message, channel and thread objects. Everything in between is the bot's own code: the
+`discord` driver awaits `main.on_message` (rate limits, the scheduler, attachment
+download, `process_uploaded_file`, `app.invoke`/`app.ainvoke`, `export_to_excel` and the
+reply), with `--workers N` through the dispatcher to N worker processes like a bot with
+`BOT_WORKERS` set; the `graph` driver calls `read_attachment`, `process_uploaded_file` and the compiled graph directly
+and does not need discord.py installed.
+
+Requests arrive open-loop (Poisson, `--rate` per second) with a `--mix` of kinds:
+  chat    a question answered with `query_database`
+  batch   a comparison answered with `query_database_batch`
+  export  an export answered with `export_to_excel` (CSV or XLSX)
+  upload  a CSV attachment loaded with `process_uploaded_file`, then `query_uploaded_data`
+  image   an image request answered by the image model
+
+Reported per kind: throughput, p50/p95/p99 latency and errors, plus per-span p50/p99,
+the time until the first answer text was visible in Discord, the peak RSS of the process and, per model, how
+many requests the response cache and single-flight answered (`--no-llm-cache` turns both off). `--record` writes the generated traffic as JSONL and
+`--replay` plays a recording back with its original timing (scaled by `--speed`), so a
+change can be measured against the same traffic. `--save-results` and `--baseline` catch
+regressions: the run exits with status 1 when a kind's p95 or p99 grows by more than
+`--max-regression`. Run from the repository root:
+
+    python -m benchmarks.bench_end_to_end --requests 200 --rate 20 --rows 100000
+    python -m benchmarks.bench_end_to_end --record traffic.jsonl --save-results before.json
+    python -m benchmarks.bench_end_to_end --replay traffic.jsonl --baseline before.json
+
+Replies inside an existing thread are not replayed: `on_message` recognizes threads with
+`isinstance(channel, discord.Thread)`, which the fakes are not, so every request opens a
+new conversation.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KINDS = ("chat", "batch", "export", "upload", "image")
+_QUESTIONS = {
+    "chat": "what did customer {customer} order recently?",
+    "batch": "compare revenue by region, orders by status and units by category",
+    "export": "export the orders of customers {low}-{high} to {target}",
+    "upload": "how many rows are in this file?",
+    "image": "draw a picture of a lighthouse at dusk",
+}
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--driver", choices=("discord", "graph"), default="graph", help="Drive main.on_message or the graph directly.")
+    parser.add_argument("--mode", choices=("thread", "async"), default="thread", help="GRAPH_EXECUTION_MODE for the run.")
+    parser.add_argument("--requests", type=int, default=100, help="Requests to generate (ignored with --replay).")
+    parser.add_argument("--rate", type=float, default=10.0, help="Mean arrival rate in requests per second.")
+    parser.add_argument("--mix", default="chat=60,batch=15,export=10,upload=10,image=5", help="Relative weight per request kind.")
+    parser.add_argument("--rows", type=int, default=10_000, help="Orders in the synthetic database (10k to 10M).")
+    parser.add_argument("--upload-rows", type=int, default=5_000, help="Rows per uploaded CSV.")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per fake model call.")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="Extra random seconds per fake model call, up to this.")
+    parser.add_argument("--chunk-latency", type=float, default=0.02, help="Seconds between streamed chunks of a fake answer.")
+    parser.add_argument("--no-stream", action="store_true", help="Reply only once the answer is complete (STREAM_RESPONSES=false).")
+    parser.add_argument("--no-llm-cache", action="store_true",
+                        help="Call the model for every request (LLM_CACHE_ENABLED=false, LLM_COALESCE_ENABLED=false).")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Run the graph in this many worker processes (BOT_WORKERS; discord driver only).")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Seconds per fake Discord API call.")
+    parser.add_argument("--users", type=int, default=50, help="Distinct users sending traffic.")
+    parser.add_argument("--guilds", type=int, default=5, help="Distinct guilds sending traffic.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for traffic, data and model jitter.")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the configured per-user/guild rate limits.")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "text2sql-bench"),
+                        help="Where the synthetic database is kept between runs.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the synthetic database even if it exists.")
+    parser.add_argument("--record", help="Write the generated traffic to this JSONL file.")
+    parser.add_argument("--replay", help="Replay traffic from this JSONL file instead of generating it.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor (2 = twice as fast).")
+    parser.add_argument("--save-results", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against results saved by an earlier run.")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed p95/p99 growth over the baseline.")
+    return parser.parse_args()
+
+
+def _configure_environment(args: argparse.Namespace, db_path: str, workdir: str) -> None:
+    """Settings the bot reads at import time, so this runs before any of its modules are imported."""
+    os.environ["GRAPH_EXECUTION_MODE"] = args.mode
+    os.environ["CONVERSATION_DB_PATH"] = os.path.join(workdir, "conversations.sqlite")
+    os.environ["DATA_SOURCES"] = f"default=sqlite:///{db_path}"
+    os.environ["DATA_SOURCE_REPLICAS"] = ""
+    os.environ["DATA_SOURCE_ROUTES"] = ""
+    os.environ["INGEST_CACHE_DIR"] = os.path.join(workdir, "cache", "ingest")
+    os.environ["STARTUP_PREWARM"] = ""
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["STREAM_RESPONSES"] = "false" if args.no_stream else "true"
+    os.environ["LLM_CACHE_ENABLED"] = os.environ["LLM_COALESCE_ENABLED"] = "false" if args.no_llm_cache else "true"
+    os.environ["LLM_CACHE_DB_PATH"] = ""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Every request is traced for the span breakdown; none are sampled into the log.
+    os.environ["TRACE_SAMPLE_RATE"] = "0"
+    os.environ["TRACE_SLOW_SECONDS"] = "1000000"
+    if not args.rate_limits:
+        for name in ("SCHEDULER_USER_RATE_PER_MIN", "SCHEDULER_USER_BURST", "SCHEDULER_GUILD_RATE_PER_MIN", "SCHEDULER_GUILD_BURST"):
+            os.environ[name] = "1000000"
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    # Read by `install_fake_models`, here and in worker processes.
+    os.environ["BENCH_LLM_LATENCY"] = str(args.llm_latency)
+    os.environ["BENCH_LLM_JITTER"] = str(args.llm_jitter)
+    os.environ["BENCH_CHUNK_LATENCY"] = str(args.chunk_latency)
+    os.environ["BENCH_SEED"] = str(args.seed)
+    os.environ["BOT_WORKERS"] = str(args.workers)
+
+
+# --- Traffic ---
+
+def _parse_mix(spec: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        kind, _, weight = part.partition("=")
+        if kind not in KINDS:
+            raise SystemExit(f"Unknown request kind '{kind}' in --mix (use {', '.join(KINDS)}).")
+        mix[kind] = float(weight or 1)
+    if not any(mix.values()):
+        raise SystemExit("--mix gives every request kind a weight of zero.")
+    return mix
+
+
+def _generate_traffic(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    from benchmarks.fakes import traffic_record
+
+    rng = random.Random(args.seed)
+    mix = _parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    customers = max(1, args.rows // 10)
+    traffic, at = [], 0.0
+    for _ in range(args.requests):
+        at += rng.expovariate(args.rate)
+        kind = rng.choices(kinds, weights)[0]
+        low = rng.randint(1, customers)
+        content = _QUESTIONS[kind].format(
+            customer=rng.randint(1, customers), low=low, high=min(customers, low + 20),
+            target=rng.choice(("excel", "csv")),
+        )
+        traffic.append(traffic_record(
+            kind, at, user=rng.randrange(args.users), guild=rng.randrange(args.guilds), channel=rng.randrange(20),
+            content=content, attachment_rows=args.upload_rows if kind == "upload" else 0,
+        ))
+    return traffic
+
+
+def _load_traffic(path: str, speed: float) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        traffic = [json.loads(line) for line in f if line.strip()]
+    for record in traffic:
+        record["at"] = record["at"] / speed
+    return traffic
+
+
+def _save_traffic(path: str, traffic: List[Dict[str, Any]]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for record in traffic:
+            f.write(json.dumps(record) + "\n")
+
+
+# --- Drivers ---
+
+_FAILURE_PREFIXES = ("An unexpected error", "The bot is too busy", "You are sending requests too quickly", "Error")
+
+
+def _failure(texts: List[str]) -> Optional[str]:
+    """The first reply that reports a failure, if any."""
+    for text in texts:
+        # The fake model quotes its tool results in the answer, so a failed tool shows up there too.
+        if text.startswith(_FAILURE_PREFIXES) or "\nError" in text:
+            return text
+    return None if texts else "no reply"
+
+
+def _missing_file(record: Dict[str, Any], files: int) -> Optional[str]:
+    """Exports and images must come back as a file."""
+    if record["kind"] in ("export", "image") and not files:
+        return "no file attached"
+    return None
+
+
+class Drivers:
+    """Sends one recorded request through the bot and returns the failure it reported, if any."""
+
+    def __init__(self, args: argparse.Namespace):
+        from benchmarks.fakes import FakeUser, set_discord_latency
+        from lang.graph.graph import app, checkpointer
+
+        self.args = args
+        self.app = app
+        self.checkpointer = checkpointer
+        self.bot_user = FakeUser(1, "text2sql-bot")
+        self._channels: Dict[tuple, Any] = {}
+        self._main: Any = None
+        self._dispatcher: Any = None
+        self.llm_usage: Dict[str, Any] = {}
+        set_discord_latency(args.discord_latency)
+
+    async def close(self) -> None:
+        from llm_cache import get_llm_usage, merge_usage
+
+        snapshots = [get_llm_usage().snapshot()]
+        if self._dispatcher is not None:
+            snapshots += [worker["llm"] for worker in self._dispatcher.stats()["per_worker"].values()]
+            await self._dispatcher.close()
+        self.llm_usage = merge_usage(snapshots)
+        # aiosqlite's worker thread is not a daemon; the process would not exit with it open.
+        if self.args.mode == "async":
+            await self.checkpointer.conn.close()
+
+    async def _start_workers(self) -> None:
+        """What `on_ready` does with `BOT_WORKERS` set, with the fake models in every worker."""
+        from cluster import JobDispatcher, LocalJobTransport, WorkerPool, set_job_dispatcher
+
+        transport = LocalJobTransport(self.args.workers)
+        self._dispatcher = JobDispatcher(
+            transport, WorkerPool(transport, transport.worker_ids, setup="benchmarks.fakes:install_fake_models")
+        )
+        set_job_dispatcher(self._dispatcher)
+        await self._dispatcher.start()
+        while self._dispatcher.stats()["workers"] < self.args.workers:
+            await asyncio.sleep(0.1)
+
+    def _channel(self, guild: int, channel: int) -> Any:
+        from benchmarks.fakes import FakeChannel, FakeGuild
+
+        key = (guild, channel)
+        if key not in self._channels:
+            self._channels[key] = FakeChannel(10_000 * (guild + 1) + channel, FakeGuild(guild + 1))
+        return self._channels[key]
+
+    def _attachments(self, record: Dict[str, Any], index: int) -> List[Any]:
+        from benchmarks.fakes import FakeAttachment, synthetic_csv
+
+        rows = record.get("attachment_rows", 0)
+        if not rows:
+            return []
+        return [FakeAttachment(f"upload_{index}.csv", synthetic_csv(rows, seed=index))]
+
+    async def start(self) -> None:
+        """Setup that is not timed: the bot module and, with `--workers`, its worker processes."""
+        if self.args.driver != "discord":
+            return
+        # Only this driver needs discord.py.
+        import main
+
+        main.bot._connection.user = self.bot_user
+        self._main = main
+        if self.args.workers:
+            await self._start_workers()
+
+    async def discord(self, record: Dict[str, Any], index: int) -> Optional[str]:
+        from benchmarks.fakes import FakeMessage, FakeUser
+
+        channel = self._channel(record["guild"], record["channel"])
+        author = FakeUser(100_000 + record["user"], f"user{record['user']}")
+        message = FakeMessage(
+            f"<@{self.bot_user.id}> {record['content']}", author=author, channel=channel,
+            guild=channel.guild, attachments=self._attachments(record, index), mentions=[self.bot_user],
+        )
+        threads_before = len(channel.threads)
+        await self._main.on_message(message)
+        threads = channel.threads[threads_before:]
+        replies = [m for thread in threads for m in thread.sent] or channel.sent[-1:]
+        files = sum(len(thread.files) for thread in threads)
+        return _failure([reply.content for reply in replies]) or _missing_file(record, files)
+
+    async def graph(self, record: Dict[str, Any], index: int) -> Optional[str]:
+        from langchain_core.messages import HumanMessage
+        from lang.db.sources import get_data_sources
+        from lang.tools.file_processor import process_uploaded_file, read_attachment
+        from telemetry import start_trace, trace
+
+        loop = asyncio.get_running_loop()
+        thread_id = f"bench-{index}"
+        content = record["content"]
+        with start_trace("request", kind=record["kind"]):
+            for attachment in self._attachments(record, index):
+                upload = await read_attachment(attachment)
+                try:
+                    with trace("file.process"):
+                        processed = await loop.run_in_executor(
+                            None, contextvars.copy_context().run, process_uploaded_file, upload, thread_id
+                        )
+                finally:
+                    upload.discard()
+                content = f"File Content:\n{processed['content']}\n\n---\n\nUser Question: {content}"
+            data_source = get_data_sources().resolve(str(record["guild"] + 1), str(self._channel(record["guild"], record["channel"]).id), None)
+            inputs = {"messages": [HumanMessage(content=content)]}
+            run_config = {"configurable": {"thread_id": thread_id, "data_source": data_source, "guild_id": str(record["guild"] + 1)}}
+            if self.args.mode == "async":
+                state = await self.app.ainvoke(inputs, run_config)
+            else:
+                state = await loop.run_in_executor(None, contextvars.copy_context().run, self.app.invoke, inputs, run_config)
+        return _failure([str(state["messages"][-1].content)]) or _missing_file(record, len(state.get("artifacts") or []))
+
+
+# --- Measurement ---
+
+def _percentile(ordered: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def _run(traffic: List[Dict[str, Any]], drivers: Drivers) -> tuple:
+    results: List[Dict[str, Any]] = []
+
+    async def one(index: int, record: Dict[str, Any]) -> None:
+        await asyncio.sleep(max(0.0, started + record["at"] - time.perf_counter()))
+        sent = time.perf_counter()
+        try:
+            error = await send(record, index)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.append({"kind": record["kind"], "latency": time.perf_counter() - sent, "error": error})
+
+    send = drivers.discord if drivers.args.driver == "discord" else drivers.graph
+    await drivers.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i, record) for i, record in enumerate(traffic)))
+    wall = time.perf_counter() - started
+    await drivers.close()
+    return results, wall
+
+
+def _summarize(results: List[Dict[str, Any]], wall: float) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"wall_seconds": round(wall, 3), "kinds": {}}
+    groups = {kind: [r for r in results if r["kind"] == kind] for kind in KINDS}
+    groups["all"] = results
+    for kind, group in groups.items():
+        if not group:
+            continue
+        ordered = sorted(r["latency"] for r in group)
+        summary["kinds"][kind] = {
+            "requests": len(group),
+            "errors": sum(1 for r in group if r["error"]),
+            "throughput": round(len(group) / wall, 3),
+            "p50": round(statistics.median(ordered), 4),
+            "p95": round(_percentile(ordered, 0.95), 4),
+            "p99": round(_percentile(ordered, 0.99), 4),
+            "max": round(ordered[-1], 4),
+        }
+    summary["peak_rss_mb"] = _peak_rss_mb()
+    return summary
+
+
+def _llm_summary(usage: Dict[str, Any]) -> Dict[str, Any]:
+    """Per model: requests, how many the cache and single-flight answered, and the model time saved."""
+    models = {}
+    for model, counts in usage.get("models", {}).items():
+        requests = counts.get("calls", 0) + counts.get("cache_hit", 0) + counts.get("coalesced", 0)
+        models[model] = {
+            "requests": int(requests),
+            "calls": int(counts.get("calls", 0)),
+            "cache_hits": int(counts.get("cache_hit", 0)),
+            "coalesced": int(counts.get("coalesced", 0)),
+            "saved_share": round((requests - counts.get("calls", 0)) / requests, 4) if requests else 0.0,
+            "saved_seconds": round(counts.get("saved_seconds", 0), 3),
+        }
+    return models
+
+
+def _report(summary: Dict[str, Any], results: List[Dict[str, Any]]) -> None:
+    from streaming import time_to_first_token
+    from telemetry import span_duration
+
+    print(f"wall={summary['wall_seconds']:.2f}s | peak RSS="
+          + (f"{summary['peak_rss_mb']:.0f} MB" if summary["peak_rss_mb"] is not None else "n/a"))
+    for kind, stats in summary["kinds"].items():
+        print(
+            f"{kind:>7} | n={stats['requests']:5d} | errors={stats['errors']:4d} | "
+            f"throughput={stats['throughput']:7.2f} req/s | p50={stats['p50']:6.2f}s | "
+            f"p95={stats['p95']:6.2f}s | p99={stats['p99']:6.2f}s | max={stats['max']:6.2f}s"
+        )
+    for model, llm in summary.get("llm", {}).items():
+        print(
+            f"{'':>7} | {model:<28} requests={llm['requests']:5d} | calls={llm['calls']:5d} | "
+            f"cached={llm['cache_hits']:4d} | coalesced={llm['coalesced']:4d} | saved={llm['saved_share']:4.0%} "
+            f"({llm['saved_seconds']:.1f}s of model time)"
+        )
+    for labels, count, total in span_duration.series():
+        name = labels["span"]
+        print(
+            f"{'':>7} | {name:<28} n={count:5d} | avg={total / count:6.3f}s | "
+            f"p50={span_duration.quantile(0.5, span=name):6.3f}s | p99={span_duration.quantile(0.99, span=name):6.3f}s"
+        )
+    for labels, count, total in time_to_first_token.series():
+        mode = labels["mode"]
+        print(
+            f"{'':>7} | {'time to first token (' + mode + ')':<28} n={count:5d} | avg={total / count:6.3f}s | "
+            f"p50={time_to_first_token.quantile(0.5, mode=mode):6.3f}s | p99={time_to_first_token.quantile(0.99, mode=mode):6.3f}s"
+        )
+    errors = sorted({r["error"] for r in results if r["error"]})
+    for error in errors[:5]:
+        print(f"  error: {error[:200]!r}")
+
+
+def _regressions(summary: Dict[str, Any], baseline: Dict[str, Any], allowed: float) -> List[str]:
+    found = []
+    for kind, stats in summary["kinds"].items():
+        before = baseline.get("kinds", {}).get(kind)
+        if not before:
+            continue
+        for metric in ("p95", "p99"):
+            if before[metric] > 0 and stats[metric] > before[metric] * (1 + allowed):
+                found.append(f"{kind} {metric} {before[metric]:.3f}s -> {stats[metric]:.3f}s "
+                             f"(+{stats[metric] / before[metric] - 1:.0%}, allowed +{allowed:.0%})")
+        if stats["errors"] > before["errors"]:
+            found.append(f"{kind} errors {before['errors']} -> {stats['errors']}")
+    return found
+
+
+def main() -> None:
+    args = _parse_args()
+    if args.workers and args.driver != "discord":
+        sys.exit("--workers needs the discord driver: the graph driver does not go through the bot's dispatcher.")
+    os.makedirs(args.data_dir, exist_ok=True)
+    db_path = os.path.abspath(os.path.join(args.data_dir, f"orders_{args.rows}_{args.seed}.sqlite"))
+    workdir = tempfile.mkdtemp(prefix="text2sql-e2e-")
+    _configure_environment(args, db_path, workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    from benchmarks.fakes import build_synthetic_database, install_fake_models
+
+    started = time.perf_counter()
+    build_synthetic_database(db_path, orders=args.rows, seed=args.seed, rebuild=args.rebuild)
+    print(f"Synthetic database: {db_path} ({args.rows:,} orders, ready in {time.perf_counter() - started:.1f}s)")
+
+    traffic = _load_traffic(args.replay, args.speed) if args.replay else _generate_traffic(args)
+    if args.record:
+        _save_traffic(args.record, traffic)
+
+    # Uploads, exports and generated images are written relative to the working directory.
+    os.chdir(workdir)
+
+    drivers = Drivers(args)
+    # The models are built lazily, so the fakes are in place before the first request needs one.
+    install_fake_models()
+
+    duration = traffic[-1]["at"] if traffic else 0.0
+    print(f"{'Replaying' if args.replay else 'Sending'} {len(traffic)} requests over {duration:.1f}s "
+          f"({args.driver} driver, {args.mode} mode, {args.workers or 'no'} workers, LLM {args.llm_latency}s+{args.llm_jitter}s, workdir {workdir})")
+    results, wall = asyncio.run(_run(traffic, drivers))
+    summary = _summarize(results, wall)
+    summary["llm"] = _llm_summary(drivers.llm_usage)
+    summary["config"] = {k: v for k, v in vars(args).items() if k not in ("save_results", "baseline", "record")}
+    _report(summary, results)
+
+    if args.save_results:
+        with open(args.save_results, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = _regressions(summary, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
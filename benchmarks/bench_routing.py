@@ -0,0 +1,114 @@
+"""
+Routing benchmark: accuracy and per-route decision latency over a labeled prompt corpus.
+
+Each line of the corpus (`benchmarks/data/routing_corpus.jsonl`) holds a message, whether
+it carries an image, the expected route (`fast_path`, `agent` or `generate_image_node`)
+and, for fast-path prompts, the expected intent. The router is compared with the old
+keyword router. The schema catalog is replaced with a fixed set of tables, so no
+database or model is needed. Run from the repository root:
+
+    python -m benchmarks.bench_routing --repeat 2000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from lang.db.schema import SchemaCatalog, TableInfo, set_schema_catalog
+from lang.graph.router import ROUTE_AGENT, ROUTE_FAST_PATH, ROUTE_IMAGE, Router
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "routing_corpus.jsonl")
+TABLES = ("customers", "orders", "order_items", "products", "payments", "employees")
+# The keyword list the graph used before the routing stage, kept for comparison.
+LEGACY_IMAGE_KEYWORDS = ["generate", "create", "draw", "modify", "edit", "style", "design", "image", "photo"]
+# Model round trips each route costs per request.
+LLM_CALLS = {ROUTE_FAST_PATH: 0, ROUTE_IMAGE: 1, ROUTE_AGENT: 2}
+
+
+def _legacy_route(text: str, has_image: bool) -> str:
+    text = text.lower()
+    return ROUTE_IMAGE if any(k in text for k in LEGACY_IMAGE_KEYWORDS) or has_image else ROUTE_AGENT
+
+
+def _load_corpus(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * fraction + 0.5) - 1))]
+
+
+def _accuracy(corpus: List[dict], router: Router) -> None:
+    confusion: Dict[str, Counter] = defaultdict(Counter)
+    legacy_correct = 0
+    misroutes = []
+    for case in corpus:
+        decision = router.decide(case["text"], case["has_image"])
+        predicted = decision.route
+        if predicted == ROUTE_FAST_PATH and decision.match.intent.name != case.get("intent"):
+            predicted = f"fast_path:{decision.match.intent.name}"
+        confusion[case["route"]][predicted] += 1
+        if predicted != case["route"]:
+            misroutes.append((case["text"], case["route"], predicted))
+        # The old router had no fast path; those prompts count as correct if they reach the agent.
+        expected_legacy = ROUTE_AGENT if case["route"] == ROUTE_FAST_PATH else case["route"]
+        legacy_correct += _legacy_route(case["text"], case["has_image"]) == expected_legacy
+
+    correct = sum(confusion[route][route] for route in confusion)
+    print(f"Corpus: {len(corpus)} prompts ({CORPUS_PATH})")
+    print(f"Router accuracy:        {correct / len(corpus):6.1%}")
+    print(f"Legacy keyword router:  {legacy_correct / len(corpus):6.1%}  (fast-path prompts counted as agent)")
+    print("\nPer expected route:")
+    for route in sorted(confusion):
+        total = sum(confusion[route].values())
+        print(f"  {route:>20}: {confusion[route][route]:3d}/{total:<3d} correct   {dict(confusion[route])}")
+    if misroutes:
+        print("\nMisrouted:")
+        for text, expected, predicted in misroutes:
+            print(f"  - {text!r}: expected {expected}, got {predicted}")
+
+    fast = sum(1 for c in corpus if router.decide(c["text"], c["has_image"]).route == ROUTE_FAST_PATH)
+    legacy_calls = sum(LLM_CALLS[_legacy_route(c["text"], c["has_image"])] for c in corpus)
+    calls = sum(LLM_CALLS[router.decide(c["text"], c["has_image"]).route] for c in corpus)
+    print(f"\nLLM round trips for the corpus: {calls} (legacy: {legacy_calls}); {fast} prompts answered without the LLM")
+
+
+def _latency(corpus: List[dict], router: Router, repeat: int) -> None:
+    samples: Dict[str, List[float]] = defaultdict(list)
+    for case in corpus:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            decision = router.decide(case["text"], case["has_image"])
+            samples[decision.route].append(time.perf_counter() - started)
+    print(f"\nDecision latency per route ({repeat} runs per prompt):")
+    for route in sorted(samples):
+        ordered = sorted(samples[route])
+        print(
+            f"  {route:>20}: n={len(ordered):7d} | p50={_percentile(ordered, 0.50) * 1e6:7.1f} us | "
+            f"p99={_percentile(ordered, 0.99) * 1e6:7.1f} us | max={ordered[-1] * 1e6:8.1f} us"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=CORPUS_PATH, help="Labeled prompts, one JSON object per line.")
+    parser.add_argument("--repeat", type=int, default=1000, help="Routing decisions timed per prompt.")
+    args = parser.parse_args()
+
+    set_schema_catalog(SchemaCatalog(loader=lambda: {name: TableInfo(name) for name in TABLES}))
+    corpus = _load_corpus(args.corpus)
+    router = Router()
+    # The schema catalog logs its first load; keep the report readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        router.decide("describe orders")
+    _accuracy(corpus, router)
+    _latency(corpus, router, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Simulation benchmark: tail latency under bursty load, with and without the request scheduler.
+
+A shared backend with a fixed number of slots stands in for the Gemini quota and the
+database; text requests hold a slot for `--text-service` seconds and image requests
+for `--image-service` seconds. Several quiet servers send a steady trickle of requests
+while one server has a user who fires bursts of mentions. Without the scheduler every
+request goes straight to the backend in arrival order; with it, requests pass the
+per-user/per-server token buckets and the fair, prioritized queue. Run from the
+repository root:
+
+    python -m benchmarks.bench_scheduler --duration 20 --burst-size 40
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from scheduler import Priority, RateLimitedError, RequestScheduler, SchedulerBusyError
+
+# (arrival time, cohort, user id, guild id, priority)
+Arrival = Tuple[float, str, str, str, Priority]
+
+
+def _arrivals(args: argparse.Namespace) -> List[Arrival]:
+    rng = random.Random(args.seed)
+    arrivals: List[Arrival] = []
+    for g in range(args.quiet_guilds):
+        at = rng.expovariate(args.quiet_rate)
+        while at < args.duration:
+            is_image = rng.random() < args.image_share
+            arrivals.append((
+                at, "quiet image" if is_image else "quiet text", f"user-{g}-{rng.randrange(5)}", f"guild-{g}",
+                Priority.IMAGE if is_image else Priority.TEXT,
+            ))
+            at += rng.expovariate(args.quiet_rate)
+    burst_at = 0.5
+    while burst_at < args.duration:
+        arrivals.extend((burst_at + i * 0.001, "spam text", "spammer", "guild-spam", Priority.TEXT) for i in range(args.burst_size))
+        burst_at += args.burst_interval
+    return sorted(arrivals)
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * fraction + 0.5) - 1))]
+
+
+async def _simulate(arrivals: List[Arrival], args: argparse.Namespace, scheduled: bool) -> Dict[str, Dict[str, list]]:
+    backend = asyncio.Semaphore(args.backend_slots)
+    results: Dict[str, Dict[str, list]] = defaultdict(lambda: {"latencies": [], "rejected": []})
+    scheduler = RequestScheduler(
+        max_concurrency=args.backend_slots, max_image_concurrency=max(1, args.backend_slots // 4), max_queue=500,
+        user_rate=args.user_rate_per_min / 60, user_burst=3, guild_rate=args.guild_rate_per_min / 60, guild_burst=20,
+    )
+
+    async def backend_job(priority: Priority) -> None:
+        async with backend:
+            await asyncio.sleep(args.image_service if priority == Priority.IMAGE else args.text_service)
+
+    async def request(arrival: Arrival, started: float) -> None:
+        at, cohort, user_id, guild_id, priority = arrival
+        await asyncio.sleep(max(0.0, started + at - time.perf_counter()))
+        submitted = time.perf_counter()
+        try:
+            if scheduled:
+                scheduler.check_rate(user_id, guild_id)
+                await scheduler.run(lambda: backend_job(priority), user_id=user_id, guild_id=guild_id, priority=priority)
+            else:
+                await backend_job(priority)
+        except (RateLimitedError, SchedulerBusyError):
+            results[cohort]["rejected"].append(at)
+            return
+        results[cohort]["latencies"].append(time.perf_counter() - submitted)
+
+    started = time.perf_counter()
+    # The scheduler logs every rate-limit hit; keep the benchmark output readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(request(a, started) for a in arrivals))
+    return results
+
+
+def _report(mode: str, results: Dict[str, Dict[str, list]]) -> None:
+    print(f"\n{mode}")
+    for cohort in sorted(results):
+        latencies = sorted(results[cohort]["latencies"])
+        rejected = len(results[cohort]["rejected"])
+        if not latencies:
+            print(f"  {cohort:>12} | served=    0 | rejected={rejected:5d}")
+            continue
+        print(
+            f"  {cohort:>12} | served={len(latencies):5d} | rejected={rejected:5d} | "
+            f"p50={_percentile(latencies, 0.50):6.2f}s | p95={_percentile(latencies, 0.95):6.2f}s | "
+            f"p99={_percentile(latencies, 0.99):6.2f}s | max={latencies[-1]:6.2f}s"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=15.0, help="Seconds of simulated traffic.")
+    parser.add_argument("--backend-slots", type=int, default=8, help="Requests the backend serves at once.")
+    parser.add_argument("--text-service", type=float, default=0.3, help="Seconds a text request holds a slot.")
+    parser.add_argument("--image-service", type=float, default=1.5, help="Seconds an image request holds a slot.")
+    parser.add_argument("--quiet-guilds", type=int, default=10, help="Servers with steady, light traffic.")
+    parser.add_argument("--quiet-rate", type=float, default=0.8, help="Requests per second per quiet server.")
+    parser.add_argument("--image-share", type=float, default=0.15, help="Fraction of quiet requests that are images.")
+    parser.add_argument("--burst-size", type=int, default=60, help="Mentions per burst from the spamming user.")
+    parser.add_argument("--burst-interval", type=float, default=3.0, help="Seconds between bursts.")
+    parser.add_argument("--user-rate-per-min", type=float, default=30.0, help="Scheduler per-user token refill rate.")
+    parser.add_argument("--guild-rate-per-min", type=float, default=300.0, help="Scheduler per-server token refill rate.")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    arrivals = _arrivals(args)
+    print(f"Simulating {len(arrivals)} requests over {args.duration:.0f}s "
+          f"({args.backend_slots} backend slots, bursts of {args.burst_size} every {args.burst_interval:.0f}s)")
+    _report("unscheduled (arrival order, unbounded)", asyncio.run(_simulate(arrivals, args, scheduled=False)))
+    _report("scheduled (rate limits + fair priority queue)", asyncio.run(_simulate(arrivals, args, scheduled=True)))
+
+
+if __name__ == "__main__":
+    main()
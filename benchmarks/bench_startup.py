@@ -0,0 +1,87 @@
+"""
+Startup-time guard: runs `python -X importtime -c "import <module>"` in a fresh interpreter,
+reports the slowest packages and fails if the import exceeds a budget or pulls in a
+library that must only be imported on first use (model SDKs, DB drivers, file parsers).
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --module main --budget-ms 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+# Libraries that must stay out of the import path; they load inside the code that uses them.
+DEFERRED_MODULES = (
+    "langchain_google_genai",
+    "langchain.agents",
+    "mysql.connector",
+    "aiomysql",
+    "PyPDF2",
+    "pandas",
+    "pyarrow",
+    "openpyxl",
+)
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_profile(module: str) -> List[Tuple[str, int, int]]:
+    """Returns (module, self us, cumulative us) for every module imported by `import module`."""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=_REPO_ROOT, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        sys.exit(f"Importing '{module}' failed:\n{completed.stderr[-2000:]}")
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def _by_package(rows: List[Tuple[str, int, int]]) -> Dict[str, int]:
+    totals: Dict[str, int] = defaultdict(int)
+    for name, self_us, _ in rows:
+        totals[name.split(".")[0]] += self_us
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main", help="Module whose import is measured.")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters to start; the fastest run is reported.")
+    parser.add_argument("--top", type=int, default=15, help="Packages to list, by self time.")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Fail if the import takes longer than this.")
+    args = parser.parse_args()
+
+    runs = [_import_profile(args.module) for _ in range(args.runs)]
+    totals = [next((cum for name, _, cum in rows if name == args.module), 0) for rows in runs]
+    fastest = runs[totals.index(min(totals))]
+    total_ms = min(totals) / 1000
+
+    print(f"import {args.module}: {total_ms:.1f} ms (fastest of {args.runs}), {len(fastest)} modules")
+    print(f"\nTop {args.top} packages by self time:")
+    for package, self_us in sorted(_by_package(fastest).items(), key=lambda item: -item[1])[: args.top]:
+        print(f"  {package:<32} {self_us / 1000:8.1f} ms")
+
+    imported = {name for name, _, _ in fastest}
+    eager = [m for m in DEFERRED_MODULES if m in imported]
+    failures = []
+    if eager:
+        failures.append(f"deferred modules imported at startup: {', '.join(eager)}")
+    if args.budget_ms is not None and total_ms > args.budget_ms:
+        failures.append(f"import took {total_ms:.1f} ms, budget is {args.budget_ms:.1f} ms")
+    if failures:
+        print("\nFAIL: " + "; ".join(failures))
+        sys.exit(1)
+    print("\nOK: no deferred modules imported" + (f", within {args.budget_ms:.0f} ms budget" if args.budget_ms else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Throughput of the scale-out deployment as worker processes are added, on one machine.
+
+For each worker count, the real `JobDispatcher` (as the bot process runs it) sends
+`--jobs` jobs through `LocalJobTransport` to that many worker processes, which run
+the real graph with the fake Gemini model of `benchmarks/fakes.py` against a
+synthetic SQLite database. Each job carries a CSV of `--upload-rows` rows that the
+worker parses and bulk-loads before the model queries it, so a job costs CPU time
+like an upload does, plus `--llm-latency` seconds per model call of waiting.
+
+With one job per worker at a time (`--concurrency 1`) throughput should grow almost
+linearly with the worker count until the CPU cores are busy: the waiting part scales
+on any machine, the parsing part only up to `os.cpu_count()` workers. `--kill-after`
+kills a worker mid-run to show that its jobs are delivered again and every job still
+completes. Run from the repository root:
+
+    python -m benchmarks.bench_workers --workers 1,2,4 --jobs 120 --upload-rows 5000
+    python -m benchmarks.bench_workers --workers 4 --kill-after 2
+"""
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to measure.")
+    parser.add_argument("--jobs", type=int, default=120, help="Jobs per worker count.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs each worker runs at once (WORKER_CONCURRENCY).")
+    parser.add_argument("--upload-rows", type=int, default=5_000, help="Rows of the CSV each job uploads (0 for plain questions).")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds per fake model call.")
+    parser.add_argument("--mode", choices=("thread", "async"), default="thread", help="GRAPH_EXECUTION_MODE of the workers.")
+    parser.add_argument("--kill-after", type=float, help="Kill one worker this many seconds into each run.")
+    parser.add_argument("--min-efficiency", type=float, default=0.0,
+                        help="Exit with status 1 if the largest run's throughput per worker falls below this share of one worker's.")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "text2sql-bench"),
+                        help="Where the synthetic database is kept between runs.")
+    return parser.parse_args()
+
+
+def _configure_environment(args: argparse.Namespace, db_path: str, workdir: str) -> None:
+    """Read by the bot's modules at import time, here and in every worker process."""
+    os.environ["GRAPH_EXECUTION_MODE"] = args.mode
+    os.environ["CONVERSATION_DB_PATH"] = os.path.join(workdir, "conversations.sqlite")
+    os.environ["DATA_SOURCES"] = f"default=sqlite:///{db_path}"
+    os.environ["DATA_SOURCE_REPLICAS"] = ""
+    os.environ["DATA_SOURCE_ROUTES"] = ""
+    os.environ["INGEST_CACHE_DIR"] = os.path.join(workdir, "cache", "ingest")
+    os.environ["STARTUP_PREWARM"] = ""
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["WORKER_CONCURRENCY"] = str(args.concurrency)
+    os.environ["WORKER_HEARTBEAT_SECONDS"] = "0.5"
+    os.environ["WORKER_HEARTBEAT_TIMEOUT"] = "3"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["TRACE_SAMPLE_RATE"] = "0"
+    os.environ["TRACE_SLOW_SECONDS"] = "1000000"
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    os.environ["BENCH_LLM_LATENCY"] = str(args.llm_latency)
+
+
+def _jobs(run: str, count: int, csv: bytes) -> List[Any]:
+    from cluster import Job
+
+    if not csv:
+        return [Job(f"{run}-{i}", f"how many orders did customer {i % 500 + 1} place?", "default") for i in range(count)]
+    return [Job(f"{run}-{i}", "How many rows does this file have?", "default", (f"sales_{i}.csv", csv)) for i in range(count)]
+
+
+async def _wait_for_workers(dispatcher: Any, count: int, timeout: float = 120.0) -> None:
+    deadline = time.monotonic() + timeout
+    while dispatcher.stats()["workers"] < count:
+        if time.monotonic() > deadline:
+            raise SystemExit(f"Only {dispatcher.stats()['workers']} of {count} workers started within {timeout:.0f}s.")
+        await asyncio.sleep(0.1)
+
+
+async def _measure(args: argparse.Namespace, workers: int, csv: bytes) -> Dict[str, Any]:
+    from cluster import JobDispatcher, LocalJobTransport, WorkerPool
+
+    transport = LocalJobTransport(workers)
+    pool = WorkerPool(transport, transport.worker_ids, setup="benchmarks.fakes:install_fake_models")
+    dispatcher = JobDispatcher(transport, pool)
+    await dispatcher.start()
+    try:
+        await _wait_for_workers(dispatcher, workers)
+        # One job per worker first, so imports and first-use setup are not timed.
+        await asyncio.gather(*(dispatcher.run(job) for job in _jobs(f"warmup{workers}", workers, csv)))
+        before = dict(dispatcher.stats())
+
+        async def timed(job) -> float:
+            started = time.perf_counter()
+            await dispatcher.run(job)
+            return time.perf_counter() - started
+
+        async def kill_one() -> None:
+            await asyncio.sleep(args.kill_after)
+            process = pool.process(transport.worker_ids[0])
+            print(f"  killing worker {transport.worker_ids[0]} (pid {process.pid})")
+            os.kill(process.pid, signal.SIGKILL)
+
+        killer = asyncio.create_task(kill_one()) if args.kill_after is not None else None
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(timed(job) for job in _jobs(f"run{workers}", args.jobs, csv)))
+        wall = time.perf_counter() - started
+        if killer is not None:
+            killer.cancel()
+        after = dispatcher.stats()
+    finally:
+        await dispatcher.close()
+    ordered = sorted(latencies)
+    return {
+        "workers": workers,
+        "wall": wall,
+        "throughput": len(latencies) / wall,
+        "p50": statistics.median(ordered),
+        "p99": ordered[min(len(ordered) - 1, int(round(0.99 * len(ordered))) - 1)],
+        **{key: after[key] - before[key] for key in ("completed", "redelivered", "duplicates", "lost_workers")},
+    }
+
+
+def main() -> None:
+    args = _parse_args()
+    counts = [int(n) for n in args.workers.split(",") if n.strip()]
+    sys.path.insert(0, os.getcwd())
+    from benchmarks.fakes import build_synthetic_database, synthetic_csv
+
+    db_path = build_synthetic_database(os.path.join(args.data_dir, "orders_10000_0.sqlite"), 10_000)
+    workdir = tempfile.mkdtemp(prefix="text2sql-workers-")
+    os.chdir(workdir)
+    _configure_environment(args, db_path, workdir)
+    csv = synthetic_csv(args.upload_rows) if args.upload_rows else b""
+
+    print(f"{args.jobs} jobs per run, {args.concurrency} at a time per worker, CSV of {args.upload_rows:,} rows, "
+          f"LLM {args.llm_latency}s, {os.cpu_count()} CPU core(s), {args.mode} mode")
+    results = [asyncio.run(_measure(args, workers, csv)) for workers in counts]
+    base = results[0]["throughput"] / results[0]["workers"]
+    for r in results:
+        efficiency = r["throughput"] / (base * r["workers"])
+        r["efficiency"] = efficiency
+        print(
+            f"workers={r['workers']:3d} | wall={r['wall']:7.2f}s | throughput={r['throughput']:7.2f} jobs/s | "
+            f"speedup={r['throughput'] / results[0]['throughput']:5.2f}x | efficiency={efficiency:5.0%} | "
+            f"p50={r['p50']:6.2f}s | p99={r['p99']:6.2f}s | completed={r['completed']} | "
+            f"redelivered={r['redelivered']} | duplicates={r['duplicates']} | workers lost={r['lost_workers']}"
+        )
+    if args.min_efficiency and results[-1]["efficiency"] < args.min_efficiency:
+        print(f"SCALING: efficiency {results[-1]['efficiency']:.0%} with {results[-1]['workers']} workers "
+              f"is below {args.min_efficiency:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+"""
+Offline stand-ins for the bot's external services, shared by the benchmarks:
+
+- `FakeGeminiChat`: a chat model that answers with scripted tool calls after a
+  configurable latency, in place of `ChatGoogleGenerativeAI`; `install_fake_models`
+  registers it in this process or a worker process.
+- `build_synthetic_database`: a SQLite file with customers/products/orders tables
+  (10k to 10M orders) that serves as the MySQL data source through `sqlite_compat`.
+- `FakeUser`, `FakeChannel`, `FakeThread`, `FakeMessage`, `FakeAttachment`: just
+  enough of discord.py's objects for `main.on_message` to run end to end.
+"""
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# --- Fake LLM ---
+
+_CUSTOMER_RE = re.compile(r"customer (\d+)")
+_RANGE_RE = re.compile(r"customers (\d+)-(\d+)")
+_UPLOADED_TABLE_RE = re.compile(r"loaded as the table `([^`]+)`")
+# Words per streamed chunk of a fake answer.
+_STREAM_CHUNK_WORDS = 8
+# A 1x1 transparent PNG, returned by the fake image model.
+_PIXEL_PNG = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+def _text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+
+def _estimate_tokens(messages: Sequence[BaseMessage]) -> int:
+    return sum(len(_text(m)) for m in messages) // 4 + 1
+
+
+class FakeGeminiChat(BaseChatModel):
+    """
+    Answers like the agent would, without a network call.
+
+    The first step of a turn is a tool call picked from the question's wording:
+    "export" -> `export_to_excel`, "compare" -> `query_database_batch`, a question
+    about an uploaded file -> `query_uploaded_data`, anything else -> `query_database`.
+    Once the tool results are in, the next step answers with them. Every call sleeps
+    for `latency` seconds plus up to `jitter` seconds and reports token usage. When
+    streamed, a text answer then arrives in chunks of a few words, `chunk_latency`
+    seconds apart, like Gemini's streaming responses.
+    """
+
+    latency: float = 0.5
+    chunk_latency: float = 0.0
+    jitter: float = 0.0
+    seed: int = 0
+    image: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "FakeGeminiChat":
+        return self
+
+    def _delay(self, messages: Sequence[BaseMessage]) -> float:
+        # Seeded by the conversation so a replay sleeps the same amount for the same message.
+        rng = random.Random(f"{self.seed}:{_text(messages[-1])[:200]}:{len(messages)}")
+        return self.latency + rng.random() * self.jitter
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._delay(messages) + self._writing_time(messages))
+        return self._result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._delay(messages) + self._writing_time(messages))
+        return self._result(messages)
+
+    def _writing_time(self, messages: List[BaseMessage]) -> float:
+        # A model takes as long to write an answer whether or not it is streamed.
+        return (len(self._chunks(messages)) - 1) * self.chunk_latency
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self._delay(messages))
+        for index, chunk in enumerate(self._chunks(messages)):
+            if index and self.chunk_latency:
+                time.sleep(self.chunk_latency)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._delay(messages))
+        for index, chunk in enumerate(self._chunks(messages)):
+            if index and self.chunk_latency:
+                await asyncio.sleep(self.chunk_latency)
+            yield chunk
+
+    def _chunks(self, messages: List[BaseMessage]) -> List[ChatGenerationChunk]:
+        """The response split into chunks of `_STREAM_CHUNK_WORDS` words; tool calls and usage ride on the last one."""
+        message = self._result(messages).generations[0].message
+        words = re.findall(r"\S+\s*", message.content) if isinstance(message.content, str) else []
+        words = ["".join(words[i:i + _STREAM_CHUNK_WORDS]) for i in range(0, len(words), _STREAM_CHUNK_WORDS)]
+        if len(words) < 2:
+            return [ChatGenerationChunk(message=AIMessageChunk(
+                content=message.content, tool_calls=message.tool_calls, usage_metadata=message.usage_metadata
+            ))]
+        chunks = [ChatGenerationChunk(message=AIMessageChunk(content=word)) for word in words[:-1]]
+        chunks.append(ChatGenerationChunk(message=AIMessageChunk(
+            content=words[-1], tool_calls=message.tool_calls, usage_metadata=message.usage_metadata
+        )))
+        return chunks
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        message = self._respond(messages)
+        output_tokens = len(_text(message)) // 4 + 8 * len(message.tool_calls) + 1
+        message.usage_metadata = {
+            "input_tokens": _estimate_tokens(messages),
+            "output_tokens": output_tokens,
+            "total_tokens": _estimate_tokens(messages) + output_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _respond(self, messages: List[BaseMessage]) -> AIMessage:
+        if self.image:
+            return AIMessage(content=[{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{_PIXEL_PNG}"}}])
+        last = messages[-1]
+        if isinstance(last, ToolMessage):
+            results = [m for m in messages if isinstance(m, ToolMessage)]
+            return AIMessage(content="Here is what I found:\n" + "\n".join(str(m.content) for m in results[-3:]))
+        if not isinstance(last, HumanMessage):
+            return AIMessage(content="Summary of the earlier conversation.")
+        question = _text(last).lower()
+        uploaded = _UPLOADED_TABLE_RE.search(_text(last))
+        if uploaded:
+            call = ("query_uploaded_data", {"query": f'SELECT COUNT(*) AS row_count FROM "{uploaded.group(1)}"'})
+        elif "export" in question:
+            span = _RANGE_RE.search(question)
+            low, high = (int(span.group(1)), int(span.group(2))) if span else (1, 100)
+            file_format = "xlsx" if "excel" in question else "csv"
+            call = ("export_to_excel", {
+                "query": f"SELECT * FROM orders WHERE customer_id BETWEEN {low} AND {high}",
+                "table_name": "orders",
+                "file_format": file_format,
+            })
+        elif "compare" in question:
+            call = ("query_database_batch", {"queries": [
+                "SELECT c.region, SUM(o.amount) AS revenue FROM orders o JOIN customers c ON c.id = o.customer_id GROUP BY c.region",
+                "SELECT status, COUNT(*) AS orders FROM orders GROUP BY status",
+                "SELECT p.category, SUM(o.quantity) AS units FROM orders o JOIN products p ON p.id = o.product_id GROUP BY p.category",
+            ]})
+        else:
+            match = _CUSTOMER_RE.search(question)
+            customer = int(match.group(1)) if match else 1
+            call = ("query_database", {
+                "query": f"SELECT id, product_id, quantity, amount, status, created_at FROM orders "
+                         f"WHERE customer_id = {customer} ORDER BY created_at DESC"
+            })
+        name, args = call
+        return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{name}_{len(messages)}"}])
+
+
+def install_fake_models() -> None:
+    """
+    Puts the fake models in the registry, configured by the `BENCH_LLM_*` environment
+    variables so worker processes (`WorkerPool(setup=...)`) get the same ones.
+    """
+    import config
+    from llm_cache import cached_chat_model
+    from registry import registry
+
+    latency = float(os.environ.get("BENCH_LLM_LATENCY", "0.5"))
+    jitter = float(os.environ.get("BENCH_LLM_JITTER", "0"))
+    seed = int(os.environ.get("BENCH_SEED", "0"))
+    # Wrapped like the real clients, so the LLM_CACHE_* settings apply to the fakes too.
+    registry.override("llm", cached_chat_model(FakeGeminiChat(
+        latency=latency, jitter=jitter, seed=seed, chunk_latency=float(os.environ.get("BENCH_CHUNK_LATENCY", "0"))
+    ), config.GEMINI_MODEL_NAME))
+    registry.override("image_llm", cached_chat_model(
+        FakeGeminiChat(latency=latency * 4, jitter=jitter, seed=seed, image=True), config.IMAGE_MODEL_NAME, cache=False
+    ))
+
+
+# --- Synthetic Database ---
+
+_REGIONS = ("north", "south", "east", "west", "central")
+_CATEGORIES = ("books", "games", "garden", "kitchen", "music", "sports", "tools", "toys")
+_STATUSES = ("pending", "paid", "shipped", "delivered", "refunded")
+
+
+def _chunks(rows: Iterator[Tuple], size: int = 50_000) -> Iterator[List[Tuple]]:
+    chunk: List[Tuple] = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def build_synthetic_database(path: str, orders: int = 10_000, seed: int = 0, rebuild: bool = False) -> str:
+    """
+    Creates (or reuses) a SQLite database with `orders` order rows, `orders // 10`
+    customers and 1,000 products, indexed like a typical OLTP schema.
+    """
+    if os.path.exists(path) and not rebuild:
+        return path
+    # Build under a temporary name so an interrupted build is never reused.
+    building = f"{path}.building"
+    if os.path.exists(building):
+        os.remove(building)
+    rng = random.Random(seed)
+    customers = max(1, orders // 10)
+    started = datetime(2023, 1, 1)
+    conn = sqlite3.connect(building)
+    try:
+        conn.executescript(
+            """
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT NOT NULL, region TEXT NOT NULL, created_at TEXT NOT NULL);
+            CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT NOT NULL, category TEXT NOT NULL, price REAL NOT NULL);
+            CREATE TABLE orders (
+                id INTEGER PRIMARY KEY,
+                customer_id INTEGER NOT NULL REFERENCES customers(id),
+                product_id INTEGER NOT NULL REFERENCES products(id),
+                quantity INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+        conn.executemany("INSERT INTO customers VALUES (?, ?, ?, ?)", (
+            (i, f"Customer {i}", rng.choice(_REGIONS), (started + timedelta(days=rng.randrange(365))).isoformat(" "))
+            for i in range(1, customers + 1)
+        ))
+        prices = {i: round(rng.uniform(2, 500), 2) for i in range(1, 1001)}
+        conn.executemany("INSERT INTO products VALUES (?, ?, ?, ?)", (
+            (i, f"Product {i}", rng.choice(_CATEGORIES), price) for i, price in prices.items()
+        ))
+        rows = (
+            (i, rng.randint(1, customers), product, quantity, round(prices[product] * quantity, 2), rng.choice(_STATUSES),
+             (started + timedelta(seconds=rng.randrange(2 * 365 * 86400))).isoformat(" "))
+            for i in range(1, orders + 1)
+            for product, quantity in [(rng.randint(1, 1000), rng.randint(1, 5))]
+        )
+        for chunk in _chunks(rows):
+            conn.executemany("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?)", chunk)
+        conn.executescript(
+            """
+            CREATE INDEX idx_orders_customer ON orders (customer_id);
+            CREATE INDEX idx_orders_created ON orders (created_at);
+            CREATE INDEX idx_orders_product ON orders (product_id);
+            ANALYZE;
+            """
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(building, path)
+    return path
+
+
+def synthetic_csv(rows: int, seed: int = 0) -> bytes:
+    """A CSV upload with `rows` data rows."""
+    rng = random.Random(seed)
+    lines = ["order_id,region,amount,ordered_on"]
+    lines.extend(
+        f"{i},{rng.choice(_REGIONS)},{rng.uniform(1, 900):.2f},2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        for i in range(1, rows + 1)
+    )
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+# --- Fake Discord ---
+
+class _DiscordLatency:
+    """Seconds every fake Discord API call (send, edit, thread creation, download) takes."""
+    seconds = 0.0
+
+    @classmethod
+    async def wait(cls) -> None:
+        if cls.seconds:
+            await asyncio.sleep(cls.seconds)
+
+
+def set_discord_latency(seconds: float) -> None:
+    _DiscordLatency.seconds = seconds
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+
+    def mentioned_in(self, message: "FakeMessage") -> bool:
+        return any(user.id == self.id for user in message.mentions)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeAttachment:
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.size = len(data)
+        self._data = data
+
+    async def read(self) -> bytes:
+        await _DiscordLatency.wait()
+        return self._data
+
+    async def save(self, fp: Any) -> int:
+        await _DiscordLatency.wait()
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, "wb") as f:
+                f.write(self._data)
+        else:
+            fp.write(self._data)
+        return self.size
+
+
+class FakeMessage:
+    """A sent or received message; every edit and reply is recorded."""
+
+    _next_id = 1_000_000
+
+    def __init__(self, content: str = "", author: Optional[FakeUser] = None, channel: Any = None,
+                 guild: Optional[FakeGuild] = None, attachments: Optional[List[FakeAttachment]] = None,
+                 mentions: Optional[List[FakeUser]] = None):
+        FakeMessage._next_id += 1
+        self.id = FakeMessage._next_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.attachments = attachments or []
+        self.mentions = mentions or []
+        self.edits: List[str] = []
+        self.deleted = False
+        self.created_at = time.perf_counter()
+
+    async def edit(self, content: Optional[str] = None, **kwargs: Any) -> "FakeMessage":
+        await _DiscordLatency.wait()
+        if content is not None:
+            self.content = content
+            self.edits.append(content)
+        return self
+
+    async def delete(self) -> None:
+        await _DiscordLatency.wait()
+        self.deleted = True
+
+    async def reply(self, content: Optional[str] = None, **kwargs: Any) -> "FakeMessage":
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: Optional[FakeGuild]):
+        self.id = channel_id
+        self.guild = guild
+        self.sent: List[FakeMessage] = []
+        self.files: List[Any] = []
+        self.threads: List["FakeThread"] = []
+
+    async def send(self, content: Optional[str] = None, file: Any = None, files: Optional[List[Any]] = None,
+                   **kwargs: Any) -> FakeMessage:
+        await _DiscordLatency.wait()
+        message = FakeMessage(content or "", channel=self, guild=self.guild)
+        if file is not None:
+            self.files.append(file)
+        self.files.extend(files or [])
+        self.sent.append(message)
+        return message
+
+    async def create_thread(self, name: str, type: Any = None, **kwargs: Any) -> "FakeThread":
+        await _DiscordLatency.wait()
+        FakeMessage._next_id += 1
+        thread = FakeThread(FakeMessage._next_id, self.guild, parent_id=self.id, name=name)
+        self.threads.append(thread)
+        return thread
+
+
+class FakeThread(FakeChannel):
+    def __init__(self, thread_id: int, guild: Optional[FakeGuild], parent_id: int, name: str = "", owner_id: Optional[int] = None):
+        super().__init__(thread_id, guild)
+        self.parent_id = parent_id
+        self.name = name
+        self.owner_id = owner_id
+
+
+def traffic_record(kind: str, at: float, user: int, guild: int, channel: int, content: str,
+                   attachment_rows: int = 0) -> Dict[str, Any]:
+    """One line of a recorded-traffic file (JSONL)."""
+    record = {"at": round(at, 4), "kind": kind, "user": user, "guild": guild, "channel": channel, "content": content}
+    if attachment_rows:
+        record["attachment_rows"] = attachment_rows
+    return record
@@ -0,0 +1,493 @@
+"""
+Scale-out deployment: the bot process only talks to Discord and hands every request
+to a pool of worker processes (`worker.py`) that run the LangGraph app.
+
+- `JobTransport` moves jobs to workers and events (heartbeats, progress, results) back.
+  `LocalJobTransport` uses multiprocessing queues on one machine; an external broker
+  plugs in through `JOB_TRANSPORT="package.module:ClassName"`.
+- `JobDispatcher` runs in the bot process. It sends each job to the least busy live
+  worker (the same worker as before for a thread, which holds the thread's uploaded
+  tables), and when a worker stops sending heartbeats it sends that worker's
+  unfinished jobs to another one. Delivery is therefore at least once: a job can run
+  twice, and only its first result is used.
+- `WorkerPool` starts the local worker processes and restarts those that exit.
+"""
+import asyncio
+import importlib
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from config import (
+    BOT_WORKERS,
+    JOB_MAX_ATTEMPTS,
+    JOB_TRANSPORT,
+    WORKER_HEARTBEAT_SECONDS,
+    WORKER_HEARTBEAT_TIMEOUT,
+)
+from telemetry import get_logger, metrics
+
+log = get_logger(__name__)
+
+worker_jobs_total = metrics.counter(
+    "text2sql_worker_jobs_total", "Jobs handed to worker processes, by outcome.", ["outcome"]
+)
+
+# Threads whose worker is remembered; the oldest are forgotten beyond this.
+_MAX_AFFINITY_ENTRIES = 10_000
+
+
+class JobFailedError(Exception):
+    """A job raised on its worker, or every worker it was sent to was lost."""
+
+
+@dataclass
+class Job:
+    """
+    One request for a worker. Everything in it survives pickling; a JSON-based broker
+    must encode the attachment's bytes itself.
+    """
+
+    thread_id: str
+    text: str
+    data_source: Optional[str] = None
+    # (filename, bytes) of the request's first attachment, parsed on the worker.
+    attachment: Optional[Tuple[str, bytes]] = None
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    # Deliveries so far, counting the current one.
+    attempt: int = 0
+    # The Discord guild the request came from, for per-guild usage accounting.
+    guild_id: Optional[str] = None
+    # The server's upload limit: larger files are not read or sent back, only named.
+    max_file_bytes: Optional[int] = None
+
+    def message(self) -> Dict[str, Any]:
+        return {"type": "job", **asdict(self)}
+
+    @classmethod
+    def from_message(cls, message: Dict[str, Any]) -> "Job":
+        return cls(**{k: v for k, v in message.items() if k != "type"})
+
+
+class JobTransport(ABC):
+    """
+    Carries messages between the bot process and its workers. Messages are dicts
+    with a "type": the bot sends "job", "cancel", "forget" and "stop" messages to one
+    worker, and every worker publishes "heartbeat", "started", "tokens", "status",
+    "result" and "bye" events on one shared stream that the bot reads.
+
+    An implementation for an external broker (for example a Redis list or a RabbitMQ
+    queue per worker, plus one for events) needs these methods, a constructor without
+    arguments that reads its own settings from the environment, and workers started
+    with `python -m worker --id <unique id>` on each machine. `send` and `publish` are
+    called from several threads and should not block for long.
+    """
+
+    @abstractmethod
+    def send(self, worker_id: str, message: Dict[str, Any]) -> None:
+        """Queues a message for one worker."""
+
+    @abstractmethod
+    def receive(self, worker_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """The worker's next message, or None after `timeout` seconds."""
+
+    @abstractmethod
+    def publish(self, event: Dict[str, Any]) -> None:
+        """Sends an event from a worker to the bot process."""
+
+    @abstractmethod
+    def next_event(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """The next worker event, or None after `timeout` seconds."""
+
+    def close(self) -> None:
+        pass
+
+
+class LocalJobTransport(JobTransport):
+    """Multiprocessing queues: one inbox per worker and one event queue, on this machine only."""
+
+    def __init__(self, workers: int):
+        context = multiprocessing.get_context("spawn")
+        self._inboxes = {f"local-{index}": context.Queue() for index in range(workers)}
+        self._events = context.Queue()
+
+    def send(self, worker_id: str, message: Dict[str, Any]) -> None:
+        self._inboxes[worker_id].put(message)
+
+    def receive(self, worker_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self._inboxes[worker_id].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self._events.put(event)
+
+    def next_event(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    @property
+    def worker_ids(self) -> List[str]:
+        return list(self._inboxes)
+
+
+def load_transport(spec: str) -> JobTransport:
+    """Builds the transport named by `JOB_TRANSPORT`'s "package.module:ClassName" form."""
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise ValueError(f"JOB_TRANSPORT must be 'local' or 'package.module:ClassName', got '{spec}'.")
+    transport = getattr(importlib.import_module(module_name), class_name)()
+    if not isinstance(transport, JobTransport):
+        raise ValueError(f"{spec} is not a JobTransport.")
+    return transport
+
+
+class WorkerPool:
+    """
+    Runs the given workers as processes on this machine and restarts any that exit.
+    `setup` ("package.module:function") runs first in every worker; the benchmarks use
+    it to install their fake model.
+    """
+
+    def __init__(self, transport: JobTransport, worker_ids: List[str], setup: Optional[str] = None):
+        self.transport = transport
+        self.worker_ids = list(worker_ids)
+        self.setup = setup
+        self.restarts = 0
+        self._processes: Dict[str, multiprocessing.process.BaseProcess] = {}
+
+    def start(self) -> None:
+        for worker_id in self.worker_ids:
+            self._spawn(worker_id)
+        if self._processes:
+            log.info("WORKERS", f"Started {len(self._processes)} worker process(es).")
+
+    def check(self) -> List[str]:
+        """Restarts workers whose process has exited and returns their ids."""
+        exited = []
+        for worker_id, process in list(self._processes.items()):
+            if not process.is_alive():
+                log.warning("WORKERS", f"Worker {worker_id} exited (code {process.exitcode}); restarting it.")
+                self.restarts += 1
+                exited.append(worker_id)
+                self._spawn(worker_id)
+        return exited
+
+    def process(self, worker_id: str) -> Optional[multiprocessing.process.BaseProcess]:
+        return self._processes.get(worker_id)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        for worker_id in self._processes:
+            self.transport.send(worker_id, {"type": "stop"})
+        for process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
+
+    def _spawn(self, worker_id: str) -> None:
+        # Imported here: the worker module loads the graph, which the transport does not need.
+        from worker import run_worker
+
+        # Local queues are handed to the process; an external transport is rebuilt there from JOB_TRANSPORT.
+        transport = self.transport if isinstance(self.transport, LocalJobTransport) else None
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=run_worker,
+            args=(transport, worker_id, self.setup),
+            name=f"worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+
+@dataclass
+class _Worker:
+    worker_id: str
+    last_seen: float
+    slots: int = 1
+    alive: bool = True
+    host: str = ""
+    pid: int = 0
+    completed: int = 0
+    jobs: Set[str] = field(default_factory=set)
+    # The worker's latest model usage report (`LLMUsage.snapshot()`).
+    llm: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class _Pending:
+    job: Job
+    future: asyncio.Future
+    on_event: Optional[Callable[[Dict[str, Any]], None]]
+    worker_id: Optional[str] = None
+
+
+class JobDispatcher:
+    """
+    Sends jobs to workers and waits for their results, on the bot's event loop.
+
+    Worker events are read on a background thread and handled on the loop. A worker
+    joins with its first heartbeat. Jobs submitted before any worker has joined wait
+    for one. A worker that has not been heard from for `heartbeat_timeout` seconds is
+    presumed dead: its unfinished jobs are sent to another worker, and a job that has
+    been delivered `max_attempts` times fails instead.
+    """
+
+    def __init__(self, transport: JobTransport, pool: Optional[WorkerPool] = None,
+                 heartbeat_timeout: float = WORKER_HEARTBEAT_TIMEOUT, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.transport = transport
+        self.pool = pool
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.workers: Dict[str, _Worker] = {}
+        self._pending: Dict[str, _Pending] = {}
+        self._waiting: Deque[_Pending] = deque()
+        self._affinity: "OrderedDict[str, str]" = OrderedDict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._monitor: Optional[asyncio.Task] = None
+        self._stopping = threading.Event()
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "redelivered": 0, "duplicates": 0, "lost_workers": 0}
+
+    async def start(self) -> None:
+        if self._loop is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        if self.pool is not None:
+            self.pool.start()
+        self._reader = threading.Thread(target=self._read_events, name="job-events", daemon=True)
+        self._reader.start()
+        self._monitor = asyncio.create_task(self._watch_workers())
+
+    async def run(self, job: Job, on_event: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """
+        Sends `job` to a worker and returns its result event. `on_event` receives the
+        job's "tokens" and "status" events. Cancelling the call cancels the job.
+        """
+        await self.start()
+        pending = _Pending(job, self._loop.create_future(), on_event)
+        self._pending[job.job_id] = pending
+        self._counters["submitted"] += 1
+        self._assign(pending)
+        try:
+            return await pending.future
+        except asyncio.CancelledError:
+            if pending.worker_id is not None:
+                self.transport.send(pending.worker_id, {"type": "cancel", "job_id": job.job_id, "thread_id": job.thread_id})
+            worker_jobs_total.inc(outcome="cancelled")
+            raise
+        finally:
+            self._pending.pop(job.job_id, None)
+            if pending in self._waiting:
+                self._waiting.remove(pending)
+            worker = self.workers.get(pending.worker_id)
+            if worker is not None:
+                worker.jobs.discard(job.job_id)
+
+    def broadcast(self, message: Dict[str, Any]) -> None:
+        """Sends a message to every live worker, e.g. "forget" for a thread's uploaded tables."""
+        for worker in self.workers.values():
+            if worker.alive:
+                self.transport.send(worker.worker_id, message)
+
+    def stats(self) -> Dict[str, Any]:
+        alive = [w for w in self.workers.values() if w.alive]
+        return {
+            **self._counters,
+            "workers": len(alive),
+            "slots": sum(w.slots for w in alive),
+            "running": sum(len(w.jobs) for w in alive),
+            "waiting": len(self._waiting),
+            "restarts": self.pool.restarts if self.pool is not None else 0,
+            "per_worker": {
+                w.worker_id: {
+                    "alive": w.alive, "running": len(w.jobs), "completed": w.completed, "host": w.host, "pid": w.pid, "llm": w.llm,
+                }
+                for w in self.workers.values()
+            },
+        }
+
+    async def close(self) -> None:
+        self._stopping.set()
+        if self._monitor is not None:
+            self._monitor.cancel()
+        if self.pool is not None:
+            await asyncio.to_thread(self.pool.stop)
+        if self._reader is not None:
+            await asyncio.to_thread(self._reader.join, 2.0)
+        self.transport.close()
+        self._loop = None
+
+    # --- Assignment ---
+
+    def _pick_worker(self, thread_id: str) -> Optional[_Worker]:
+        # The thread's previous worker holds its uploaded tables.
+        previous = self.workers.get(self._affinity.get(thread_id))
+        if previous is not None and previous.alive:
+            return previous
+        alive = [w for w in self.workers.values() if w.alive]
+        if not alive:
+            return None
+        return min(alive, key=lambda w: (len(w.jobs) / max(1, w.slots), w.worker_id))
+
+    def _assign(self, pending: _Pending) -> None:
+        job = pending.job
+        worker = self._pick_worker(job.thread_id)
+        if worker is None:
+            self._waiting.append(pending)
+            return
+        job.attempt += 1
+        pending.worker_id = worker.worker_id
+        worker.jobs.add(job.job_id)
+        self._affinity[job.thread_id] = worker.worker_id
+        self._affinity.move_to_end(job.thread_id)
+        if len(self._affinity) > _MAX_AFFINITY_ENTRIES:
+            self._affinity.popitem(last=False)
+        try:
+            self.transport.send(worker.worker_id, job.message())
+        except Exception as e:
+            # The worker is unreachable; the heartbeat check will move the job elsewhere.
+            log.error("WORKERS", f"Could not send job {job.job_id} to {worker.worker_id}: {e}")
+
+    def _lose(self, worker: _Worker, reason: str) -> None:
+        worker.alive = False
+        if reason == "stopped" and not worker.jobs:
+            log.info("WORKERS", f"Worker {worker.worker_id} stopped.")
+            return
+        self._counters["lost_workers"] += 1
+        log.warning("WORKERS", f"Worker {worker.worker_id} lost ({reason}); {len(worker.jobs)} job(s) to reassign.")
+        jobs, worker.jobs = worker.jobs, set()
+        for job_id in jobs:
+            pending = self._pending.get(job_id)
+            if pending is None or pending.future.done():
+                continue
+            if pending.job.attempt >= self.max_attempts:
+                self._counters["failed"] += 1
+                worker_jobs_total.inc(outcome="lost")
+                pending.future.set_exception(JobFailedError(
+                    f"The job was lost with {pending.job.attempt} worker(s); giving up."
+                ))
+                continue
+            self._counters["redelivered"] += 1
+            worker_jobs_total.inc(outcome="redelivered")
+            pending.worker_id = None
+            self._assign(pending)
+
+    # --- Events ---
+
+    def _read_events(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                event = self.transport.next_event(timeout=0.5)
+            except Exception as e:
+                log.error("WORKERS", f"Reading worker events failed: {e}")
+                time.sleep(1)
+                continue
+            if event is not None and self._loop is not None:
+                self._loop.call_soon_threadsafe(self._handle, event)
+
+    def _handle(self, event: Dict[str, Any]) -> None:
+        kind = event.get("type")
+        worker = self._seen(event)
+        if kind == "bye":
+            if worker.alive:
+                self._lose(worker, "stopped")
+            return
+        if kind == "heartbeat":
+            return
+        pending = self._pending.get(event.get("job_id"))
+        if kind == "result":
+            worker.jobs.discard(event.get("job_id"))
+            worker.completed += 1
+            if pending is None or pending.future.done():
+                # A redelivered job finished twice, or its request was cancelled meanwhile.
+                self._counters["duplicates"] += 1
+                return
+            if event.get("ok"):
+                self._counters["completed"] += 1
+                worker_jobs_total.inc(outcome="completed")
+                pending.future.set_result(event)
+            else:
+                self._counters["failed"] += 1
+                worker_jobs_total.inc(outcome="failed")
+                pending.future.set_exception(JobFailedError(event.get("error") or "The job failed on its worker."))
+        elif pending is not None and pending.worker_id == worker.worker_id and pending.on_event is not None:
+            # Progress from the worker currently running the job.
+            pending.on_event(event)
+
+    def _seen(self, event: Dict[str, Any]) -> _Worker:
+        worker_id = event.get("worker", "?")
+        worker = self.workers.get(worker_id)
+        now = time.monotonic()
+        if worker is None:
+            worker = self.workers[worker_id] = _Worker(worker_id, now, alive=False)
+        worker.last_seen = now
+        if event.get("type") == "heartbeat":
+            worker.slots = event.get("slots", worker.slots)
+            worker.host, worker.pid = event.get("host", ""), event.get("pid", 0)
+            worker.llm = event.get("llm", worker.llm)
+            if not worker.alive:
+                worker.alive = True
+                log.info("WORKERS", f"Worker {worker_id} joined", host=worker.host, pid=worker.pid, slots=worker.slots)
+                while self._waiting:
+                    self._assign(self._waiting.popleft())
+        return worker
+
+    async def _watch_workers(self) -> None:
+        while True:
+            await asyncio.sleep(min(WORKER_HEARTBEAT_SECONDS, self.heartbeat_timeout / 2))
+            now = time.monotonic()
+            for worker in list(self.workers.values()):
+                if worker.alive and now - worker.last_seen > self.heartbeat_timeout:
+                    self._lose(worker, f"no heartbeat for {now - worker.last_seen:.0f}s")
+            if self.pool is not None:
+                # A worker whose process exited is known to be lost without waiting for its heartbeat.
+                for worker_id in await asyncio.to_thread(self.pool.check):
+                    worker = self.workers.get(worker_id)
+                    if worker is not None and worker.alive:
+                        self._lose(worker, "process exited")
+
+
+_dispatcher: Optional[JobDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def scale_out_enabled() -> bool:
+    return BOT_WORKERS > 0 or JOB_TRANSPORT != "local"
+
+
+def get_job_dispatcher() -> Optional[JobDispatcher]:
+    """The dispatcher for worker processes, or None when the graph runs in the bot process."""
+    global _dispatcher
+    if not scale_out_enabled():
+        return None
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            if JOB_TRANSPORT == "local":
+                transport = LocalJobTransport(BOT_WORKERS)
+                worker_ids = transport.worker_ids
+            else:
+                # Workers on other machines join through the broker; BOT_WORKERS more run here.
+                transport = load_transport(JOB_TRANSPORT)
+                worker_ids = [f"{socket.gethostname()}-{index}" for index in range(BOT_WORKERS)]
+            _dispatcher = JobDispatcher(transport, WorkerPool(transport, worker_ids) if worker_ids else None)
+        return _dispatcher
+
+
+def set_job_dispatcher(dispatcher: Optional[JobDispatcher]) -> None:
+    """Replaces the shared dispatcher (e.g. with one built by a benchmark)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        _dispatcher = dispatcher
@@ -0,0 +1,182 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import config
+from lang.db.pool import DatabaseUnavailableError, PoolTimeoutError
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+
+class AsyncConnectionPool:
+    """
+    Event-loop-native counterpart of `ConnectionPool`, backed by `aiomysql`.
+
+    `aiomysql` already bounds and recycles connections; this wrapper adds the same
+    checkout timeout, error types and metrics as the threaded pool so the SQL tools
+    can treat both modes identically.
+    """
+
+    def __init__(
+        self,
+        *,
+        min_size: int,
+        max_size: int,
+        checkout_timeout: float,
+        idle_timeout: float,
+        connect_kwargs: Optional[Dict[str, Any]] = None,
+        name: str = "mysql-async",
+    ):
+        self.name = name
+        # aiomysql connection arguments (host, port, user, password, db); defaults to the `DB_*` settings.
+        self.connect_kwargs = connect_kwargs or {
+            "host": config.DB_HOST, "user": config.DB_USER, "password": config.DB_PASSWORD, "db": config.DB_NAME,
+        }
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self._pool: Any = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._create_lock: Optional[asyncio.Lock] = None
+        self._stats = {
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "failed_handshakes": 0,
+            "interrupts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    async def _ensure_pool(self) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._pool is not None and self._loop is loop:
+            return self._pool
+        if self._create_lock is None or self._loop is not loop:
+            # Locks and pools are bound to the loop that created them.
+            self._create_lock = asyncio.Lock()
+            self._pool = None
+            self._loop = loop
+        async with self._create_lock:
+            if self._pool is None:
+                import aiomysql
+
+                log.info("DB_POOL", f"Creating async MySQL pool '{self.name}' (min={self.min_size}, max={self.max_size})")
+                try:
+                    self._pool = await aiomysql.create_pool(
+                        **self.connect_kwargs,
+                        minsize=self.min_size,
+                        maxsize=self.max_size,
+                        pool_recycle=self.idle_timeout,
+                    )
+                except Exception as e:
+                    self._stats["failed_handshakes"] += 1
+                    raise DatabaseUnavailableError(str(e)) from e
+        return self._pool
+
+    @asynccontextmanager
+    async def connection(self, timeout: Optional[float] = None) -> AsyncIterator[Any]:
+        """Checks a connection out for the duration of the block."""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        pool = await self._ensure_pool()
+        started = time.monotonic()
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._stats["checkout_timeouts"] += 1
+            raise PoolTimeoutError(f"Timed out after {timeout:.1f}s waiting for an async connection.")
+        except Exception as e:
+            self._stats["failed_handshakes"] += 1
+            raise DatabaseUnavailableError(str(e)) from e
+
+        waited = time.monotonic() - started
+        self._stats["checkouts"] += 1
+        self._stats["wait_time_total"] += waited
+        self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+        try:
+            yield conn
+        finally:
+            try:
+                await self._reset(conn)
+            finally:
+                pool.release(conn)
+
+    async def _reset(self, conn: Any) -> None:
+        """
+        Rolls back whatever the block left uncommitted, as the threaded pool does on
+        release, so a statement changes the same data in both execution modes.
+        """
+        if conn.closed:
+            return
+        try:
+            await conn.rollback()
+        except Exception as e:
+            # The connection's state is unknown; the driver pool drops closed connections.
+            log.warning("DB_POOL", f"Rollback on release failed, closing the connection: {e}")
+            conn.close()
+        except BaseException:
+            conn.close()
+            raise
+
+    async def interrupt(self, conn: Any) -> None:
+        """
+        Kills the statement running on `conn` over a side connection, then closes `conn`:
+        after a cancelled read its protocol state is unknown, and the driver pool drops
+        closed connections instead of handing them out again.
+        """
+        import aiomysql
+
+        try:
+            side = await aiomysql.connect(**self.connect_kwargs)
+            try:
+                async with side.cursor() as cursor:
+                    await cursor.execute(f"KILL QUERY {int(conn.thread_id())}")
+            finally:
+                side.close()
+            self._stats["interrupts"] += 1
+        except Exception as e:
+            log.error("DB_POOL", f"Failed to interrupt async statement: {e}")
+        finally:
+            conn.close()
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    def metrics(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["name"] = self.name
+        stats["size"] = self._pool.size if self._pool is not None else 0
+        stats["idle"] = self._pool.freesize if self._pool is not None else 0
+        stats["in_use"] = stats["size"] - stats["idle"]
+        stats["max_size"] = self.max_size
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
+
+
+_async_pool: Optional[AsyncConnectionPool] = None
+
+
+def get_async_pool() -> AsyncConnectionPool:
+    """Returns the process-wide async MySQL pool; the driver pool opens lazily on first checkout."""
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = AsyncConnectionPool(
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT,
+            idle_timeout=config.DB_POOL_IDLE_TIMEOUT,
+        )
+    return _async_pool
+
+
+@asynccontextmanager
+async def async_pooled_connection(timeout: Optional[float] = None) -> AsyncIterator[Any]:
+    """Async equivalent of `pooled_connection`."""
+    async with get_async_pool().connection(timeout) as conn:
+        yield conn
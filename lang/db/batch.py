@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Sequence
+
+import config
+from lang.db.cache import get_query_cache, is_read_only
+from lang.db.guard import (
+    QueryGuardError,
+    QueryTimeoutError,
+    await_statement,
+    get_query_guard,
+    statement_tracker,
+    with_max_execution_time,
+)
+from lang.db.sources import current_source
+from lang.state.context import get_thread_id
+from telemetry import get_logger, trace
+
+log = get_logger(__name__)
+
+_WRITE_REJECTED = "Only read-only statements can run in a batch; use `query_database` for writes."
+
+
+@dataclass
+class StatementResult:
+    """
+    Outcome and timing of one statement in a batch.
+
+    `queued` is the time from the start of the batch until the statement got a worker
+    and a connection; `elapsed` is the time it spent executing. The statement
+    finished `queued + elapsed` seconds into the batch.
+    """
+    index: int
+    query: str
+    rows: List[Any] = field(default_factory=list)
+    error: Optional[str] = None
+    queued: float = 0.0
+    elapsed: float = 0.0
+    cached: bool = False
+    timed_out: bool = False
+
+    @property
+    def finished_at(self) -> float:
+        return self.queued + self.elapsed
+
+
+@dataclass
+class BatchResult:
+    statements: List[StatementResult]
+    wall: float
+
+    @property
+    def serial_time(self) -> float:
+        """Execution time the statements would have taken one after another."""
+        return sum(s.elapsed for s in self.statements)
+
+    @property
+    def critical(self) -> Optional[StatementResult]:
+        """The statement that finished last, i.e. the one the batch waited for."""
+        return max(self.statements, key=lambda s: s.finished_at, default=None)
+
+
+def _execute(conn: Any, query: str) -> List[Any]:
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(query)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+async def _aexecute(conn: Any, query: str) -> List[Any]:
+    import aiomysql
+
+    async with conn.cursor(aiomysql.DictCursor) as cursor:
+        await cursor.execute(query)
+        return list(await cursor.fetchall())
+
+
+def _from_cache(result: StatementResult, batch_started: float) -> bool:
+    """Fills `result` from the result cache (or rejects a write); returns True if nothing is left to run."""
+    if not is_read_only(result.query):
+        result.error = _WRITE_REJECTED
+        return True
+    hit, rows = get_query_cache().get_rows(result.query)
+    if hit:
+        result.rows, result.cached = rows, True
+        result.queued = time.perf_counter() - batch_started
+    return hit
+
+
+def _log(result: StatementResult) -> None:
+    status = "cached" if result.cached else ("timed out" if result.timed_out else ("failed" if result.error else f"{len(result.rows)} row(s)"))
+    log.debug(
+        "SQL_BATCH",
+        f"#{result.index + 1} {status}: queued {result.queued * 1000:.0f} ms, ran {result.elapsed * 1000:.0f} ms",
+    )
+
+
+# --- Thread Mode ---
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=config.QUERY_BATCH_MAX_PARALLEL, thread_name_prefix="sql-batch")
+    return _executor
+
+
+def _run_statement(
+    index: int, query: str, timeout: float, batch_started: float, thread_id: Optional[str]
+) -> StatementResult:
+    result = StatementResult(index, query)
+    if _from_cache(result, batch_started):
+        return result
+    try:
+        statement = get_query_guard().check(query, bounded=True)
+        with current_source().checkout(read_only=True, thread_id=thread_id) as (pool, conn):
+            result.queued = time.perf_counter() - batch_started
+            started = time.perf_counter()
+            try:
+                with trace("db.query", source=current_source().name, batch=True), \
+                        statement_tracker.track(pool, conn, thread_id, timeout):
+                    result.rows = _execute(conn, with_max_execution_time(statement, timeout))
+            finally:
+                result.elapsed = time.perf_counter() - started
+        get_query_cache().put_rows(query, result.rows)
+    except QueryGuardError as e:
+        result.timed_out = isinstance(e, QueryTimeoutError)
+        result.error = str(e)
+    except Exception as e:
+        result.error = str(e)
+    return result
+
+
+def run_batch(queries: Sequence[str], timeout: Optional[float] = None, thread_id: Optional[str] = None) -> BatchResult:
+    """
+    Runs independent read-only statements concurrently on pooled connections.
+
+    At most `QUERY_BATCH_MAX_PARALLEL` statements run at once. Each statement passes
+    the query guard first; one that runs longer than `timeout` seconds (default
+    `QUERY_BATCH_TIMEOUT`) is killed on the server, as is every statement of
+    `thread_id` when its request is cancelled. Failures are reported per statement
+    and never abort the others.
+    """
+    timeout = config.QUERY_BATCH_TIMEOUT if timeout is None else timeout
+    started = time.perf_counter()
+    # Each worker runs in a copy of the caller's context, so it sees the request's data source.
+    futures = [
+        _get_executor().submit(contextvars.copy_context().run, _run_statement, i, q, timeout, started, thread_id)
+        for i, q in enumerate(queries)
+    ]
+    results = [future.result() for future in futures]
+    for result in results:
+        _log(result)
+    return BatchResult(results, time.perf_counter() - started)
+
+
+# --- Async Mode ---
+
+async def _arun_statement(
+    index: int, query: str, timeout: float, batch_started: float, slots: asyncio.Semaphore
+) -> StatementResult:
+    source = current_source()
+    if not source.supports_async:
+        async with slots:
+            return await asyncio.to_thread(_run_statement, index, query, timeout, batch_started, get_thread_id())
+    result = StatementResult(index, query)
+    if _from_cache(result, batch_started):
+        return result
+    try:
+        statement = await get_query_guard().acheck(query, bounded=True)
+        async with slots, source.acheckout(read_only=True) as (pool, conn):
+            result.queued = time.perf_counter() - batch_started
+            started = time.perf_counter()
+            try:
+                # Timing out, or cancelling the whole request, kills the statement on the server too.
+                with trace("db.query", source=source.name, batch=True):
+                    result.rows = await await_statement(pool, conn, _aexecute(conn, with_max_execution_time(statement, timeout)), timeout)
+            finally:
+                result.elapsed = time.perf_counter() - started
+        get_query_cache().put_rows(query, result.rows)
+    except QueryGuardError as e:
+        result.timed_out = isinstance(e, QueryTimeoutError)
+        result.error = str(e)
+    except Exception as e:
+        result.error = str(e)
+    return result
+
+
+async def arun_batch(queries: Sequence[str], timeout: Optional[float] = None) -> BatchResult:
+    """
+    Async equivalent of `run_batch`. Cancelling the caller cancels every statement
+    still running and kills it on the server.
+    """
+    timeout = config.QUERY_BATCH_TIMEOUT if timeout is None else timeout
+    slots = asyncio.Semaphore(config.QUERY_BATCH_MAX_PARALLEL)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_arun_statement(i, q, timeout, started, slots) for i, q in enumerate(queries)))
+    for result in results:
+        _log(result)
+    return BatchResult(list(results), time.perf_counter() - started)
@@ -0,0 +1,274 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import config
+from lang.db.sources import current_source
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by entry count and approximate size, with per-entry
+    TTLs and tags for group invalidation (e.g. every entry that read table `orders`).
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 0, name: str = "cache"):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes  # 0 disables the size bound.
+        self._lock = threading.Lock()
+        # key -> (value, expires_at, size, tags)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float, int, Set[str]]]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Returns `(True, value)` on a hit and `(False, None)` on a miss or expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return False, None
+            value, expires_at, _, _ = entry
+            if expires_at and expires_at < time.monotonic():
+                self._remove_locked(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return True, value
+
+    def set(self, key: Hashable, value: Any, ttl: float = 0, size: int = 1, tags: Iterable[str] = ()) -> None:
+        """Stores a value; `ttl` of 0 means it never expires on its own."""
+        if self.max_bytes and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + ttl if ttl else 0.0
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = (value, expires_at, size, set(tags))
+            self._bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+                self._stats["invalidations"] += 1
+
+    def invalidate_tags(self, tags: Iterable[str]) -> int:
+        """Removes every entry carrying any of `tags`; returns how many were removed."""
+        tags = set(tags)
+        with self._lock:
+            doomed = [key for key, entry in self._entries.items() if entry[3] & tags]
+            for key in doomed:
+                self._remove_locked(key)
+            self._stats["invalidations"] += len(doomed)
+            return len(doomed)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"name": self.name, "entries": len(self._entries), "bytes": self._bytes})
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _remove_locked(self, key: Hashable) -> None:
+        _, _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+# --- Normalization Helpers ---
+
+# Quoted literals are matched first so comment markers and whitespace inside them survive.
+_SQL_TOKEN_RE = re.compile(
+    r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)"
+    r"|(--[^\n]*|#[^\n]*|/\*.*?\*/)"
+    r"|(\s+)",
+    re.DOTALL,
+)
+_TABLE_RE = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+((?:`[^`]+`|\w+)(?:\.(?:`[^`]+`|\w+))?)", re.IGNORECASE)
+_READ_ONLY_RE = re.compile(r"^\s*(SELECT|SHOW|DESCRIBE|DESC|EXPLAIN|WITH)\b", re.IGNORECASE)
+_QUESTION_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+# A LIMIT clause at the very end of a statement: LIMIT n | LIMIT m, n | LIMIT n OFFSET m.
+_TRAILING_LIMIT_RE = re.compile(r"\bLIMIT\s+(\d+)(?:\s*,\s*(\d+)|\s+OFFSET\s+(\d+))?\s*$", re.IGNORECASE)
+
+
+def normalize_question(question: str) -> str:
+    """Lower-cases, drops punctuation and collapses whitespace: 'Top 10 customers?' -> 'top 10 customers'."""
+    return " ".join(_QUESTION_PUNCTUATION_RE.sub(" ", question.lower()).split())
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Canonical form of a statement for cache keys: comments removed, runs of
+    whitespace outside quoted literals collapsed, trailing semicolons dropped.
+    Identifiers keep their case because MySQL table names can be case-sensitive.
+    """
+    normalized = _SQL_TOKEN_RE.sub(lambda m: m.group(1) or " ", query)
+    return normalized.strip().rstrip(";").strip()
+
+
+def limit_statement(query: str, limit: int, offset: int = 0) -> str:
+    """
+    Restricts a statement to `limit` rows starting at `offset`. A LIMIT the statement
+    already ends with is combined with the window rather than wrapped in a derived
+    table, which MySQL refuses for joins selecting two columns with the same name.
+    """
+    sql = normalize_sql(query)
+    match = _TRAILING_LIMIT_RE.search(sql)
+    if match is None:
+        return f"{sql} LIMIT {offset}, {limit}"
+    if match.group(2) is not None:
+        own_offset, own_limit = int(match.group(1)), int(match.group(2))
+    else:
+        own_offset, own_limit = int(match.group(3) or 0), int(match.group(1))
+    limit = max(0, min(limit, own_limit - offset))
+    return f"{sql[:match.start()].rstrip()} LIMIT {own_offset + offset}, {limit}"
+
+
+def extract_tables(query: str) -> Set[str]:
+    """Best-effort set of (lower-cased, unqualified) table names a statement touches."""
+    names = set()
+    for match in _TABLE_RE.finditer(normalize_sql(query)):
+        name = match.group(1).split(".")[-1].strip("`")
+        names.add(name.lower())
+    return names
+
+
+def is_read_only(query: str) -> bool:
+    return bool(_READ_ONLY_RE.match(normalize_sql(query)))
+
+
+def _approximate_size(rows: List[Any]) -> int:
+    size = 0
+    for row in rows:
+        values = row.values() if isinstance(row, dict) else row
+        size += sum(len(str(v)) for v in values) + 16
+    return size
+
+
+def _parse_table_ttls(spec: str) -> Dict[str, float]:
+    """Parses `"orders=10,products=3600"` into `{"orders": 10.0, "products": 3600.0}`."""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        table, _, seconds = item.partition("=")
+        ttls[table.strip().lower()] = float(seconds)
+    return ttls
+
+
+class QueryCache:
+    """
+    Two-level cache in front of the SQL tools.
+
+    Level 1 maps a normalized natural-language question (plus the schema version)
+    to the SQL the agent generated for it, so repeated questions skip the LLM.
+    Level 2 maps normalized SQL text to result rows, with a TTL taken from the
+    shortest-lived table the query reads. Both levels are tagged by table so a
+    write to `orders` drops every question and result that depends on it.
+
+    Keys of both levels include the current request's data source, so the same
+    question or SQL asked of two databases never shares an entry.
+    """
+
+    def __init__(
+        self,
+        max_questions: int = 1024,
+        max_results: int = 512,
+        max_result_bytes: int = 64 * 1024 * 1024,
+        default_ttl: float = 60.0,
+        table_ttls: Optional[Dict[str, float]] = None,
+    ):
+        self.questions = LRUCache(max_entries=max_questions, name="question_to_sql")
+        self.results = LRUCache(max_entries=max_results, max_bytes=max_result_bytes, name="sql_to_rows")
+        self.default_ttl = default_ttl
+        self.table_ttls = table_ttls or {}
+
+    # --- Level 1: question -> SQL ---
+
+    def get_sql(self, question: str, schema_version: int) -> Optional[str]:
+        hit, sql = self.questions.get((current_source().name, schema_version, normalize_question(question)))
+        return sql if hit else None
+
+    def put_sql(self, question: str, schema_version: int, sql: str) -> None:
+        self.questions.set(
+            (current_source().name, schema_version, normalize_question(question)),
+            sql,
+            ttl=self._ttl_for(sql),
+            tags=extract_tables(sql),
+        )
+
+    # --- Level 2: SQL -> rows ---
+
+    def get_rows(self, query: str) -> Tuple[bool, Optional[List[Any]]]:
+        return self.results.get((current_source().name, normalize_sql(query)))
+
+    def put_rows(self, query: str, rows: List[Any]) -> None:
+        self.results.set(
+            (current_source().name, normalize_sql(query)),
+            rows,
+            ttl=self._ttl_for(query),
+            size=_approximate_size(rows),
+            tags=extract_tables(query),
+        )
+
+    # --- Invalidation & Stats ---
+
+    def invalidate_tables(self, tables: Iterable[str]) -> None:
+        tables = {t.lower() for t in tables}
+        if not tables:
+            return
+        dropped = self.questions.invalidate_tags(tables) + self.results.invalidate_tags(tables)
+        log.info("QUERY_CACHE", f"Invalidated {dropped} entries for tables: {', '.join(sorted(tables))}")
+
+    def clear(self) -> None:
+        self.questions.clear()
+        self.results.clear()
+        log.info("QUERY_CACHE", "Cleared all entries.")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {"questions": self.questions.stats(), "results": self.results.stats()}
+
+    def _ttl_for(self, query: str) -> float:
+        ttls = [self.table_ttls.get(table, self.default_ttl) for table in extract_tables(query)]
+        return min(ttls) if ttls else self.default_ttl
+
+
+# --- Shared Cache ---
+
+_query_cache: Optional[QueryCache] = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryCache:
+    """Returns the process-wide query cache, creating it on first use."""
+    global _query_cache
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                _query_cache = QueryCache(
+                    max_questions=config.QUERY_CACHE_MAX_QUESTIONS,
+                    max_results=config.QUERY_CACHE_MAX_RESULTS,
+                    max_result_bytes=config.QUERY_CACHE_MAX_RESULT_BYTES,
+                    default_ttl=config.QUERY_CACHE_TTL,
+                    table_ttls=_parse_table_ttls(config.QUERY_CACHE_TABLE_TTLS),
+                )
+    return _query_cache
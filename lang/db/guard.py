@@ -0,0 +1,455 @@
+import asyncio
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, Set
+
+import config
+from lang.db.async_pool import AsyncConnectionPool
+from lang.db.cache import LRUCache, limit_statement, normalize_sql
+from lang.db.pool import ConnectionPool, DatabaseUnavailableError
+from lang.db.sources import current_source
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+
+class QueryGuardError(Exception):
+    """Base class for statements the guardrails stopped; the message is shown to the agent."""
+
+
+class QueryRejectedError(QueryGuardError):
+    """Raised before execution when a statement is not allowed or is estimated to be too expensive."""
+
+
+class QueryTimeoutError(QueryGuardError):
+    """Raised when a statement was killed for running past its timeout."""
+
+
+class QueryCancelledError(QueryGuardError):
+    """Raised when a statement was killed because its Discord request was cancelled."""
+
+
+# --- Statement Classification ---
+
+READ = "read"
+WRITE = "write"
+DDL = "ddl"
+OTHER = "other"
+
+_LEADING_KEYWORD_RE = re.compile(r"^\s*\(?\s*(\w+)")
+_KINDS = {
+    "select": READ, "with": READ, "show": READ, "describe": READ, "desc": READ, "explain": READ,
+    "insert": WRITE, "update": WRITE, "delete": WRITE, "replace": WRITE, "load": WRITE,
+    "create": DDL, "alter": DDL, "drop": DDL, "rename": DDL, "truncate": DDL,
+}
+# A WITH clause can lead into a write in MySQL 8; SELECT ... INTO OUTFILE writes to the server.
+_EMBEDDED_WRITE_RE = re.compile(r"\b(?:UPDATE\s+\S+\s+SET|DELETE\s+FROM|INSERT\s+INTO|INTO\s+(?:OUTFILE|DUMPFILE))\b", re.IGNORECASE)
+_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`")
+# Statement types MySQL can EXPLAIN.
+_EXPLAINABLE = {"select", "with", "insert", "update", "delete", "replace"}
+# Constructs that make the server read every input row before returning the first one,
+# so a LIMIT does not bound the work. Aggregates count only as calls, so a column named
+# `count` or `max` does not; match on the statement with its literals removed.
+_AGGREGATE_RE = re.compile(
+    r"\b(?:GROUP\s+BY|ORDER\s+BY|DISTINCT|UNION|HAVING)\b"
+    r"|\b(?:OVER|COUNT|SUM|AVG|MIN|MAX|GROUP_CONCAT|STDDEV|VARIANCE)\s*\(",
+    re.IGNORECASE,
+)
+_HINTABLE_SELECT_RE = re.compile(r"^(\s*SELECT)\b(?!\s*/\*\+)", re.IGNORECASE)
+# MySQL error 3024: "maximum statement execution time exceeded".
+_SERVER_TIMEOUT_ERRNO = 3024
+
+
+def _unquoted(sql: str) -> str:
+    return _LITERAL_RE.sub("''", sql)
+
+
+def classify_statement(query: str) -> str:
+    """Returns READ, WRITE, DDL or OTHER (SET, CALL, GRANT, ...) for a single statement."""
+    sql = normalize_sql(query)
+    match = _LEADING_KEYWORD_RE.match(sql)
+    kind = _KINDS.get(match.group(1).lower(), OTHER) if match else OTHER
+    if kind == READ and _EMBEDDED_WRITE_RE.search(_unquoted(sql)):
+        return WRITE
+    return kind
+
+
+def with_max_execution_time(query: str, timeout: float) -> str:
+    """
+    Adds a `MAX_EXECUTION_TIME` optimizer hint to a top-level SELECT so the server
+    aborts it on its own. Other statements are returned unchanged; they are bounded
+    by the client-side watchdog instead.
+    """
+    return _HINTABLE_SELECT_RE.sub(lambda m: f"{m.group(1)} /*+ MAX_EXECUTION_TIME({int(timeout * 1000)}) */", query, count=1)
+
+
+def _is_server_timeout(error: BaseException) -> bool:
+    errno = getattr(error, "errno", None)
+    if errno is None and getattr(error, "args", None):
+        errno = error.args[0]
+    return errno == _SERVER_TIMEOUT_ERRNO
+
+
+# --- Plan Estimation ---
+
+@dataclass
+class PlanEstimate:
+    """What `EXPLAIN` says a statement will cost."""
+    examined_rows: int
+    full_scans: List[str] = field(default_factory=list)
+    # The server must read all input (sort, temporary table, aggregate) before returning rows.
+    materializes: bool = False
+
+
+def estimate_plan(plan: List[Dict[str, Any]], query: str) -> PlanEstimate:
+    """
+    Estimates rows examined from traditional `EXPLAIN` output. Within one SELECT the
+    tables form a nested loop: each table is read once per row that survived the
+    tables before it (`rows * filtered%`). Independent SELECTs (subqueries, unions)
+    add up.
+    """
+    per_select: Dict[Any, List[float]] = {}
+    full_scans = []
+    materializes = bool(_AGGREGATE_RE.search(_unquoted(normalize_sql(query))))
+    for row in plan:
+        rows = float(row.get("rows") or 1)
+        filtered = float(row.get("filtered") or 100) / 100
+        total, fanout = per_select.setdefault(row.get("id"), [0.0, 1.0])
+        per_select[row.get("id")] = [total + fanout * rows, fanout * max(rows * filtered, 1.0)]
+        if str(row.get("type") or "").upper() == "ALL" and row.get("table"):
+            full_scans.append(str(row["table"]))
+        extra = str(row.get("Extra") or "")
+        if "Using temporary" in extra or "Using filesort" in extra:
+            materializes = True
+    return PlanEstimate(int(sum(total for total, _ in per_select.values())), full_scans, materializes)
+
+
+# --- Guard ---
+
+class QueryGuard:
+    """
+    Pre-execution analysis for SQL the agent emits.
+
+    Statements are classified as read-only or mutating (multi-statement input is
+    always refused, writes and DDL are refused in read-only mode), then `EXPLAIN`ed.
+    A statement estimated to examine more than `max_examined_rows` rows is:
+
+    - allowed when the caller already bounds it with a LIMIT and the plan streams
+      (no sort, temporary table or aggregate), since the server stops early;
+    - rewritten with `LIMIT rewrite_limit` when it streams but is unbounded (exports);
+    - rejected otherwise, with a reason the agent can act on.
+
+    Plans are cached by normalized SQL for `plan_cache_ttl` seconds. If `EXPLAIN`
+    itself fails the statement is allowed and runs under its timeout as usual.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = True,
+        read_only: bool = False,
+        max_examined_rows: int = 50_000_000,
+        rewrite_limit: int = 100_000,
+        plan_cache_ttl: float = 300.0,
+    ):
+        self.enabled = enabled
+        self.read_only = read_only
+        self.max_examined_rows = max_examined_rows
+        self.rewrite_limit = rewrite_limit
+        self.plan_cache_ttl = plan_cache_ttl
+        self._plans = LRUCache(max_entries=1024, name="query_plans")
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Any] = {
+            "checked": 0,
+            "allowed": 0,
+            "rewritten": 0,
+            "rejected": 0,
+            "explained": 0,
+            "explain_failures": 0,
+            "explain_time_total": 0.0,
+            "estimated_rows_max": 0,
+            "rejections": {},
+        }
+
+    # --- Public API ---
+
+    def check(self, query: str, *, bounded: bool) -> str:
+        """
+        Returns the statement to run (possibly rewritten) or raises `QueryRejectedError`.
+        `bounded` tells the guard the caller caps the rows it reads with a LIMIT.
+        """
+        kind = self._precheck(query)
+        if kind is None:
+            return query
+        hit, estimate = self._plans.get(_plan_key(query))
+        if not hit:
+            estimate = self._explain(query)
+        return self._decide(query, kind, estimate, bounded)
+
+    async def acheck(self, query: str, *, bounded: bool) -> str:
+        """Async equivalent of `check`."""
+        kind = self._precheck(query)
+        if kind is None:
+            return query
+        hit, estimate = self._plans.get(_plan_key(query))
+        if not hit:
+            estimate = await self._aexplain(query)
+        return self._decide(query, kind, estimate, bounded)
+
+    def clear_plans(self) -> None:
+        """Forgets cached plans, e.g. after DDL changed tables or indexes."""
+        self._plans.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["rejections"] = dict(self._stats["rejections"])
+        stats["explain_time_avg"] = stats["explain_time_total"] / stats["explained"] if stats["explained"] else 0.0
+        stats["plan_cache"] = self._plans.stats()
+        return stats
+
+    # --- Internal Helpers ---
+
+    def _precheck(self, query: str) -> Optional[str]:
+        """Classifies the statement and applies the static rules; returns None when no plan is needed."""
+        if not self.enabled:
+            return None
+        sql = normalize_sql(query)
+        with self._lock:
+            self._stats["checked"] += 1
+        if ";" in _unquoted(sql):
+            self._reject("multiple_statements", "Send one SQL statement at a time.")
+        kind = classify_statement(sql)
+        if self.read_only and kind != READ:
+            self._reject("read_only", "The database is read-only for this bot; only SELECT, SHOW and DESCRIBE statements are allowed.")
+        match = _LEADING_KEYWORD_RE.match(sql)
+        if not match or match.group(1).lower() not in _EXPLAINABLE:
+            self._count("allowed")
+            return None
+        return kind
+
+    def _explain(self, query: str) -> Optional[PlanEstimate]:
+        source = current_source()
+        if source.driver != "mysql":
+            # Only MySQL's EXPLAIN output is understood; stand-ins run under their timeouts.
+            return None
+        started = time.perf_counter()
+        try:
+            # The plan is the same on every replica, so EXPLAIN takes a read connection.
+            with source.checkout(read_only=True) as (_, conn):
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    cursor.execute(f"EXPLAIN {normalize_sql(query)}")
+                    plan = cursor.fetchall()
+                finally:
+                    cursor.close()
+        except DatabaseUnavailableError:
+            raise
+        except Exception as e:
+            return self._explain_failed(e)
+        return self._remember(query, plan, time.perf_counter() - started)
+
+    async def _aexplain(self, query: str) -> Optional[PlanEstimate]:
+        source = current_source()
+        if not source.supports_async:
+            return await asyncio.to_thread(self._explain, query)
+        import aiomysql
+
+        started = time.perf_counter()
+        try:
+            async with source.acheckout(read_only=True) as (_, conn):
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute(f"EXPLAIN {normalize_sql(query)}")
+                    plan = list(await cursor.fetchall())
+        except DatabaseUnavailableError:
+            raise
+        except Exception as e:
+            return self._explain_failed(e)
+        return self._remember(query, plan, time.perf_counter() - started)
+
+    def _explain_failed(self, error: Exception) -> None:
+        log.warning("QUERY_GUARD", f"EXPLAIN failed, running the statement unchecked: {error}")
+        with self._lock:
+            self._stats["explain_failures"] += 1
+        return None
+
+    def _remember(self, query: str, plan: List[Dict[str, Any]], elapsed: float) -> PlanEstimate:
+        estimate = estimate_plan(plan, query)
+        self._plans.set(_plan_key(query), estimate, ttl=self.plan_cache_ttl)
+        with self._lock:
+            self._stats["explained"] += 1
+            self._stats["explain_time_total"] += elapsed
+            self._stats["estimated_rows_max"] = max(self._stats["estimated_rows_max"], estimate.examined_rows)
+        return estimate
+
+    def _decide(self, query: str, kind: str, estimate: Optional[PlanEstimate], bounded: bool) -> str:
+        if estimate is None or estimate.examined_rows <= self.max_examined_rows:
+            self._count("allowed", estimate)
+            return query
+        scans = f" (full scans: {', '.join(estimate.full_scans)})" if estimate.full_scans else ""
+        cost = f"an estimated {estimate.examined_rows:,} rows examined{scans}, over the {self.max_examined_rows:,} row budget"
+        if kind == READ and not estimate.materializes:
+            if bounded:
+                self._count("allowed", estimate)
+                return query
+            self._count("rewritten", estimate)
+            log.info("QUERY_GUARD", f"Limiting statement to {self.rewrite_limit:,} rows: {cost}")
+            return limit_statement(query, self.rewrite_limit)
+        self._reject(
+            "over_budget",
+            f"Query rejected: {cost}. Filter on indexed columns, join on keys, or aggregate a smaller range.",
+        )
+
+    def _count(self, action: str, estimate: Optional[PlanEstimate] = None) -> None:
+        with self._lock:
+            self._stats[action] += 1
+        if estimate is not None:
+            log.info("QUERY_GUARD", f"{action}: estimated {estimate.examined_rows:,} rows examined")
+
+    def _reject(self, reason: str, message: str) -> None:
+        with self._lock:
+            self._stats["rejected"] += 1
+            self._stats["rejections"][reason] = self._stats["rejections"].get(reason, 0) + 1
+        log.info("QUERY_GUARD", f"Rejected ({reason}): {message}")
+        raise QueryRejectedError(message)
+
+
+def _plan_key(query: str) -> Any:
+    # The same SQL can have very different plans on different databases.
+    return current_source().name, normalize_sql(query)
+
+
+_guard: Optional[QueryGuard] = None
+_guard_lock = threading.Lock()
+
+
+def get_query_guard() -> QueryGuard:
+    """Returns the process-wide query guard, built from the configuration on first use."""
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                _guard = QueryGuard(
+                    enabled=config.QUERY_GUARD_ENABLED,
+                    read_only=config.QUERY_GUARD_READ_ONLY,
+                    max_examined_rows=config.QUERY_GUARD_MAX_EXAMINED_ROWS,
+                    rewrite_limit=config.QUERY_GUARD_REWRITE_LIMIT,
+                    plan_cache_ttl=config.QUERY_GUARD_PLAN_CACHE_TTL,
+                )
+    return _guard
+
+
+# --- Timeouts & Cancellation ---
+
+class _Watchdog:
+    """Interrupts the statement on a pooled connection after `timeout` seconds or when cancelled."""
+
+    def __init__(self, pool: ConnectionPool, conn: Any, timeout: float):
+        self._pool = pool
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._done = False
+        self.reason: Optional[str] = None
+        self._timer = threading.Timer(timeout, self.kill, args=("timeout",))
+        self._timer.daemon = True
+
+    def start(self) -> None:
+        self._timer.start()
+
+    def finish(self) -> None:
+        # Waits for an interrupt in flight, so it never lands after the connection is released.
+        with self._lock:
+            self._done = True
+            self._timer.cancel()
+
+    def kill(self, reason: str) -> None:
+        with self._lock:
+            if self._done or self.reason:
+                return
+            self.reason = reason
+            self._pool.interrupt(self._conn)
+
+
+class StatementTracker:
+    """
+    Tracks the statements running for each Discord thread in thread mode, so a
+    statement can be killed when it exceeds its timeout or when its request is
+    cancelled (`!cancel`). Async mode needs no registry: cancelling the request's
+    task cancels the awaiting statement, which kills itself (see `await_statement`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running: Dict[Optional[str], Set[_Watchdog]] = {}
+        self._cancelled: Set[str] = set()
+
+    @contextmanager
+    def track(self, pool: ConnectionPool, conn: Any, thread_id: Optional[str], timeout: float) -> Iterator[None]:
+        """Runs the block as a tracked statement, translating kills into `QueryGuardError`s."""
+        watchdog = _Watchdog(pool, conn, timeout)
+        with self._lock:
+            if thread_id is not None and thread_id in self._cancelled:
+                raise QueryCancelledError("The request was cancelled.")
+            self._running.setdefault(thread_id, set()).add(watchdog)
+        watchdog.start()
+        try:
+            yield
+        except Exception as e:
+            if watchdog.reason == "cancelled":
+                raise QueryCancelledError("The query was stopped because the request was cancelled.") from e
+            if watchdog.reason == "timeout" or _is_server_timeout(e):
+                raise QueryTimeoutError(_timeout_message(timeout)) from e
+            raise
+        finally:
+            watchdog.finish()
+            with self._lock:
+                running = self._running.get(thread_id)
+                if running is not None:
+                    running.discard(watchdog)
+                    if not running:
+                        del self._running[thread_id]
+
+    def cancel_thread(self, thread_id: str) -> int:
+        """Kills every statement running for a thread and refuses new ones until `reset`; returns how many were killed."""
+        with self._lock:
+            self._cancelled.add(thread_id)
+            running = list(self._running.get(thread_id, ()))
+        for watchdog in running:
+            watchdog.kill("cancelled")
+        if running:
+            log.info("QUERY_GUARD", f"Killed {len(running)} running statement(s) for cancelled thread {thread_id}")
+        return len(running)
+
+    def reset(self, thread_id: str) -> None:
+        """Allows statements for a thread again; called when a new request starts."""
+        with self._lock:
+            self._cancelled.discard(thread_id)
+
+
+def _timeout_message(timeout: float) -> str:
+    return f"The query was stopped after exceeding the {timeout:g}s time limit. Narrow it with filters on indexed columns."
+
+
+async def await_statement(pool: AsyncConnectionPool, conn: Any, statement: Awaitable[Any], timeout: float) -> Any:
+    """
+    Awaits a statement running on a connection of `pool` with a timeout. On timeout or
+    cancellation of the request, the statement is killed on the server as well.
+    """
+    try:
+        return await asyncio.wait_for(statement, timeout)
+    except asyncio.TimeoutError:
+        await pool.interrupt(conn)
+        raise QueryTimeoutError(_timeout_message(timeout))
+    except asyncio.CancelledError:
+        await pool.interrupt(conn)
+        raise
+    except Exception as e:
+        if _is_server_timeout(e):
+            raise QueryTimeoutError(_timeout_message(timeout)) from e
+        raise
+
+
+statement_tracker = StatementTracker()
@@ -0,0 +1,394 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+import config
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+
+class DatabaseUnavailableError(Exception):
+    """Raised when a connection cannot be handed out (handshake failure or checkout timeout)."""
+
+
+class PoolTimeoutError(DatabaseUnavailableError):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+class _PooledConnection:
+    """Book-keeping wrapper around a raw DB-API connection held by the pool."""
+
+    __slots__ = ("raw", "created_at", "last_used", "last_checked")
+
+    def __init__(self, raw: Any):
+        now = time.monotonic()
+        self.raw = raw
+        self.created_at = now
+        self.last_used = now
+        self.last_checked = now
+
+
+def _default_ping(conn: Any) -> None:
+    """Checks that a connection is still usable, raising if it is not."""
+    if hasattr(conn, "ping"):
+        # mysql.connector: raises InterfaceError when the server has gone away.
+        conn.ping(reconnect=False)
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _default_reset(conn: Any) -> None:
+    """Returns a connection to a clean state before it is handed out again."""
+    conn.rollback()
+
+
+def _default_interrupt(conn: Any, connect: Callable[[], Any]) -> None:
+    """Aborts the statement currently running on `conn`, leaving the connection usable."""
+    if hasattr(conn, "interrupt"):
+        # sqlite3: may be called from any thread.
+        conn.interrupt()
+        return
+    # mysql.connector: `conn` is blocked reading the result, so the server is told to
+    # kill the statement over a short-lived side connection.
+    side = connect()
+    try:
+        cursor = side.cursor()
+        try:
+            cursor.execute(f"KILL QUERY {int(conn.connection_id)}")
+        finally:
+            cursor.close()
+    finally:
+        _safe_close(side)
+
+
+def _safe_close(conn: Any) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    """
+    A thread-safe, size-bounded pool of DB-API connections.
+
+    The pool is driver-agnostic: it only needs a zero-argument `connect` callable,
+    so it works with `mysql.connector` in production and `sqlite3` as a local
+    stand-in. Connections are handed out LIFO so a small hot set stays warm while
+    the rest age out through idle eviction.
+
+    Args:
+        connect: Factory that opens a new raw connection.
+        min_size: Connections kept open even when idle.
+        max_size: Hard cap on open connections (in use + idle).
+        checkout_timeout: Seconds to wait for a free connection before failing.
+        idle_timeout: Seconds an idle connection may sit before it is closed.
+        health_check_interval: Idle connections older than this are pinged before reuse.
+        ping: Callable that raises if a connection is dead.
+        reset: Callable run on release to discard uncommitted state.
+        interrupt: Callable `(conn, connect)` that aborts the statement running on `conn`.
+        name: Label used in logs and metrics.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        *,
+        min_size: int = 1,
+        max_size: int = 10,
+        checkout_timeout: float = 10.0,
+        idle_timeout: float = 300.0,
+        health_check_interval: float = 30.0,
+        ping: Callable[[Any], None] = _default_ping,
+        reset: Callable[[Any], None] = _default_reset,
+        interrupt: Callable[[Any, Callable[[], Any]], None] = _default_interrupt,
+        name: str = "default",
+    ):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        if min_size < 0 or min_size > max_size:
+            raise ValueError("min_size must be between 0 and max_size.")
+
+        self.name = name
+        self._connect = connect
+        self._ping = ping
+        self._reset = reset
+        self._interrupt = interrupt
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle: Deque[_PooledConnection] = deque()
+        self._in_use: Dict[int, _PooledConnection] = {}
+        self._size = 0  # Open connections plus connections currently being opened.
+        self._closed = False
+
+        self._stats = {
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "failed_handshakes": 0,
+            "health_check_failures": 0,
+            "idle_evictions": 0,
+            "interrupts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    # --- Checkout / Release ---
+
+    def acquire(self, timeout: Optional[float] = None) -> Any:
+        """
+        Checks out a connection, opening a new one if the pool is below `max_size`.
+
+        Raises:
+            PoolTimeoutError: If no connection is free within `timeout` seconds.
+            DatabaseUnavailableError: If opening a new connection fails.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            entry = None
+            with self._available:
+                if self._closed:
+                    raise DatabaseUnavailableError(f"Connection pool '{self.name}' is closed.")
+                self._evict_idle_locked()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["checkout_timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"Timed out after {timeout:.1f}s waiting for a connection from pool '{self.name}'."
+                        )
+                    self._available.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    # Reserve a slot, then open the connection outside the lock.
+                    self._size += 1
+
+            if entry is None:
+                entry = self._open_reserved()
+            elif not self._is_healthy(entry):
+                self._discard(entry)
+                continue
+
+            waited = time.monotonic() - started
+            with self._lock:
+                entry.last_used = time.monotonic()
+                self._in_use[id(entry.raw)] = entry
+                self._stats["checkouts"] += 1
+                self._stats["wait_time_total"] += waited
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+            return entry.raw
+
+    def release(self, conn: Any, discard: bool = False) -> None:
+        """Returns a connection to the pool, or closes it when `discard` is set or it cannot be reset."""
+        with self._lock:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            return
+
+        if not discard:
+            try:
+                self._reset(conn)
+            except Exception as e:
+                log.warning("DB_POOL", f"Dropping connection that failed to reset: {e}")
+                discard = True
+
+        if discard or self._closed:
+            self._discard(entry)
+            return
+
+        with self._available:
+            entry.last_used = time.monotonic()
+            self._idle.append(entry)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Any]:
+        """Context manager that checks a connection out and always returns it."""
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            # A failed statement may leave the session mid-transaction; the reset on
+            # release decides whether the connection is still reusable.
+            self.release(conn)
+
+    def interrupt(self, conn: Any) -> bool:
+        """
+        Aborts the statement running on a checked-out connection (e.g. when it exceeds
+        its timeout). The side connection a driver may need is opened outside the size
+        cap, so this works even when every pooled connection is busy. Returns whether
+        the interrupt was delivered.
+        """
+        try:
+            self._interrupt(conn, self._connect)
+        except Exception as e:
+            log.error("DB_POOL", f"Failed to interrupt statement on pool '{self.name}': {e}")
+            return False
+        with self._lock:
+            self._stats["interrupts"] += 1
+        return True
+
+    # --- Lifecycle ---
+
+    def warm(self) -> None:
+        """Opens connections until `min_size` are available."""
+        while True:
+            with self._lock:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            entry = self._open_reserved()
+            with self._available:
+                self._idle.append(entry)
+                self._available.notify()
+
+    def close(self) -> None:
+        """Closes idle connections and refuses further checkouts; in-use connections close on release."""
+        with self._available:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._available.notify_all()
+        for entry in idle:
+            self._discard(entry)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Returns a snapshot of pool counters and gauges."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "name": self.name,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "max_size": self.max_size,
+            })
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
+
+    # --- Internal Helpers ---
+
+    def _open_reserved(self) -> _PooledConnection:
+        """Opens a connection for a slot already counted in `_size`."""
+        try:
+            raw = self._connect()
+        except Exception as e:
+            with self._available:
+                self._size -= 1
+                self._stats["failed_handshakes"] += 1
+                self._available.notify()
+            log.error("DB_POOL", f"Failed to open connection for pool '{self.name}': {e}")
+            raise DatabaseUnavailableError(str(e)) from e
+        with self._lock:
+            self._stats["connections_created"] += 1
+        return _PooledConnection(raw)
+
+    def _is_healthy(self, entry: _PooledConnection) -> bool:
+        now = time.monotonic()
+        if now - entry.last_checked < self.health_check_interval:
+            return True
+        try:
+            self._ping(entry.raw)
+        except Exception as e:
+            log.warning("DB_POOL", f"Health check failed, discarding connection: {e}")
+            with self._lock:
+                self._stats["health_check_failures"] += 1
+            return False
+        entry.last_checked = now
+        return True
+
+    def _evict_idle_locked(self) -> None:
+        """Closes connections idle longer than `idle_timeout`, keeping `min_size` open. Caller holds the lock."""
+        if self.idle_timeout <= 0:
+            return
+        cutoff = time.monotonic() - self.idle_timeout
+        # The oldest idle connections sit at the left end of the deque.
+        while self._idle and self._size > self.min_size and self._idle[0].last_used < cutoff:
+            entry = self._idle.popleft()
+            self._size -= 1
+            self._stats["idle_evictions"] += 1
+            self._stats["connections_closed"] += 1
+            _safe_close(entry.raw)
+
+    def _discard(self, entry: _PooledConnection) -> None:
+        _safe_close(entry.raw)
+        with self._available:
+            self._size -= 1
+            self._stats["connections_closed"] += 1
+            self._available.notify()
+
+
+# --- Shared Pool ---
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def _connect_mysql() -> Any:
+    """Opens a new MySQL connection using the credentials from `config`."""
+    import mysql.connector
+
+    return mysql.connector.connect(
+        host=config.DB_HOST,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD,
+        database=config.DB_NAME,
+    )
+
+
+def get_pool() -> ConnectionPool:
+    """Returns the process-wide MySQL pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                log.info("DB_POOL", f"Creating MySQL pool (min={config.DB_POOL_MIN_SIZE}, max={config.DB_POOL_MAX_SIZE})")
+                _pool = ConnectionPool(
+                    _connect_mysql,
+                    min_size=config.DB_POOL_MIN_SIZE,
+                    max_size=config.DB_POOL_MAX_SIZE,
+                    checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT,
+                    idle_timeout=config.DB_POOL_IDLE_TIMEOUT,
+                    health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL,
+                    name="mysql",
+                )
+    return _pool
+
+
+def set_pool(pool: Optional[ConnectionPool]) -> None:
+    """
+    Replaces the process-wide pool, e.g. with a SQLite-backed stand-in for local testing.
+    The previous pool, if any, is closed.
+    """
+    global _pool
+    with _pool_lock:
+        previous, _pool = _pool, pool
+    if previous is not None and previous is not pool:
+        previous.close()
+
+
+@contextmanager
+def pooled_connection(timeout: Optional[float] = None) -> Iterator[Any]:
+    """Checks a connection out of the shared pool for the duration of the block."""
+    with get_pool().connection(timeout) as conn:
+        yield conn
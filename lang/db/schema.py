@@ -0,0 +1,275 @@
+import hashlib
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+from lang.db.sources import current_source, get_data_sources
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+
+@dataclass
+class ColumnInfo:
+    name: str
+    data_type: str
+    nullable: bool = True
+    key: str = ""  # MySQL COLUMN_KEY: "PRI", "UNI", "MUL" or "".
+
+
+@dataclass
+class TableInfo:
+    name: str
+    columns: List[ColumnInfo] = field(default_factory=list)
+    # (column, referenced table, referenced column)
+    foreign_keys: List[Tuple[str, str, str]] = field(default_factory=list)
+
+    @property
+    def primary_key(self) -> List[str]:
+        return [c.name for c in self.columns if c.key == "PRI"]
+
+    def render(self) -> str:
+        """Renders the table as a single compact line, e.g. `orders(id int PK, customer_id int -> customers.id)`."""
+        references = {column: f"{table}.{ref}" for column, table, ref in self.foreign_keys}
+        parts = []
+        for column in self.columns:
+            part = f"{column.name} {column.data_type}"
+            if column.key == "PRI":
+                part += " PK"
+            if column.name in references:
+                part += f" -> {references[column.name]}"
+            parts.append(part)
+        return f"{self.name}({', '.join(parts)})"
+
+
+@dataclass
+class SchemaSnapshot:
+    tables: Dict[str, TableInfo]
+    version: int
+    fingerprint: str
+    loaded_at: float
+
+
+SchemaLoader = Callable[[], Dict[str, TableInfo]]
+
+_COLUMNS_QUERY = """
+    SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE()
+    ORDER BY TABLE_NAME, ORDINAL_POSITION
+"""
+
+_FOREIGN_KEYS_QUERY = """
+    SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+    FROM information_schema.KEY_COLUMN_USAGE
+    WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL
+"""
+
+
+def load_mysql_schema(source: Optional[str] = None) -> Dict[str, TableInfo]:
+    """Reads tables, columns, keys and foreign keys of a data source's database from `information_schema`."""
+    tables: Dict[str, TableInfo] = {}
+    with get_data_sources().get(source).checkout(read_only=True) as (_, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(_COLUMNS_QUERY)
+            for table_name, column_name, column_type, is_nullable, column_key in cursor.fetchall():
+                table = tables.setdefault(table_name, TableInfo(name=table_name))
+                table.columns.append(ColumnInfo(
+                    name=column_name,
+                    data_type=str(column_type),
+                    nullable=is_nullable == "YES",
+                    key=column_key or "",
+                ))
+            cursor.execute(_FOREIGN_KEYS_QUERY)
+            for table_name, column_name, ref_table, ref_column in cursor.fetchall():
+                if table_name in tables:
+                    tables[table_name].foreign_keys.append((column_name, ref_table, ref_column))
+        finally:
+            cursor.close()
+    return tables
+
+
+def load_sqlite_schema(source: Optional[str] = None) -> Dict[str, TableInfo]:
+    """Reads tables, columns, primary keys and foreign keys of a SQLite stand-in database."""
+    tables: Dict[str, TableInfo] = {}
+    with get_data_sources().get(source).checkout(read_only=True) as (_, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SHOW TABLES")
+            for (table_name,) in cursor.fetchall():
+                table = tables[table_name] = TableInfo(name=table_name)
+                quoted = table_name.replace('"', '""')
+                cursor.execute(f'PRAGMA table_info("{quoted}")')
+                for _, column_name, column_type, not_null, _, pk in cursor.fetchall():
+                    table.columns.append(ColumnInfo(
+                        name=column_name, data_type=(column_type or "").lower(), nullable=not not_null, key="PRI" if pk else "",
+                    ))
+                cursor.execute(f'PRAGMA foreign_key_list("{quoted}")')
+                for row in cursor.fetchall():
+                    table.foreign_keys.append((row[3], row[2], row[4]))
+        finally:
+            cursor.close()
+    return tables
+
+
+def _fingerprint(tables: Dict[str, TableInfo]) -> str:
+    digest = hashlib.sha1()
+    for name in sorted(tables):
+        digest.update(tables[name].render().encode("utf-8"))
+    return digest.hexdigest()
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text: str) -> set:
+    """Lower-cased word tokens plus naive singular forms, so 'customers' matches 'customer'."""
+    tokens = set()
+    for word in _WORD_RE.findall(text.lower()):
+        tokens.add(word)
+        if len(word) > 3 and word.endswith("ies"):
+            tokens.add(word[:-3] + "y")
+        elif len(word) > 3 and word.endswith("es"):
+            tokens.add(word[:-2])
+        if len(word) > 2 and word.endswith("s"):
+            tokens.add(word[:-1])
+    return tokens
+
+
+class SchemaCatalog:
+    """
+    In-memory snapshot of the database schema with TTL and versioned invalidation.
+
+    `version` only changes when the schema actually changes (or on explicit
+    invalidation), so it can be used as part of cache keys for anything derived
+    from the schema.
+    """
+
+    def __init__(self, loader: SchemaLoader = load_mysql_schema, ttl: float = 600.0):
+        self._loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot: Optional[SchemaSnapshot] = None
+        self._fingerprint: Optional[str] = None
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def snapshot(self) -> SchemaSnapshot:
+        """Returns the current snapshot, reloading it when it is missing or older than the TTL."""
+        current = self._snapshot
+        if current is not None and time.monotonic() - current.loaded_at < self.ttl:
+            return current
+        with self._lock:
+            current = self._snapshot
+            if current is not None and time.monotonic() - current.loaded_at < self.ttl:
+                return current
+            log.info("SCHEMA", "Loading schema snapshot...")
+            started = time.perf_counter()
+            tables = self._loader()
+            fingerprint = _fingerprint(tables)
+            # After an explicit invalidation the version has already been bumped.
+            if self._version == 0 or (self._fingerprint is not None and self._fingerprint != fingerprint):
+                self._version += 1
+            self._fingerprint = fingerprint
+            self._snapshot = SchemaSnapshot(tables, self._version, fingerprint, time.monotonic())
+            log.info("SCHEMA", f"Loaded {len(tables)} tables (version {self._version}) in {time.perf_counter() - started:.3f}s")
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        """Drops the snapshot and bumps the version so derived caches stop matching."""
+        with self._lock:
+            self._snapshot = None
+            self._fingerprint = None
+            self._version += 1
+        log.info("SCHEMA", f"Schema snapshot invalidated (version {self._version})")
+
+    def get_table(self, name: str) -> Optional[TableInfo]:
+        tables = self.snapshot().tables
+        if name in tables:
+            return tables[name]
+        # MySQL table names are case-insensitive on most platforms.
+        lowered = name.lower()
+        return next((t for n, t in tables.items() if n.lower() == lowered), None)
+
+    def relevant_tables(self, question: str, max_tables: int = 8) -> List[TableInfo]:
+        """
+        Ranks tables by lexical overlap with the question: table-name matches weigh
+        more than column-name matches, and tables joined by a foreign key to a
+        strong match are pulled in so the agent can write the join.
+        """
+        tables = self.snapshot().tables
+        question_tokens = _tokens(question)
+        scores: Dict[str, float] = {}
+        for name, table in tables.items():
+            name_tokens = _tokens(name.replace("_", " "))
+            score = 3.0 * len(question_tokens & name_tokens)
+            for column in table.columns:
+                if question_tokens & _tokens(column.name.replace("_", " ")):
+                    score += 1.0
+            if score:
+                scores[name] = score
+
+        ranked = sorted(scores, key=lambda n: (-scores[n], n))[:max_tables]
+        selected = list(ranked)
+        for name in ranked:
+            for _, ref_table, _ in tables[name].foreign_keys:
+                if ref_table in tables and ref_table not in selected and len(selected) < max_tables:
+                    selected.append(ref_table)
+        return [tables[name] for name in selected]
+
+    def relevant_slice(self, question: str, max_tables: int = 8, max_chars: int = 4000) -> str:
+        """Renders a compact schema excerpt for the prompt, bounded by `max_tables` and `max_chars`."""
+        tables = self.snapshot().tables
+        if not tables:
+            return "The database has no tables."
+
+        lines = []
+        for table in self.relevant_tables(question, max_tables):
+            line = table.render()
+            if sum(len(l) + 1 for l in lines) + len(line) > max_chars:
+                break
+            lines.append(line)
+
+        names = ", ".join(sorted(tables))
+        if len(names) <= max_chars // 2:
+            lines.append(f"All tables: {names}")
+        else:
+            lines.append(f"{len(tables)} tables in total; use get_database_tables to list them.")
+        return "\n".join(lines)
+
+
+# --- Shared Catalog ---
+
+_catalogs: Dict[str, SchemaCatalog] = {}
+_catalog_override: Optional[SchemaCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_schema_catalog() -> SchemaCatalog:
+    """Returns the schema catalog of the current request's data source, creating it on first use."""
+    if _catalog_override is not None:
+        return _catalog_override
+    source = current_source()
+    catalog = _catalogs.get(source.name)
+    if catalog is None:
+        with _catalog_lock:
+            catalog = _catalogs.get(source.name)
+            if catalog is None:
+                loader = load_sqlite_schema if source.driver == "sqlite" else load_mysql_schema
+                catalog = _catalogs[source.name] = SchemaCatalog(loader=partial(loader, source.name), ttl=config.SCHEMA_CACHE_TTL)
+    return catalog
+
+
+def set_schema_catalog(catalog: Optional[SchemaCatalog]) -> None:
+    """Serves `catalog` for every data source, e.g. one backed by a stand-in loader; None restores per-source catalogs."""
+    global _catalog_override
+    with _catalog_lock:
+        _catalog_override = catalog
@@ -0,0 +1,86 @@
+import re
+import sqlite3
+from typing import Any, List, Optional, Sequence
+
+# MySQL statements the tools issue that SQLite spells differently.
+_TRANSLATIONS = (
+    (re.compile(r"^\s*SHOW\s+TABLES\s*;?\s*$", re.IGNORECASE),
+     "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"),
+)
+
+
+def _translate(query: str) -> str:
+    for pattern, replacement in _TRANSLATIONS:
+        if pattern.match(query):
+            return replacement
+    return query
+
+
+class SQLiteCursor:
+    """A sqlite3 cursor that accepts mysql.connector's `dictionary`/`buffered` options."""
+
+    def __init__(self, raw: sqlite3.Cursor, dictionary: bool):
+        self._raw = raw
+        self._dictionary = dictionary
+
+    @property
+    def description(self) -> Optional[Sequence[Any]]:
+        return self._raw.description
+
+    @property
+    def rowcount(self) -> int:
+        return self._raw.rowcount
+
+    def execute(self, query: str, params: Sequence[Any] = ()) -> None:
+        self._raw.execute(_translate(query), params)
+
+    def fetchone(self) -> Any:
+        row = self._raw.fetchone()
+        return self._shape([row])[0] if row is not None else None
+
+    def fetchmany(self, size: int) -> List[Any]:
+        return self._shape(self._raw.fetchmany(size))
+
+    def fetchall(self) -> List[Any]:
+        return self._shape(self._raw.fetchall())
+
+    def close(self) -> None:
+        self._raw.close()
+
+    def _shape(self, rows: List[Any]) -> List[Any]:
+        if not self._dictionary or not rows or self._raw.description is None:
+            return rows
+        columns = [d[0] for d in self._raw.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+
+class SQLiteConnection:
+    """
+    Wraps a sqlite3 connection so it can stand in for a MySQL connection in the pools
+    and SQL tools: dict cursors, `SHOW TABLES`, and `interrupt` for statement timeouts.
+    Handy for local development and for testing several data sources without servers.
+    """
+
+    def __init__(self, path: str):
+        # Pooled connections are handed to whichever thread checks them out.
+        self._raw = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+    def cursor(self, dictionary: bool = False, buffered: Optional[bool] = None, **_: Any) -> SQLiteCursor:
+        return SQLiteCursor(self._raw.cursor(), dictionary)
+
+    def commit(self) -> None:
+        self._raw.commit()
+
+    def rollback(self) -> None:
+        if self._raw.in_transaction:
+            self._raw.rollback()
+
+    def interrupt(self) -> None:
+        self._raw.interrupt()
+
+    def close(self) -> None:
+        self._raw.close()
+
+
+def connect_sqlite(path: str) -> SQLiteConnection:
+    return SQLiteConnection(path)
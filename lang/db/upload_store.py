@@ -0,0 +1,327 @@
+import csv
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import config
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+TABULAR_EXTENSIONS = (".csv", ".xlsx")
+
+_INSERT_BATCH_ROWS = 10_000
+_TYPE_SAMPLE_ROWS = 1_000
+_SAMPLE_ROWS_IN_SCHEMA = 3
+_IDENTIFIER_RE = re.compile(r"[^0-9a-zA-Z_]+")
+# Columns whose names look like keys or dates are indexed after loading.
+_INDEXED_COLUMN_RE = re.compile(r"(^id$|_id$|^date$|_date$|_at$)", re.IGNORECASE)
+_READ_ONLY_RE = re.compile(r"^\s*(SELECT|WITH|EXPLAIN|PRAGMA\s+table_info)\b", re.IGNORECASE)
+
+
+@dataclass
+class UploadedTable:
+    name: str
+    source: str
+    columns: List[Tuple[str, str]]  # (column name, SQLite type)
+    row_count: int
+    load_seconds: float
+    last_used: float = field(default_factory=time.monotonic)
+
+    def render(self) -> str:
+        columns = ", ".join(f"{name} {sql_type}" for name, sql_type in self.columns)
+        return f"{self.name}({columns}) -- {self.row_count:,} rows from '{self.source}'"
+
+
+class _ThreadDatabase:
+    """One in-memory SQLite database holding the uploads of a single Discord thread."""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        # Loads are throwaway copies of an upload; durability would only slow them down.
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.lock = threading.Lock()
+        self.tables: Dict[str, UploadedTable] = {}
+
+    def size_bytes(self) -> int:
+        """Callers hold `lock`: another thread may be loading into or closing the connection."""
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+
+def _locked_size(database: _ThreadDatabase) -> int:
+    with database.lock:
+        # A dropped thread's database is closed and has no tables.
+        return database.size_bytes() if database.tables else 0
+
+
+def _identifier(text: str, fallback: str) -> str:
+    name = _IDENTIFIER_RE.sub("_", text).strip("_").lower()
+    if not name:
+        name = fallback
+    if name[0].isdigit():
+        name = f"_{name}"
+    return name
+
+
+def _unique_columns(header: Sequence[Any]) -> List[str]:
+    names: List[str] = []
+    for index, raw in enumerate(header):
+        base = _identifier(str(raw) if raw is not None else "", f"column_{index + 1}")
+        name, suffix = base, 2
+        while name in names:
+            name, suffix = f"{base}_{suffix}", suffix + 1
+        names.append(name)
+    return names
+
+
+def _infer_type(values: Iterable[Any]) -> str:
+    """Picks INTEGER, REAL or TEXT from a sample of a column's values."""
+    inferred = "INTEGER"
+    for value in values:
+        if value is None or value == "":
+            continue
+        if isinstance(value, bool):
+            return "TEXT"
+        if isinstance(value, int):
+            continue
+        if isinstance(value, float):
+            inferred = "REAL"
+            continue
+        text = str(value)
+        try:
+            int(text)
+            continue
+        except ValueError:
+            pass
+        try:
+            float(text)
+            inferred = "REAL"
+        except ValueError:
+            return "TEXT"
+    return inferred
+
+
+def _csv_rows(source: Any) -> Tuple[List[Any], Iterator[Sequence[Any]], Any]:
+    if isinstance(source, str):
+        f = open(source, "r", encoding="utf-8", errors="replace", newline="")
+    else:
+        f = io.TextIOWrapper(source, encoding="utf-8", errors="replace", newline="")
+    reader = csv.reader(f)
+    return next(reader, []), reader, f
+
+
+def _xlsx_rows(source: Any) -> Tuple[List[Any], Iterator[Sequence[Any]], Any]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    rows = workbook.worksheets[0].iter_rows(values_only=True)
+    return list(next(rows, ())), rows, workbook
+
+
+class UploadStore:
+    """
+    Per-thread, in-process SQL engine for uploaded spreadsheets.
+
+    Each Discord thread gets its own in-memory SQLite database. Files are bulk
+    loaded with inferred column types and indexes on key-like columns, so the agent
+    can answer questions with real SQL instead of reading the file as text. When the
+    combined size of all databases exceeds the memory budget, the least recently
+    used tables are dropped.
+    """
+
+    def __init__(self, memory_budget_bytes: int, max_threads: int = 100):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_threads = max_threads
+        self._lock = threading.Lock()
+        self._databases: Dict[str, _ThreadDatabase] = {}
+
+    def load_file(self, thread_id: str, file_path: str, stream: Optional[BinaryIO] = None) -> UploadedTable:
+        """
+        Loads a CSV/XLSX file into the thread's database, replacing any table of the same name.
+        With a `stream`, the file is read from it and `file_path` only supplies the name.
+        """
+        _, extension = os.path.splitext(file_path.lower())
+        if extension not in TABULAR_EXTENSIONS:
+            raise ValueError(f"Unsupported file type for table loading: '{extension}'")
+        database = self._database(thread_id)
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        table_name = _identifier(stem, "upload")
+
+        started = time.perf_counter()
+        header, rows, handle = (_csv_rows if extension == ".csv" else _xlsx_rows)(file_path if stream is None else stream)
+        try:
+            with database.lock:
+                table = self._bulk_load(database, table_name, os.path.basename(file_path), header, rows)
+        finally:
+            handle.close()
+        table.load_seconds = time.perf_counter() - started
+        log.info(
+            "UPLOAD_STORE",
+            f"Loaded {table.row_count:,} rows into '{table_name}' for thread {thread_id} "
+            f"in {table.load_seconds:.2f}s ({table.row_count / max(table.load_seconds, 1e-9):,.0f} rows/sec)",
+        )
+        self._enforce_budget(keep=(thread_id, table_name))
+        return table
+
+    def describe(self, thread_id: Optional[str]) -> str:
+        """Returns the schema of every table loaded for the thread, with a few sample rows each."""
+        database = self._databases.get(thread_id) if thread_id else None
+        if database is None or not database.tables:
+            return "No uploaded data is loaded in this conversation."
+        sections = []
+        with database.lock:
+            for table in database.tables.values():
+                cursor = database.conn.execute(f'SELECT * FROM "{table.name}" LIMIT {_SAMPLE_ROWS_IN_SCHEMA}')
+                sample = "\n".join(" | ".join("NULL" if v is None else str(v) for v in row) for row in cursor.fetchall())
+                sections.append(f"{table.render()}\nSample rows:\n{sample}")
+        return "\n\n".join(sections)
+
+    def query(self, thread_id: Optional[str], sql: str, max_rows: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Runs a read-only statement against the thread's uploads.
+
+        Returns up to `max_rows` rows as dicts and whether more rows were available.
+        """
+        database = self._databases.get(thread_id) if thread_id else None
+        if database is None:
+            raise LookupError("No uploaded data is loaded in this conversation.")
+        if not _READ_ONLY_RE.match(sql):
+            raise PermissionError("Only SELECT queries are allowed on uploaded data.")
+        with database.lock:
+            database.conn.execute("PRAGMA query_only=ON")
+            try:
+                cursor = database.conn.execute(sql)
+                columns = [d[0] for d in cursor.description or ()]
+                rows = cursor.fetchmany(max_rows + 1)
+            finally:
+                database.conn.execute("PRAGMA query_only=OFF")
+            now = time.monotonic()
+            for table in database.tables.values():
+                if table.name in sql:
+                    table.last_used = now
+        return [dict(zip(columns, row)) for row in rows[:max_rows]], len(rows) > max_rows
+
+    def drop_thread(self, thread_id: str) -> None:
+        with self._lock:
+            database = self._databases.pop(thread_id, None)
+        if database is not None:
+            with database.lock:
+                database.tables.clear()
+                database.conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            databases = dict(self._databases)
+        return {
+            "threads": len(databases),
+            "tables": sum(len(d.tables) for d in databases.values()),
+            "bytes": sum(_locked_size(d) for d in databases.values()),
+            "budget_bytes": self.memory_budget_bytes,
+        }
+
+    # --- Internal Helpers ---
+
+    def _database(self, thread_id: str) -> _ThreadDatabase:
+        with self._lock:
+            database = self._databases.get(thread_id)
+            if database is None:
+                database = self._databases[thread_id] = _ThreadDatabase()
+            return database
+
+    def _bulk_load(self, database: _ThreadDatabase, table_name: str, source: str,
+                   header: Sequence[Any], rows: Iterator[Sequence[Any]]) -> UploadedTable:
+        columns = _unique_columns(header)
+        width = len(columns)
+        sample = list(islice(rows, _TYPE_SAMPLE_ROWS))
+        types = [_infer_type(row[i] if i < len(row) else None for row in sample) for i in range(width)]
+
+        def normalized(batch: Iterable[Sequence[Any]]) -> Iterator[Tuple[Any, ...]]:
+            for row in batch:
+                if len(row) != width:
+                    row = (list(row) + [None] * width)[:width]
+                # Empty CSV cells mean NULL, not an empty string. The membership test runs
+                # in C, so complete rows skip the per-value rebuild.
+                yield tuple(None if v == "" else v for v in row) if "" in row else row
+
+        conn = database.conn
+        quoted_columns = ", ".join(f'"{c}" {t}' for c, t in zip(columns, types))
+        placeholders = ", ".join("?" * width)
+        row_count = 0
+        with conn:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute(f'CREATE TABLE "{table_name}" ({quoted_columns})')
+            insert = f'INSERT INTO "{table_name}" VALUES ({placeholders})'
+            conn.executemany(insert, normalized(sample))
+            row_count += len(sample)
+            while True:
+                batch = list(islice(rows, _INSERT_BATCH_ROWS))
+                if not batch:
+                    break
+                conn.executemany(insert, normalized(batch))
+                row_count += len(batch)
+            for column in columns:
+                if _INDEXED_COLUMN_RE.search(column):
+                    conn.execute(f'CREATE INDEX "idx_{table_name}_{column}" ON "{table_name}" ("{column}")')
+        conn.execute(f'ANALYZE "{table_name}"')
+
+        table = UploadedTable(table_name, source, list(zip(columns, types)), row_count, 0.0)
+        database.tables[table_name] = table
+        return table
+
+    def _enforce_budget(self, keep: Tuple[str, str]) -> None:
+        """Drops least recently used tables (never `keep`) until every database fits the budget."""
+        with self._lock:
+            databases = dict(self._databases)
+        total = 0
+        candidates = []
+        for thread_id, d in databases.items():
+            with d.lock:
+                if not d.tables:
+                    continue
+                total += d.size_bytes()
+                candidates.extend((table.last_used, thread_id, name) for name, table in d.tables.items())
+        candidates.sort()
+        for _, thread_id, name in candidates:
+            if total <= self.memory_budget_bytes and len(databases) <= self.max_threads:
+                break
+            if (thread_id, name) == keep:
+                continue
+            database = databases[thread_id]
+            with database.lock:
+                if name not in database.tables:
+                    continue
+                before = database.size_bytes()
+                database.conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+                database.tables.pop(name, None)
+                database.conn.execute("VACUUM")
+                total -= before - database.size_bytes()
+            log.info("UPLOAD_STORE", f"Evicted table '{name}' of thread {thread_id} to stay within the memory budget.")
+            if not database.tables:
+                self.drop_thread(thread_id)
+                databases.pop(thread_id, None)
+
+
+_upload_store: Optional[UploadStore] = None
+_upload_store_lock = threading.Lock()
+
+
+def get_upload_store() -> UploadStore:
+    """Returns the process-wide upload store, creating it on first use."""
+    global _upload_store
+    if _upload_store is None:
+        with _upload_store_lock:
+            if _upload_store is None:
+                _upload_store = UploadStore(
+                    memory_budget_bytes=config.UPLOAD_DB_MEMORY_BUDGET_MB * 1024 * 1024,
+                    max_threads=config.UPLOAD_DB_MAX_THREADS,
+                )
+    return _upload_store
@@ -1,72 +1,131 @@
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
 from lang.state.state import AgentState
-from lang.node.node import agent_node, generate_image_node
-from lang.tools.tools import all_tools
-import re
+from lang.node.node import (
+    agent_node,
+    aagent_node,
+    generate_image_node,
+    agenerate_image_node,
+    compact_history_node,
+    acompact_history_node,
+    fast_path_node,
+    afast_path_node,
+    tools_node,
+    atools_node,
+)
+from lang.graph.router import ROUTE_AGENT, ROUTE_FAST_PATH, ROUTE_IMAGE, get_router, message_text
+from config import CONVERSATION_DB_PATH, GRAPH_EXECUTION_MODE
+import asyncio
+import os
+from telemetry import get_logger, trace
+
+log = get_logger(__name__)
 
 def route_to_image_or_agent(state: AgentState) -> str:
     """
-    Routes the workflow to either the image generation node or the general agent
-    based on the content of the user's last message.
+    Routes the workflow based on the user's last message: trivial intents go to the
+    fast path (one tool call, no LLM), image requests to the image generation node,
+    and everything else to the general agent.
     """
-    print("--- [ROUTER] Deciding workflow path... ---")
-    last_message = state["messages"][-1]
-    
-    prompt_text = ""
-    image_data_exists = False
-
-    # Handle cases where the message contains both text and images.
-    if isinstance(last_message.content, list):
-        for part in last_message.content:
-            if isinstance(part, dict):
-                if part.get("type") == "text":
-                    prompt_text = part.get("text", "").lower()
-                if part.get("type") == "image_url":
-                    # We only need to know if an image exists, not its content
-                    image_data_exists = True
-    else:
-        # Fallback for text-only messages
-        prompt_text = str(last_message.content).lower()
-
-    # Keywords to trigger the image generation path
-    image_keywords = ["generate", "create", "draw", "modify", "edit", "style", "design", "image", "photo"]
-
-    # The user's prompt MUST contain an image keyword OR they must have uploaded an image.
-    if any(keyword in prompt_text for keyword in image_keywords) or image_data_exists:
-        print("--- [ROUTER] -> Decision: Route to dedicated image generation node. ---")
-        return "generate_image_node"
-    
-    print("--- [ROUTER] -> Decision: Route to general agent. ---")
-    return "agent"
+    with trace("graph.route") as span:
+        prompt_text, image_data_exists = message_text(state["messages"][-1].content)
+        decision = get_router().decide(prompt_text, image_data_exists)
+        span.set(route=decision.route)
+    log.info("ROUTER", f"-> Decision: {decision.route} ({decision.reason}).")
+    return decision.route
 
 def should_continue(state: AgentState) -> str:
     """
     Determines whether the general agent should continue using tools or end the workflow.
     """
-    print("--- [AGENT_ROUTER] Deciding next step for agent... ---")
     if hasattr(state["messages"][-1], "tool_calls") and state["messages"][-1].tool_calls:
-        print("--- [AGENT_ROUTER] -> Decision: Execute tools. ---")
+        log.debug("AGENT_ROUTER", "-> Decision: Execute tools.")
         return "tools"
     
-    print("--- [AGENT_ROUTER] -> Decision: End of workflow. ---")
+    log.debug("AGENT_ROUTER", "-> Decision: End of workflow.")
     return END
 
+def after_fast_path(state: AgentState) -> str:
+    """
+    Ends the run once the fast path has answered; a question it could no longer match
+    (the schema changed after routing) goes to the agent instead.
+    """
+    if isinstance(state["messages"][-1], AIMessage):
+        return END
+    log.info("ROUTER", "-> Fast path no longer matches; handing over to the agent.")
+    return "agent"
+
+def _build_checkpointer():
+    """
+    Creates the SQLite-backed checkpointer that persists each Discord thread's state.
+    The async saver is required when the graph runs with `app.ainvoke`.
+    """
+    directory = os.path.dirname(CONVERSATION_DB_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    log.info("GRAPH", f"Using conversation store at {CONVERSATION_DB_PATH}")
+    if GRAPH_EXECUTION_MODE == "async":
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+        class _LoopBindingAsyncSqliteSaver(AsyncSqliteSaver):
+            # The saver captures the running loop when it is created, but the graph is built
+            # at import time, before the bot's loop exists; bind to the loop of first use instead.
+            async def setup(self) -> None:
+                if not self.is_setup:
+                    self.loop = asyncio.get_running_loop()
+                await super().setup()
+
+        def create() -> AsyncSqliteSaver:
+            # The connection opens lazily on the event loop that first uses it.
+            return _LoopBindingAsyncSqliteSaver(aiosqlite.connect(CONVERSATION_DB_PATH))
+
+        async def acreate() -> AsyncSqliteSaver:
+            return create()
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # The usual case: no loop is running yet, so construct the saver on a short-lived one.
+            return asyncio.run(acreate())
+        return create()
+
+    import sqlite3
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    return SqliteSaver(sqlite3.connect(CONVERSATION_DB_PATH, check_same_thread=False))
+
 # --- Build the Graph ---
 workflow = StateGraph(AgentState)
 
 # Define the nodes for the graph.
-workflow.add_node("agent", agent_node)
-workflow.add_node("tools", ToolNode(all_tools))
-workflow.add_node("generate_image_node", generate_image_node)
+# Each node carries a sync and an async implementation, so the same compiled app
+# serves `app.invoke` (thread mode) and `app.ainvoke` (async mode).
+workflow.add_node(
+    "compact_history",
+    RunnableLambda(compact_history_node, afunc=acompact_history_node, name="compact_history"),
+)
+workflow.add_node(ROUTE_FAST_PATH, RunnableLambda(fast_path_node, afunc=afast_path_node, name=ROUTE_FAST_PATH))
+workflow.add_node("agent", RunnableLambda(agent_node, afunc=aagent_node, name="agent"))
+# The agent's single tool loop (see `tools_node`); the files its tools create are
+# collected into the state's artifacts.
+workflow.add_node("tools", RunnableLambda(tools_node, afunc=atools_node, name="tools"))
+workflow.add_node(
+    "generate_image_node",
+    RunnableLambda(generate_image_node, afunc=agenerate_image_node, name="generate_image_node"),
+)
 
 # --- Wire the Graph ---
-# Set the conditional entry point to route to the correct node.
-workflow.set_conditional_entry_point(
+# Every run first trims the thread's history to the token budget, then routes.
+workflow.set_entry_point("compact_history")
+workflow.add_conditional_edges(
+    "compact_history",
     route_to_image_or_agent,
     {
-        "generate_image_node": "generate_image_node",
-        "agent": "agent"
+        ROUTE_FAST_PATH: ROUTE_FAST_PATH,
+        ROUTE_IMAGE: "generate_image_node",
+        ROUTE_AGENT: "agent"
     }
 )
 
@@ -74,8 +133,12 @@ workflow.set_conditional_entry_point(
 workflow.add_conditional_edges("agent", should_continue, {"tools": "tools", "__end__": END})
 workflow.add_edge("tools", "agent")
 
-# Define the edge for the image generation workflow.
+# Define the edges for the image generation workflow and the fast path.
 workflow.add_edge("generate_image_node", END)
+workflow.add_conditional_edges(ROUTE_FAST_PATH, after_fast_path, {"agent": "agent", "__end__": END})
 
-# Compile the graph into a runnable application
-app = workflow.compile()
\ No newline at end of file
+# Compile the graph into a runnable application.
+# The checkpointer keys state by the `thread_id` in the run config, so replies in
+# the same Discord thread continue the same conversation.
+checkpointer = _build_checkpointer()
+app = workflow.compile(checkpointer=checkpointer)
\ No newline at end of file
@@ -0,0 +1,249 @@
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.tools import BaseTool
+
+import config
+from lang.db.pool import DatabaseUnavailableError
+from lang.db.schema import get_schema_catalog
+from lang.tools.tools import describe_table, get_database_tables, query_database
+
+ROUTE_FAST_PATH = "fast_path"
+ROUTE_IMAGE = "generate_image_node"
+ROUTE_AGENT = "agent"
+
+# Table names as users type them: plain identifiers, optionally schema-qualified or backquoted.
+_TABLE_PATTERN = r"`?(?P<{group}>[a-z0-9_$]+(?:\.[a-z0-9_$]+)?)`?"
+_MENTION_RE = re.compile(r"<@!?\d+>")
+_TRAILING_PUNCTUATION_RE = re.compile(r"[\s?.!]+$")
+_WHITESPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"[a-z]+")
+
+
+@dataclass(frozen=True)
+class Intent:
+    """
+    A trivial request answered by one tool call without the LLM.
+
+    `patterns` are regex alternatives over the normalized message (lower case, single
+    spaces, no trailing punctuation); `{table}` marks where a table name is captured.
+    """
+    name: str
+    patterns: Tuple[str, ...]
+    tool: BaseTool
+    build_args: Callable[[Optional[str]], Dict[str, Any]]
+
+
+@dataclass(frozen=True)
+class IntentMatch:
+    intent: Intent
+    table: Optional[str] = None
+
+    def tool_args(self) -> Dict[str, Any]:
+        return self.intent.build_args(self.table)
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    route: str
+    match: Optional[IntentMatch] = None
+    reason: str = ""
+
+
+_OPTIONAL_TABLE_WORDS = r"(?: the)?(?: table)? {table}(?: table)?"
+
+DEFAULT_INTENTS: Tuple[Intent, ...] = (
+    Intent(
+        name="list_tables",
+        patterns=(
+            r"(?:list|show)(?: me)?(?: all)?(?: of)?(?: the)?(?: database)? tables(?: in the database)?",
+            r"(?:what|which) tables (?:are there|do (?:we|you) have|exist|are available)(?: in the database)?",
+            r"tables",
+        ),
+        tool=get_database_tables,
+        build_args=lambda table: {},
+    ),
+    Intent(
+        name="describe_table",
+        patterns=(
+            r"(?:describe|desc)" + _OPTIONAL_TABLE_WORDS,
+            r"(?:show|list)(?: me)?(?: the)? (?:columns|schema|structure|fields) (?:of|for|in)" + _OPTIONAL_TABLE_WORDS,
+            r"what (?:columns|fields) (?:are in|does)" + _OPTIONAL_TABLE_WORDS + r"(?: have)?",
+        ),
+        tool=describe_table,
+        build_args=lambda table: {"table_name": table},
+    ),
+    Intent(
+        name="row_count",
+        patterns=(
+            r"how many (?:rows|records|entries) (?:are )?(?:in|does)" + _OPTIONAL_TABLE_WORDS + r"(?: have| contain)?",
+            r"(?:count|number of) (?:the )?(?:rows|records) (?:in|of)" + _OPTIONAL_TABLE_WORDS,
+            r"(?:row count|count rows) (?:of|for|in)" + _OPTIONAL_TABLE_WORDS,
+        ),
+        tool=query_database,
+        build_args=lambda table: {"query": f"SELECT COUNT(*) AS row_count FROM `{table}`"},
+    ),
+)
+
+
+def normalize_message(text: str) -> str:
+    text = _MENTION_RE.sub(" ", text).lower()
+    text = _WHITESPACE_RE.sub(" ", text).strip()
+    return _TRAILING_PUNCTUATION_RE.sub("", text)
+
+
+class FastPathMatcher:
+    """
+    Matches a message against every intent pattern with one compiled regex.
+
+    Each pattern becomes a named alternative; the outermost group that matched
+    (`lastgroup`) identifies the intent, so matching costs a single regex pass no
+    matter how many intents are configured.
+    """
+
+    def __init__(self, intents: Sequence[Intent]):
+        self._by_group: Dict[str, Tuple[Intent, Optional[str]]] = {}
+        alternatives = []
+        for i, intent in enumerate(intents):
+            for j, pattern in enumerate(intent.patterns):
+                group = f"i{i}_{j}"
+                table_group = f"{group}__table" if "{table}" in pattern else None
+                body = pattern.replace("{table}", _TABLE_PATTERN.format(group=table_group)) if table_group else pattern
+                alternatives.append(f"(?P<{group}>{body})")
+                self._by_group[group] = (intent, table_group)
+        polite = r"(?:(?:please|can you|could you|hey|hi) )*"
+        self._regex = re.compile(f"^{polite}(?:{'|'.join(alternatives)})(?: please)?$")
+
+    def match(self, text: str) -> Optional[IntentMatch]:
+        m = self._regex.match(normalize_message(text))
+        if not m:
+            return None
+        intent, table_group = self._by_group[m.lastgroup]
+        return IntentMatch(intent, m.group(table_group) if table_group else None)
+
+
+# --- Classification ---
+
+# Nouns that name a picture; any of them makes a request about images.
+_IMAGE_NOUNS = frozenset("""
+    image images picture pictures photo photos photograph illustration drawing painting sketch logo icon
+    poster wallpaper artwork avatar banner cartoon portrait meme sticker thumbnail render
+""".split())
+# Verbs that only ever mean making a picture.
+_IMAGE_VERBS = frozenset("draw paint sketch illustrate colorize recolor".split())
+# Words that point at the database, exports or uploaded data.
+_DATA_WORDS = frozenset("""
+    table tables row rows column columns query sql select database db schema record records data dataset
+    report export excel csv xlsx parquet count total sum average avg mean max min revenue sales orders
+    order customers customer products product users user transactions amount price quantity top per
+    group by month year daily weekly monthly between where file upload uploaded spreadsheet list show
+""".split())
+
+
+def classify(text: str, has_image: bool) -> str:
+    """
+    Picks the image node or the agent for a message that is not a fast-path intent.
+
+    Generic verbs like "create" or "generate" are not enough on their own: an image
+    request must name a picture or use a drawing verb, and must not be outweighed
+    by database vocabulary ("create a report of sales" goes to the agent). An
+    attached image is always sent to the image node, which edits it.
+    """
+    if has_image:
+        return ROUTE_IMAGE
+    words = _WORD_RE.findall(text.lower())
+    image_score = sum(2 if w in _IMAGE_VERBS else 1 for w in words if w in _IMAGE_NOUNS or w in _IMAGE_VERBS)
+    data_score = sum(1 for w in words if w in _DATA_WORDS)
+    return ROUTE_IMAGE if image_score and image_score >= data_score else ROUTE_AGENT
+
+
+class Router:
+    """Routing stage: fast-path intents first, then classification between image node and agent."""
+
+    def __init__(self, intents: Sequence[Intent] = DEFAULT_INTENTS, enabled: bool = True):
+        self.enabled = enabled
+        self._matcher = FastPathMatcher(intents)
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+        self._decision_time: Dict[str, float] = {}
+
+    def decide(self, text: str, has_image: bool = False) -> RouteDecision:
+        started = time.perf_counter()
+        decision = self._decide(text, has_image)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._counts[decision.route] = self._counts.get(decision.route, 0) + 1
+            self._decision_time[decision.route] = self._decision_time.get(decision.route, 0.0) + elapsed
+        return decision
+
+    def match(self, text: str) -> Optional[IntentMatch]:
+        """
+        Returns the fast-path intent for a message, with its table name resolved to the
+        schema's spelling. Unknown tables ("rows in last month's orders") do not match,
+        so the agent gets to interpret them.
+        """
+        if not self.enabled:
+            return None
+        match = self._matcher.match(text)
+        if match is None or match.table is None:
+            return match
+        table = _resolve_table(match.table)
+        return IntentMatch(match.intent, table) if table else None
+
+    def _decide(self, text: str, has_image: bool) -> RouteDecision:
+        match = None if has_image else self.match(text)
+        if match is not None:
+            return RouteDecision(ROUTE_FAST_PATH, match, f"intent '{match.intent.name}'")
+        return RouteDecision(classify(text, has_image), reason="classified")
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                route: {"count": count, "decision_time_avg": self._decision_time[route] / count}
+                for route, count in self._counts.items()
+            }
+
+
+def _resolve_table(name: str) -> Optional[str]:
+    try:
+        table = get_schema_catalog().get_table(name)
+    except DatabaseUnavailableError:
+        return None
+    return table.name if table else None
+
+
+def _enabled_intents() -> List[Intent]:
+    if not config.FAST_PATH_INTENTS:
+        return list(DEFAULT_INTENTS)
+    return [intent for intent in DEFAULT_INTENTS if intent.name in config.FAST_PATH_INTENTS]
+
+
+_router: Optional[Router] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Router:
+    """Returns the process-wide router, built from the configured intent table on first use."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = Router(_enabled_intents(), enabled=config.FAST_PATH_ENABLED)
+    return _router
+
+
+def message_text(content: Any) -> Tuple[str, bool]:
+    """Returns the text of a message's content and whether it carries an image part."""
+    if not isinstance(content, list):
+        return str(content), False
+    text, has_image = "", False
+    for part in content:
+        if isinstance(part, dict):
+            if part.get("type") == "text":
+                text = part.get("text", "")
+            elif part.get("type") == "image_url":
+                has_image = True
+    return text, has_image
@@ -1,10 +1,29 @@
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, RemoveMessage, ToolMessage, message_chunk_to_message
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.runnables import RunnableConfig
+from langgraph.prebuilt import ToolNode
 
+import asyncio
+import uuid
+
+from lang.db.cache import get_query_cache
+from lang.db.schema import get_schema_catalog
+from lang.graph.router import get_router, message_text
+from lang.state.context import bind_request_context, get_thread_id
 from lang.state.state import AgentState
-from lang.tools.tools import all_tools, generate_image
-from config import llm
+from lang.tools.tools import all_tools, generate_image, query_database
+from config import (
+    get_llm,
+    AGENT_MAX_ITERATIONS,
+    AGENT_MAX_TOKENS_PER_REQUEST,
+    CONVERSATION_TOKEN_BUDGET,
+    SCHEMA_PROMPT_MAX_TABLES,
+)
+from registry import registry
+from streaming import token_streams
+from telemetry import get_logger, record_llm_usage, trace
+
+log = get_logger(__name__)
 
 # --- Agent Prompt ---
 # This prompt template is used to instruct the agent on how to behave.
@@ -14,36 +33,424 @@ agent_prompt = ChatPromptTemplate.from_messages(
         1.  **Default to Displaying Data**: For any request to "get", "show", "find", "view", or "extract" data, you MUST use the `query_database` tool to display the results directly in the chat.
         2.  **Strict Export Condition**: You are ONLY allowed to use the `export_to_excel` tool if the user's message contains the specific words 'export' or 'excel'.
         3.  **Exporting Rule**: When you use the `export_to_excel` tool, you MUST provide the `table_name` argument. You will extract this table name from the SQL query you generate. The tool will handle filename creation automatically. Do NOT attempt to create a filename yourself.
-        4.  **Handle File Paths**: When a tool successfully creates a file (Excel or image), it will return a file path. Your final answer to the user MUST include this full, unmodified file path.
+        4.  **Paging**: `query_database` returns one page of rows plus a summary. When the user asks for more rows or the next page, call `get_next_page` instead of re-running the query.
+        5.  **Files**: A file a tool creates (an export or an image) is attached to your reply automatically. Say in one sentence what it contains; do not write file paths.
+        6.  **Use the Known Schema**: The relevant part of the database schema is listed below. Write SQL against it directly. Only call `get_database_tables` or `describe_table` when a table you need is not listed.
+        7.  **Uploaded Files**: When the conversation says an uploaded file was loaded as a table, answer questions about that file with `query_uploaded_data` (SQLite SQL), never with `query_database`.
+        8.  **Independent Queries**: When a question needs several independent queries (e.g. "compare revenue by region and churn by plan"), send them together in one `query_database_batch` call instead of calling `query_database` repeatedly.
+
+        Database schema (relevant tables):
+        {schema_context}
+
+        Summary of earlier conversation in this thread:
+        {conversation_summary}
         """),
         MessagesPlaceholder(variable_name="messages"),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
     ]
 )
 
-# --- Agent Executor ---
-# This creates the agent executor by combining the LLM, tools, and prompt.
-agent_runnable = create_tool_calling_agent(llm, all_tools, agent_prompt)
-agent_executor = AgentExecutor(agent=agent_runnable, tools=all_tools, verbose=True)
+# --- Agent Model ---
+# One model step of the graph's tool loop: the agent node calls the model, the tool
+# node runs every tool call it returned (independent calls in parallel), and the
+# results go back to the agent node until the model answers without tool calls.
+def _build_agent_model():
+    """Creates the agent runnable by combining the prompt and the tool-calling LLM."""
+    return agent_prompt | get_llm().bind_tools(all_tools)
 
+# Built on the first agent turn (or by the startup pre-warm), not at import time.
+registry.register("agent_model", _build_agent_model)
 
-def agent_node(state: AgentState) -> dict:
+def get_agent_model():
+    return registry.get("agent_model")
+
+def _final_answer_model():
+    """
+    The same prompt with tool calling switched off, used to force an answer once the
+    step limit is reached. The tools stay declared because the history contains their calls.
+    """
+    return agent_prompt | get_llm().bind_tools(all_tools, tool_choice="none")
+
+_TOKEN_LIMIT_MESSAGE = (
+    "I stopped working on this request because it used more than the allowed amount of processing. "
+    "Please ask a narrower question."
+)
+
+# Questions longer than this usually carry pasted file content and are not worth caching.
+_MAX_CACHEABLE_QUESTION_CHARS = 500
+
+# --- Conversation Compaction ---
+# Rough cost of one image part; Gemini bills images at a fixed token count.
+_IMAGE_TOKEN_ESTIMATE = 258
+
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", """Summarize the conversation below for an assistant that answers questions about a MySQL database.
+        Keep table names, column names, filters, time ranges, SQL that worked and any user preferences. Be brief (at most 150 words).
+
+        Existing summary:
+        {summary}
+        """),
+        MessagesPlaceholder(variable_name="messages"),
+    ]
+)
+
+
+def _last_user_text(state: AgentState) -> str:
+    """
+    Returns the text of the most recent human message, ignoring any image parts.
+    """
+    for message in reversed(state["messages"]):
+        if isinstance(message, HumanMessage):
+            if isinstance(message.content, list):
+                return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+            return str(message.content)
+    return ""
+
+
+def _schema_context(state: AgentState) -> str:
+    """
+    Builds the schema slice injected into the agent prompt for the current question.
+    """
+    try:
+        return get_schema_catalog().relevant_slice(_last_user_text(state), max_tables=SCHEMA_PROMPT_MAX_TABLES)
+    except Exception as e:
+        log.error("NODE", f"Could not load schema catalog: {e}")
+        return "Schema unavailable. Use `get_database_tables` to discover tables."
+
+
+def _estimate_tokens(message: BaseMessage) -> int:
+    """
+    Cheap token estimate (~4 characters per token) used for history windowing.
+    """
+    if isinstance(message.content, list):
+        tokens = 0
+        for part in message.content:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                tokens += _IMAGE_TOKEN_ESTIMATE
+            else:
+                tokens += len(str(part.get("text", "") if isinstance(part, dict) else part)) // 4
+        return tokens + 4
+    return len(str(message.content)) // 4 + 4
+
+
+def _split_history(messages: list[BaseMessage], budget: int) -> tuple[list[BaseMessage], list[BaseMessage]]:
+    """
+    Splits history into (older, recent) so that `recent` fits in `budget` tokens.
+    The newest message is always kept, and a tool result is never separated from
+    the call that produced it.
+    """
+    kept_tokens = 0
+    cut = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        kept_tokens += _estimate_tokens(messages[index])
+        if kept_tokens > budget and index < len(messages) - 1:
+            break
+        cut = index
+    while 0 < cut < len(messages) and isinstance(messages[cut], ToolMessage):
+        cut -= 1
+    return messages[:cut], messages[cut:]
+
+
+def _compaction_plan(state: AgentState) -> tuple[list[BaseMessage], list[BaseMessage]] | None:
+    """
+    Returns (older, recent) when the history exceeds the token budget, otherwise None.
+    """
+    messages = state["messages"]
+    if sum(_estimate_tokens(m) for m in messages) <= CONVERSATION_TOKEN_BUDGET:
+        return None
+    # Keep roughly half the budget verbatim so compaction does not run every turn.
+    older, recent = _split_history(messages, CONVERSATION_TOKEN_BUDGET // 2)
+    return (older, recent) if older else None
+
+
+# Every run starts with history compaction, which also empties the previous run's artifacts.
+_NEW_RUN = {"artifacts": None}
+
+
+def _compaction_update(state: AgentState, older: list[BaseMessage], summary: str) -> dict:
+    log.info("NODE", f"Compacted {len(older)} older messages into the conversation summary.")
+    return {**_NEW_RUN, "summary": summary, "messages": [RemoveMessage(id=m.id) for m in older]}
+
+
+def compact_history_node(state: AgentState) -> dict:
+    """
+    Keeps the thread's history within the token budget by summarizing older turns.
+    """
+    plan = _compaction_plan(state)
+    if plan is None:
+        return _NEW_RUN
+    older, _ = plan
+    log.debug("NODE", "Executing History Compaction Node")
+    with trace("llm.call", model="summary") as span:
+        response = get_llm().invoke(summary_prompt.invoke({"summary": state.get("summary") or "None", "messages": older}))
+        record_llm_usage(span, "summary", response.usage_metadata)
+    return _compaction_update(state, older, str(response.content))
+
+
+async def acompact_history_node(state: AgentState) -> dict:
+    """
+    Async variant of `compact_history_node`.
+    """
+    plan = _compaction_plan(state)
+    if plan is None:
+        return _NEW_RUN
+    older, _ = plan
+    log.debug("NODE", "Executing History Compaction Node (async)")
+    llm = await asyncio.to_thread(get_llm)
+    with trace("llm.call", model="summary") as span:
+        response = await llm.ainvoke(await summary_prompt.ainvoke({"summary": state.get("summary") or "None", "messages": older}))
+        record_llm_usage(span, "summary", response.usage_metadata)
+    return _compaction_update(state, older, str(response.content))
+
+
+def _agent_inputs(state: AgentState, schema_context: str) -> dict:
+    return {
+        "messages": state["messages"],
+        "schema_context": schema_context,
+        "conversation_summary": state.get("summary") or "None",
+    }
+
+
+def _turn_start(state: AgentState) -> int:
+    """
+    Index of the human message that started the current turn; the model and tool
+    messages of this turn's tool loop follow it.
+    """
+    messages = state["messages"]
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], HumanMessage):
+            return index
+    return 0
+
+
+def _turn_messages(state: AgentState) -> list[BaseMessage]:
+    return state["messages"][_turn_start(state) + 1:]
+
+
+def _step_limit_reached(turn: list[BaseMessage]) -> str | None:
+    """
+    Returns "iterations" when the next model call is the turn's last allowed one, or
+    "tokens" when the turn has used up its token budget.
+    Token usage comes from the model's usage metadata, estimated when it is missing.
+    """
+    model_steps = [m for m in turn if isinstance(m, AIMessage)]
+    used_tokens = sum(
+        (m.usage_metadata or {}).get("total_tokens") or _estimate_tokens(m) for m in model_steps
+    )
+    if used_tokens >= AGENT_MAX_TOKENS_PER_REQUEST:
+        return "tokens"
+    if len(model_steps) >= AGENT_MAX_ITERATIONS - 1:
+        return "iterations"
+    return None
+
+
+def _cacheable_question(state: AgentState) -> str | None:
+    """
+    Returns the question text if the current turn is a short, text-only question
+    that starts a conversation. Follow-ups depend on earlier turns and are never cached.
+    """
+    if _turn_start(state) > 0 or state.get("summary"):
+        return None
+    first_message = state["messages"][0]
+    if not isinstance(first_message, HumanMessage) or not isinstance(first_message.content, str):
+        return None
+    question = first_message.content.strip()
+    return question if 0 < len(question) <= _MAX_CACHEABLE_QUESTION_CHARS else None
+
+
+def _cached_sql_for(question: str | None) -> str | None:
+    if question is None:
+        return None
+    sql = get_query_cache().get_sql(question, get_schema_catalog().version)
+    if sql:
+        log.info("QUERY_CACHE", "Question cache hit, reusing its SQL.")
+        log.debug("QUERY_CACHE", "Cached SQL", sql=sql)
+    return sql
+
+
+def _remember_sql(question: str | None, turn: list[BaseMessage]) -> None:
+    """
+    Caches question -> SQL when the agent answered with exactly one successful `query_database` call.
+    """
+    if question is None:
+        return
+    tool_calls = [call for m in turn if isinstance(m, AIMessage) for call in m.tool_calls]
+    results = [m for m in turn if isinstance(m, ToolMessage)]
+    if len(tool_calls) != 1 or len(results) != 1:
+        return
+    call, result = tool_calls[0], results[0]
+    if call["name"] != query_database.name or str(result.content).startswith("Error"):
+        return
+    sql = call["args"].get("query")
+    if sql:
+        get_query_cache().put_sql(question, get_schema_catalog().version, sql)
+
+
+def _agent_step_result(state: AgentState, turn: list[BaseMessage], response: AIMessage) -> dict:
+    if response.tool_calls:
+        log.info("NODE", f"Agent requested {len(response.tool_calls)} tool call(s): "
+                 f"{', '.join(call['name'] for call in response.tool_calls)}")
+    else:
+        _remember_sql(_cacheable_question(state), turn)
+    return {"messages": [response]}
+
+
+def _chunk_text(chunk: BaseMessage) -> str:
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(part.get("text", "") for part in chunk.content if isinstance(part, dict) and part.get("type") == "text")
+
+
+def _stream_model(model, inputs: dict, listener) -> AIMessage:
+    """
+    Runs one model step as a stream, handing the text written so far to `listener`
+    after every chunk, and returns the assembled message with its tool calls.
+    """
+    response, text = None, ""
+    for chunk in model.stream(inputs):
+        response = chunk if response is None else response + chunk
+        delta = _chunk_text(chunk)
+        if delta:
+            text += delta
+            listener(text)
+    return message_chunk_to_message(response)
+
+
+async def _astream_model(model, inputs: dict, listener) -> AIMessage:
+    response, text = None, ""
+    async for chunk in model.astream(inputs):
+        response = chunk if response is None else response + chunk
+        delta = _chunk_text(chunk)
+        if delta:
+            text += delta
+            listener(text)
+    return message_chunk_to_message(response)
+
+
+def agent_node(state: AgentState, config: RunnableConfig) -> dict:
     """
     The primary agent node that handles database queries, file Q&A, and general chat.
     """
-    print("--- [NODE] Executing General Agent Node ---")
-    response = agent_executor.invoke(state)
-    return {"messages": [AIMessage(content=response["output"])]}
+    log.debug("NODE", "Executing General Agent Node")
+    bind_request_context(config)
+    turn = _turn_messages(state)
+    if not turn:
+        cached_sql = _cached_sql_for(_cacheable_question(state))
+        if cached_sql:
+            return {"messages": [AIMessage(content=query_database.invoke({"query": cached_sql}))]}
 
+    limit = _step_limit_reached(turn)
+    if limit == "tokens":
+        log.info("NODE", "Token limit for this request reached; stopping.")
+        return {"messages": [AIMessage(content=_TOKEN_LIMIT_MESSAGE)]}
+    model = _final_answer_model() if limit == "iterations" else get_agent_model()
+    if limit:
+        log.info("NODE", f"Step limit ({AGENT_MAX_ITERATIONS}) reached; asking for a final answer.")
+    inputs = _agent_inputs(state, _schema_context(state))
+    # The answer is streamed when the request's Discord reply shows it as it is written.
+    listener = token_streams.listener(get_thread_id())
+    with trace("llm.call", model="agent", step=len(turn), streamed=listener is not None) as span:
+        response = _stream_model(model, inputs, listener) if listener else model.invoke(inputs)
+        record_llm_usage(span, "agent", response.usage_metadata)
+    return _agent_step_result(state, turn, response)
 
-def generate_image_node(state: AgentState) -> dict:
+
+async def aagent_node(state: AgentState, config: RunnableConfig) -> dict:
     """
-A dedicated node that directly calls the image generation tool.
+    Async variant of `agent_node`; LLM and tool calls run natively on the event loop.
+    """
+    log.debug("NODE", "Executing General Agent Node (async)")
+    bind_request_context(config)
+    turn = _turn_messages(state)
+    if not turn:
+        cached_sql = _cached_sql_for(_cacheable_question(state))
+        if cached_sql:
+            return {"messages": [AIMessage(content=await query_database.ainvoke({"query": cached_sql}))]}
+
+    limit = _step_limit_reached(turn)
+    if limit == "tokens":
+        log.info("NODE", "Token limit for this request reached; stopping.")
+        return {"messages": [AIMessage(content=_TOKEN_LIMIT_MESSAGE)]}
+    if limit:
+        log.info("NODE", f"Step limit ({AGENT_MAX_ITERATIONS}) reached; asking for a final answer.")
+    # Building the model (first call) and a catalog refresh can block; keep them off the loop.
+    model = await asyncio.to_thread(_final_answer_model if limit == "iterations" else get_agent_model)
+    schema_context = await asyncio.to_thread(_schema_context, state)
+    inputs = _agent_inputs(state, schema_context)
+    listener = token_streams.listener(get_thread_id())
+    with trace("llm.call", model="agent", step=len(turn), streamed=listener is not None) as span:
+        response = await _astream_model(model, inputs, listener) if listener else await model.ainvoke(inputs)
+        record_llm_usage(span, "agent", response.usage_metadata)
+    return _agent_step_result(state, turn, response)
+
+
+# The agent's single tool loop: ToolNode runs every tool call of one model step, in
+# parallel when the model asks for several independent ones.
+_tool_node = ToolNode(all_tools)
+
+
+def _with_artifacts(update: dict) -> dict:
+    """Adds the files the step's tools returned as artifacts to the state update."""
+    artifacts = [
+        artifact
+        for message in update.get("messages", [])
+        if isinstance(message, ToolMessage) and message.artifact
+        for artifact in message.artifact
+    ]
+    return {**update, "artifacts": artifacts} if artifacts else update
+
+
+def tools_node(state: AgentState, config: RunnableConfig) -> dict:
+    """
+    Runs the tool calls of the agent's last step and collects the files they created.
+    """
+    return _with_artifacts(_tool_node.invoke(state, config))
+
+
+async def atools_node(state: AgentState, config: RunnableConfig) -> dict:
+    """
+    Async variant of `tools_node`.
+    """
+    return _with_artifacts(await _tool_node.ainvoke(state, config))
+
+
+def fast_path_node(state: AgentState, config: RunnableConfig) -> dict:
+    """
+    Answers a trivial intent (list tables, describe a table, count rows) with a single
+    tool call and no LLM round trip.
+    """
+    bind_request_context(config)
+    text, _ = message_text(state["messages"][-1].content)
+    match = get_router().match(text)
+    if match is None:
+        # The schema changed between routing and now; `after_fast_path` hands the question to the agent.
+        return {}
+    log.info("NODE", f"Executing Fast Path: {match.intent.name} -> {match.intent.tool.name}")
+    return {"messages": [AIMessage(content=match.intent.tool.invoke(match.tool_args()))]}
+
+
+async def afast_path_node(state: AgentState, config: RunnableConfig) -> dict:
+    """
+    Async variant of `fast_path_node`.
+    """
+    bind_request_context(config)
+    text, _ = message_text(state["messages"][-1].content)
+    # Resolving the table name may refresh the schema catalog from the DB.
+    match = await asyncio.to_thread(get_router().match, text)
+    if match is None:
+        return {}
+    log.info("NODE", f"Executing Fast Path (async): {match.intent.name} -> {match.intent.tool.name}")
+    return {"messages": [AIMessage(content=await match.intent.tool.ainvoke(match.tool_args()))]}
+
+
+def _extract_image_request(state: AgentState) -> tuple[str, str | None]:
+    """
+    Pulls the text prompt and optional reference image out of the last message.
+    The image's data URI is returned as the same string object, not a copy.
     """
-    print("--- [NODE] Executing Dedicated Image Generation Node ---")
     last_message = state["messages"][-1]
     prompt = ""
-    base64_image_data = None
+    image_data_uri = None
 
     # Multi modal mode
     if isinstance(last_message.content, list):
@@ -53,22 +460,61 @@ A dedicated node that directly calls the image generation tool.
                     prompt = part.get("text", "")
                 elif part.get("type") == "image_url":
                     image_uri = part.get("image_url", {}).get("url", "")
-                    if "base64," in image_uri:
-                        base64_image_data = image_uri.split(',')[-1]
+                    if image_uri.startswith("data:"):
+                        image_data_uri = image_uri
 
     elif isinstance(last_message.content, str):
-        print("--- [NODE] Processing text-only image request. ---")
+        log.info("NODE", "Processing text-only image request.")
         prompt = last_message.content
-    
+
+    return prompt, image_data_uri
+
+
+def _image_tool_call(prompt: str, image_data_uri: str | None) -> dict:
+    """
+    The image tool invoked as a tool call, so it returns a ToolMessage that carries the
+    generated file as its artifact instead of the text alone.
+    """
+    return {
+        "name": generate_image.name,
+        "args": {"prompt": prompt, "image_data_uri": image_data_uri},
+        "id": f"image_{uuid.uuid4().hex}",
+        "type": "tool_call",
+    }
+
+
+_MISSING_PROMPT_MESSAGE = "A text prompt is required to generate an image. For example: 'create a photo of a cat'."
+
+
+def generate_image_node(state: AgentState) -> dict:
+    """
+A dedicated node that directly calls the image generation tool.
+    """
+    log.debug("NODE", "Executing Dedicated Image Generation Node")
+    prompt, image_data_uri = _extract_image_request(state)
+
     if not prompt:
-        error_message = "A text prompt is required to generate an image. For example: 'create a photo of a cat'."
-        print(f"--- [NODE_ERROR] {error_message} ---")
-        return {"messages": [AIMessage(content=error_message)]}
+        log.error("NODE", _MISSING_PROMPT_MESSAGE)
+        return {"messages": [AIMessage(content=_MISSING_PROMPT_MESSAGE)]}
     
-    print(f"--- [NODE] Calling image tool with prompt: '{prompt}' ---")
-    result = generate_image.invoke({
-        "prompt": prompt,
-        "base64_image_data": base64_image_data
-    })
+    log.debug("NODE", "Calling image tool", prompt=prompt)
+    result = generate_image.invoke(_image_tool_call(prompt, image_data_uri))
     
-    return {"messages": [AIMessage(content=result)]}
\ No newline at end of file
+    return {"messages": [AIMessage(content=result.content)], "artifacts": result.artifact or []}
+
+
+async def agenerate_image_node(state: AgentState) -> dict:
+    """
+    Async variant of `generate_image_node`.
+    """
+    log.debug("NODE", "Executing Dedicated Image Generation Node (async)")
+    prompt, image_data_uri = _extract_image_request(state)
+
+    if not prompt:
+        log.error("NODE", _MISSING_PROMPT_MESSAGE)
+        return {"messages": [AIMessage(content=_MISSING_PROMPT_MESSAGE)]}
+
+    log.debug("NODE", "Calling image tool (async)", prompt=prompt)
+    result = await generate_image.ainvoke(_image_tool_call(prompt, image_data_uri))
+
+    return {"messages": [AIMessage(content=result.content)], "artifacts": result.artifact or []}
\ No newline at end of file
@@ -0,0 +1,42 @@
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+# The Discord thread the current graph run belongs to. Nodes bind it from the
+# run's config so tools executed further down the call stack can key per-thread
+# state (e.g. result pagination) without it being threaded through every call.
+current_thread_id: ContextVar[Optional[str]] = ContextVar("current_thread_id", default=None)
+# The named data source (database) the request's guild/channel is routed to; None means the default.
+current_data_source: ContextVar[Optional[str]] = ContextVar("current_data_source", default=None)
+# The Discord guild the request came from, for per-guild usage accounting; None for DMs.
+current_guild_id: ContextVar[Optional[str]] = ContextVar("current_guild_id", default=None)
+
+
+def bind_request_context(config: Optional[Dict[str, Any]]) -> None:
+    """Copies request-scoped values from a LangGraph run config into context variables."""
+    configurable = (config or {}).get("configurable", {})
+    current_thread_id.set(configurable.get("thread_id"))
+    current_data_source.set(configurable.get("data_source"))
+    current_guild_id.set(configurable.get("guild_id"))
+
+
+def _from_run_config(key: str) -> Optional[str]:
+    # Tools run by the graph's ToolNode execute outside the node that bound the
+    # context variables; the run config LangChain propagates to them still has them.
+    from langchain_core.runnables.config import ensure_config
+
+    return ensure_config().get("configurable", {}).get(key)
+
+
+def get_thread_id() -> Optional[str]:
+    thread_id = current_thread_id.get()
+    return thread_id if thread_id is not None else _from_run_config("thread_id")
+
+
+def get_data_source_name() -> Optional[str]:
+    name = current_data_source.get()
+    return name if name is not None else _from_run_config("data_source")
+
+
+def get_guild_id() -> Optional[str]:
+    guild_id = current_guild_id.get()
+    return guild_id if guild_id is not None else _from_run_config("guild_id")
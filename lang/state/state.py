@@ -1,7 +1,15 @@
-from typing import List, TypedDict, Annotated, Dict, Any
+from typing import List, TypedDict, Annotated, Dict, Any, NotRequired, Optional
 from langchain_core.messages import BaseMessage
 from langgraph.graph.message import add_messages
 
+
+def add_artifacts(current: Optional[List[Dict[str, Any]]], update: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Appends the files a step produced; a None update empties the list, which every run does first."""
+    if update is None:
+        return []
+    return (current or []) + update
+
+
 class AgentState(TypedDict):
     """
     Defines the state structure for the agent graph.
@@ -11,5 +19,11 @@ class AgentState(TypedDict):
     Attributes:
         messages: A list of messages in the conversation history. The `add_messages`
                   annotator ensures that new messages are always appended.
+        summary: A running summary of older turns that were compacted out of
+                 `messages` to keep the prompt within the token budget.
+        artifacts: The files (exports, images) the tools produced during the current
+                   run, as `Artifact.as_dict()` entries, for the bot to upload.
     """
-    messages: Annotated[List[BaseMessage], add_messages]
\ No newline at end of file
+    messages: Annotated[List[BaseMessage], add_messages]
+    summary: NotRequired[str]
+    artifacts: Annotated[List[Dict[str, Any]], add_artifacts]
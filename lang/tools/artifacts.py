@@ -0,0 +1,219 @@
+"""
+Files the tools produce for the user (exports, generated images) and the lifecycle of
+the output directory.
+
+A tool that creates a file returns it as an artifact next to its text result
+(LangChain's "content_and_artifact" tools). The graph collects the artifacts of the
+current run into `AgentState["artifacts"]`, so the bot uploads exactly the files that
+were produced, however the model words its answer. `ArtifactStore` prepares a file
+before it is handed out (large CSV exports are zipped) and keeps the output directory
+within its age and size limits.
+"""
+import contextlib
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from telemetry import get_logger, metrics
+
+log = get_logger(__name__)
+
+artifacts_total = metrics.counter(
+    "text2sql_artifacts_total", "Files produced by tools for the user, by kind.", ["kind"]
+)
+artifact_bytes_removed = metrics.counter(
+    "text2sql_artifact_bytes_removed_total", "Bytes deleted from the output directory by garbage collection."
+)
+
+# Types `mimetypes` does not know on every platform.
+_MIME_TYPES = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+    ".parquet": "application/vnd.apache.parquet",
+    ".zip": "application/zip",
+    ".png": "image/png",
+}
+# Only CSV compresses well; XLSX and Parquet files are compressed already.
+_COMPRESSIBLE = (".csv",)
+# Files this recent may still be waiting for their upload, so collection leaves them alone.
+_IN_USE_SECONDS = 600
+
+
+@dataclass
+class Artifact:
+    """A file for the user. Stored in the graph state as a plain dict (`as_dict`)."""
+
+    path: str
+    filename: str
+    mime_type: str
+    size: int
+    kind: str
+
+    def as_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Artifact":
+        return cls(**data)
+
+
+def mime_type_for(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    return _MIME_TYPES.get(extension) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+class ArtifactStore:
+    """
+    Registers the files tools write and garbage-collects the output directory.
+
+    `register` zips a CSV export of at least `compress_min_bytes` (0 disables it) and
+    describes the file as an `Artifact`. `collect` deletes files directly in `directory`
+    that are older than `max_age_seconds`, then the oldest ones until the rest fit in
+    `max_bytes`; files written in the last ten minutes are kept. Subdirectories (such as
+    the image cache, which has its own limit) are not touched. `register` starts a
+    collection in the background at most once per `gc_interval` seconds.
+    """
+
+    def __init__(self, directory: str, max_age_seconds: float, max_bytes: int,
+                 compress_min_bytes: int = 0, gc_interval: float = 300.0):
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.compress_min_bytes = compress_min_bytes
+        self.gc_interval = gc_interval
+        self._lock = threading.Lock()
+        self._collecting = False
+        self._last_collect = 0.0
+        self._counts = {"registered": 0, "compressed": 0, "removed": 0, "bytes_removed": 0}
+
+    def register(self, path: str, kind: str, filename: Optional[str] = None) -> Artifact:
+        """
+        Describes a finished file for upload, under `filename` if given; may replace a large
+        CSV export with a zip of it.
+        """
+        size = os.path.getsize(path)
+        if (kind == "export" and self.compress_min_bytes and size >= self.compress_min_bytes
+                and path.lower().endswith(_COMPRESSIBLE)):
+            path, size = self._compress(path, size)
+        artifact = Artifact(path=path, filename=filename or os.path.basename(path), mime_type=mime_type_for(path), size=size, kind=kind)
+        with self._lock:
+            self._counts["registered"] += 1
+        artifacts_total.inc(kind=kind)
+        self._maybe_collect()
+        return artifact
+
+    def _compress(self, path: str, size: int) -> Tuple[str, int]:
+        started = time.perf_counter()
+        zip_path = f"{os.path.splitext(path)[0]}.zip"
+        if os.path.exists(zip_path):
+            # Never replace another file's zip; the export's own name is unique.
+            zip_path = f"{path}.zip"
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".zip.tmp")
+        try:
+            with os.fdopen(fd, "wb") as handle, zipfile.ZipFile(
+                    handle, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+                archive.write(path, arcname=os.path.basename(path))
+            os.replace(tmp_path, zip_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        os.remove(path)
+        compressed = os.path.getsize(zip_path)
+        with self._lock:
+            self._counts["compressed"] += 1
+        log.info("ARTIFACTS", f"Zipped {os.path.basename(path)} in {time.perf_counter() - started:.2f}s",
+                 bytes_before=size, bytes_after=compressed)
+        return zip_path, compressed
+
+    def _maybe_collect(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self._collecting or now - self._last_collect < self.gc_interval:
+                return
+            self._collecting = True
+            self._last_collect = now
+        threading.Thread(target=self._collect_in_background, name="artifact-gc", daemon=True).start()
+
+    def _collect_in_background(self) -> None:
+        try:
+            self.collect()
+        except Exception as e:
+            log.error("ARTIFACTS", f"Garbage collection failed: {e}")
+        finally:
+            with self._lock:
+                self._collecting = False
+
+    def collect(self) -> int:
+        """Deletes expired files, then the oldest ones beyond the size limit. Returns how many were removed."""
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except FileNotFoundError:
+            return 0
+        now = time.time()
+        files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries)
+        total = sum(size for _, size, _ in files)
+        removed = removed_bytes = 0
+        for mtime, size, path in files:
+            age = now - mtime
+            expired = self.max_age_seconds and age > self.max_age_seconds
+            if not expired and (not self.max_bytes or total <= self.max_bytes):
+                continue
+            if age < _IN_USE_SECONDS:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+        if removed:
+            with self._lock:
+                self._counts["removed"] += removed
+                self._counts["bytes_removed"] += removed_bytes
+            artifact_bytes_removed.inc(removed_bytes)
+            log.info("ARTIFACTS", f"Removed {removed} old file(s) from {self.directory}", bytes=removed_bytes, remaining=total)
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counts)
+
+
+def artifacts_from_state(state: Dict[str, Any]) -> List[Artifact]:
+    """The files produced during the run that ended in `state`."""
+    return [Artifact.from_dict(data) for data in state.get("artifacts") or []]
+
+
+_artifact_store: Optional[ArtifactStore] = None
+_artifact_store_lock = threading.Lock()
+
+
+def get_artifact_store() -> ArtifactStore:
+    """Returns the process-wide artifact store, creating it on first use."""
+    global _artifact_store
+    if _artifact_store is None:
+        with _artifact_store_lock:
+            if _artifact_store is None:
+                _artifact_store = ArtifactStore(
+                    config.OUTPUT_DIR,
+                    max_age_seconds=config.ARTIFACT_MAX_AGE_HOURS * 3600,
+                    max_bytes=config.ARTIFACT_MAX_MB * 1024 * 1024,
+                    compress_min_bytes=int(config.ARTIFACT_COMPRESS_MIN_MB * 1024 * 1024),
+                    gc_interval=config.ARTIFACT_GC_INTERVAL,
+                )
+    return _artifact_store
+
+
+def set_artifact_store(store: Optional[ArtifactStore]) -> None:
+    """Replaces the process-wide store; None rebuilds it from config."""
+    global _artifact_store
+    with _artifact_store_lock:
+        _artifact_store = store
@@ -1,56 +1,460 @@
+import io
 import os
+import csv
+import json
+import time
 import base64
-import pandas as pd
-import PyPDF2
-from typing import Dict, Any, Literal
+import hashlib
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Literal, Optional, Sequence, Union
 
-def process_uploaded_file(file_path: str) -> Dict[str, Any]:
+from config import (
+    ATTACHMENT_MAX_BYTES,
+    ATTACHMENT_SPOOL_BYTES,
+    INGEST_CACHE_DIR,
+    INGEST_CACHE_MAX_MB,
+    INGEST_INLINE_MAX_BYTES,
+    INGEST_MAX_TEXT_CHARS,
+    INGEST_SAMPLE_ROWS,
+    INGEST_STATS_MAX_ROWS,
+    PDF_MAX_PAGES,
+    UPLOAD_DIR,
+)
+from lang.db.upload_store import TABULAR_EXTENSIONS, get_upload_store
+from telemetry import get_logger, trace
+
+log = get_logger(__name__)
+
+_HASH_CHUNK_BYTES = 1024 * 1024
+_MAX_DISTINCT_TRACKED = 50
+# Bump when the parsed output format changes so stale cache entries are ignored.
+_CACHE_FORMAT_VERSION = 1
+_IMAGE_MIME_TYPES = {'.png': "image/png", '.jpg': "image/jpeg", '.jpeg': "image/jpeg"}
+
+
+@contextmanager
+def _timed(step: str) -> Iterator[None]:
+    started = time.perf_counter()
+    # "CSV table load" -> span "file.load", "Content hashing" -> "file.hashing".
+    try:
+        with trace(f"file.{step.split()[-1].lower()}", step=step):
+            yield
+    finally:
+        log.info("FILE_PROCESSOR", f"{step} took {time.perf_counter() - started:.3f}s")
+
+
+# --- Uploads ---
+
+class AttachmentTooLargeError(Exception):
+    """Raised when an attachment is larger than `ATTACHMENT_MAX_BYTES`."""
+
+    def __init__(self, filename: str, size: int, limit: int):
+        super().__init__(f"'{filename}' is {size:,} bytes; the limit is {limit:,}")
+        self.filename = filename
+        self.size = size
+        self.limit = limit
+
+
+@dataclass
+class Upload:
+    """
+    An uploaded file's bytes, held in memory or, when large, in a uniquely named file
+    under `UPLOAD_DIR`. Parsers read it through `open()`; `discard()` deletes a file
+    the upload owns.
+    """
+
+    filename: str
+    data: Optional[bytes] = None
+    path: Optional[str] = None
+    owns_path: bool = False
+
+    @classmethod
+    def from_path(cls, file_path: str) -> "Upload":
+        return cls(os.path.basename(file_path), path=file_path)
+
+    @property
+    def extension(self) -> str:
+        return os.path.splitext(self.filename.lower())[1]
+
+    @property
+    def is_image(self) -> bool:
+        return self.extension in _IMAGE_MIME_TYPES
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def open(self) -> BinaryIO:
+        # BytesIO shares the bytes object's buffer until written to, so this does not copy.
+        return io.BytesIO(self.data) if self.data is not None else open(self.path, "rb")
+
+    def discard(self) -> None:
+        if self.owns_path and self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+async def read_attachment(attachment: Any) -> Upload:
+    """
+    Downloads a Discord attachment. Files up to `ATTACHMENT_SPOOL_BYTES` stay in memory;
+    larger ones are written to a unique file, so concurrent uploads with the same name
+    never overwrite each other. The caller discards the upload once it is processed.
+    """
+    if attachment.size > ATTACHMENT_MAX_BYTES:
+        raise AttachmentTooLargeError(attachment.filename, attachment.size, ATTACHMENT_MAX_BYTES)
+    if attachment.size <= ATTACHMENT_SPOOL_BYTES:
+        return Upload(attachment.filename, data=await attachment.read())
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    suffix = "".join(c for c in os.path.splitext(attachment.filename.lower())[1] if c.isalnum() or c == ".")
+    fd, path = tempfile.mkstemp(prefix="upload_", suffix=suffix, dir=UPLOAD_DIR)
+    os.close(fd)
+    upload = Upload(attachment.filename, path=path, owns_path=True)
+    try:
+        await attachment.save(path)
+    except BaseException:
+        upload.discard()
+        raise
+    return upload
+
+
+def remove_spooled_uploads() -> int:
+    """Deletes upload files left behind by a previous run (e.g. after a crash) and returns how many."""
+    removed = 0
+    if os.path.isdir(UPLOAD_DIR):
+        for name in os.listdir(UPLOAD_DIR):
+            if name.startswith("upload_"):
+                try:
+                    os.remove(os.path.join(UPLOAD_DIR, name))
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def _content_sha256(upload: Upload) -> str:
+    if upload.data is not None:
+        return hashlib.sha256(upload.data).hexdigest()
+    digest = hashlib.sha256()
+    with upload.open() as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _image_data_uri(upload: Upload) -> str:
+    """Encodes an image once, as the data URI the model message carries through the graph."""
+    with upload.open() as f:
+        encoded = base64.b64encode(f.read()).decode("ascii")
+    return f"data:{_IMAGE_MIME_TYPES[upload.extension]};base64,{encoded}"
+
+
+# --- Parsed-Content Cache ---
+
+def _cache_path(content_hash: str, extension: str) -> str:
+    # Settings that change the parsed output are part of the key.
+    settings = f"{_CACHE_FORMAT_VERSION}:{INGEST_INLINE_MAX_BYTES}:{INGEST_SAMPLE_ROWS}:{INGEST_MAX_TEXT_CHARS}:{PDF_MAX_PAGES}:{INGEST_STATS_MAX_ROWS}"
+    key = hashlib.sha256(f"{content_hash}{extension}:{settings}".encode("utf-8")).hexdigest()
+    return os.path.join(INGEST_CACHE_DIR, f"{key}.json")
+
+
+_cache_evict_lock = threading.Lock()
+
+
+def _load_cached(path: str) -> Optional[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            body = json.load(f)["body"]
+        # The modification time doubles as the last-used time for eviction.
+        os.utime(path)
+        return body
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _store_cached(path: str, body: str) -> None:
+    """Caches parsed content; a failure only costs the next upload a re-parse."""
+    # Write-then-rename so concurrent readers never see a partial entry; the temporary
+    # name is unique so concurrent ingests of the same file do not collide.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"body": body}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("FILE_PROCESSOR", f"Could not write the parsed-content cache: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+    try:
+        _evict_cached(keep=path)
+    except OSError as e:
+        log.warning("FILE_PROCESSOR", f"Could not trim the parsed-content cache: {e}")
+
+
+def _evict_cached(keep: str) -> None:
+    """Deletes least recently used entries until the cache fits in `INGEST_CACHE_MAX_MB`."""
+    max_bytes = INGEST_CACHE_MAX_MB * 1024 * 1024
+    with _cache_evict_lock:
+        entries = []
+        for entry in os.scandir(os.path.dirname(keep)):
+            if entry.name.endswith(".json") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+# --- Tabular Summaries ---
+
+class _ColumnStats:
+    """Running statistics for one column, updated one value at a time."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.numeric = 0
+        self.minimum: Optional[float] = None
+        self.maximum: Optional[float] = None
+        self.total = 0.0
+        self.distinct: set = set()
+        self.distinct_overflow = False
+
+    def add(self, value: Any) -> None:
+        self.count += 1
+        if value is None or value == "":
+            self.nulls += 1
+            return
+        number = _as_number(value)
+        if number is not None:
+            self.numeric += 1
+            self.total += number
+            self.minimum = number if self.minimum is None else min(self.minimum, number)
+            self.maximum = number if self.maximum is None else max(self.maximum, number)
+        if not self.distinct_overflow:
+            self.distinct.add(value)
+            if len(self.distinct) > _MAX_DISTINCT_TRACKED:
+                self.distinct_overflow = True
+                self.distinct.clear()
+
+    def render(self) -> str:
+        non_null = self.count - self.nulls
+        distinct = f"{_MAX_DISTINCT_TRACKED}+" if self.distinct_overflow else str(len(self.distinct))
+        if non_null and self.numeric == non_null:
+            mean = self.total / self.numeric
+            return f"- {self.name}: numeric, min {self.minimum:g}, max {self.maximum:g}, mean {mean:,.2f}, nulls {self.nulls}"
+        return f"- {self.name}: text, {distinct} distinct values, nulls {self.nulls}"
+
+
+def _as_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace(",", ""))
+        except ValueError:
+            return None
+    return None
+
+
+def summarize_rows(label: str, header: Sequence[str], rows: Iterable[Sequence[Any]]) -> str:
+    """
+    Consumes rows once and renders schema, per-column stats and the first rows.
+    Stats stop after `INGEST_STATS_MAX_ROWS` rows; rows beyond that are only counted.
+    """
+    columns = [str(c) if c is not None else f"column_{i + 1}" for i, c in enumerate(header)]
+    stats = [_ColumnStats(c) for c in columns]
+    head: List[Sequence[Any]] = []
+    row_count = 0
+    for row in rows:
+        row_count += 1
+        if len(head) < INGEST_SAMPLE_ROWS:
+            head.append(row)
+        if row_count <= INGEST_STATS_MAX_ROWS:
+            for column_stats, value in zip(stats, row):
+                column_stats.add(value)
+
+    scope = "all rows" if row_count <= INGEST_STATS_MAX_ROWS else f"the first {INGEST_STATS_MAX_ROWS:,} rows"
+    lines = [f"{label}: {row_count:,} rows x {len(columns)} columns (stats over {scope})", "Columns:"]
+    lines.extend(s.render() for s in stats)
+    lines.append(f"First {len(head)} rows:")
+    lines.append(",".join(columns))
+    lines.extend(",".join("" if v is None else str(v) for v in row) for row in head)
+    return "\n".join(lines)
+
+
+# --- Format Readers ---
+
+def _text_stream(upload: Upload, **kwargs: Any) -> io.TextIOWrapper:
+    return io.TextIOWrapper(upload.open(), encoding="utf-8", errors="replace", **kwargs)
+
+
+def _read_text(upload: Upload) -> str:
+    """Reads at most `INGEST_MAX_TEXT_CHARS` characters, noting any truncation."""
+    with _text_stream(upload) as f:
+        content = f.read(INGEST_MAX_TEXT_CHARS)
+        truncated = bool(f.read(1))
+    if truncated:
+        content += f"\n\n[Truncated after {INGEST_MAX_TEXT_CHARS:,} characters.]"
+    return content
+
+
+def _read_csv(upload: Upload) -> str:
+    if upload.size <= INGEST_INLINE_MAX_BYTES:
+        # Small files are cheaper to pass through verbatim than to summarize.
+        return _read_text(upload)
+    with _text_stream(upload, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return summarize_rows("Summary of a large CSV file", header, reader)
+
+
+def _read_xlsx(upload: Upload) -> str:
+    from openpyxl import load_workbook
+
+    # read_only mode streams rows from the sheet XML instead of building the workbook in memory.
+    workbook = load_workbook(upload.open(), read_only=True, data_only=True)
+    try:
+        sections = []
+        for sheet in workbook.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, ())
+            sections.append(summarize_rows(f"Sheet '{sheet.title}'", header, rows))
+        return "\n\n".join(sections)
+    finally:
+        workbook.close()
+
+
+def _read_pdf(upload: Upload, first_page: int = 0, max_pages: int = PDF_MAX_PAGES) -> str:
+    """Extracts text from a page range only; pages are parsed lazily by PyPDF2."""
+    import PyPDF2
+
+    with upload.open() as f:
+        reader = PyPDF2.PdfReader(f)
+        total_pages = len(reader.pages)
+        last_page = min(total_pages, first_page + max_pages)
+        pdf_content = [reader.pages[i].extract_text() or "" for i in range(first_page, last_page)]
+    content = "\n".join(pdf_content)
+    if last_page < total_pages:
+        content += f"\n\n[Showing pages {first_page + 1}-{last_page} of {total_pages}.]"
+    return content
+
+
+_TEXT_READERS = {
+    '.txt': ("Text", _read_text),
+    '.csv': ("CSV", _read_csv),
+    '.pdf': ("PDF", _read_pdf),
+    '.xlsx': ("Excel", _read_xlsx),
+}
+
+
+def _load_as_table(upload: Upload, thread_id: str, label: str) -> str:
+    """Bulk-loads a tabular upload into the thread's SQL store and describes it for the agent."""
+    store = get_upload_store()
+    with _timed(f"{label} table load"), upload.open() as stream:
+        table = store.load_file(thread_id, upload.filename, stream)
+    return (
+        f"{label} file '{upload.filename}' was loaded as the table `{table.name}`. "
+        "Answer questions about it with the `query_uploaded_data` tool (SQLite SQL).\n\n"
+        f"Uploaded tables in this conversation:\n{store.describe(thread_id)}"
+    )
+
+
+def process_uploaded_file(upload: Union[Upload, str], thread_id: Optional[str] = None) -> Dict[str, Any]:
     """
     Processes an uploaded file, extracts its content, and determines its type.
 
+    The upload is parsed from memory when it is held there; a path is read from disk.
+    With a `thread_id`, CSV/XLSX files are loaded into that thread's SQL store and
+    only their schema is returned. Otherwise large files are summarized rather than
+    pasted whole: tabular files become a schema, per-column stats and the first
+    rows; PDFs are limited to a page range. Parsed output is cached on disk by
+    content hash, so re-uploads are free.
+
     Args:
-        file_path (str): The local path to the downloaded file.
+        upload (Upload | str): The attachment, or the local path of a downloaded file.
+        thread_id (str, optional): The conversation thread the upload belongs to.
 
     Returns:
         A dictionary containing the content type ('text' or 'image') and the
-        extracted content.
+        extracted content. For images the content is a data URI, ready to be
+        placed in the model message as is.
     """
-    print(f"--- [FILE_PROCESSOR] Processing file: {file_path} ---")
-    _, extension = os.path.splitext(file_path.lower())
-    
-    content: Any = ""
+    if isinstance(upload, str):
+        upload = Upload.from_path(upload)
+    log.info("FILE_PROCESSOR", f"Processing file: {upload.filename}", bytes=upload.size, in_memory=upload.data is not None)
+    extension = upload.extension
+    filename = upload.filename
     content_type: Literal["text", "image"] = "text"
 
     try:
-        if extension in ['.txt', '.csv']:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            if extension == '.csv':
-                content = f"CSV Content from '{os.path.basename(file_path)}':\n\n{content}"
-            
-        elif extension == '.pdf':
-            pdf_content = []
-            with open(file_path, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                for page in reader.pages:
-                    pdf_content.append(page.extract_text())
-            content = f"PDF Content from '{os.path.basename(file_path)}':\n\n" + "\n".join(pdf_content)
-            
-        elif extension == '.xlsx':
-            df = pd.read_excel(file_path)
-            content = f"Excel Content from '{os.path.basename(file_path)}':\n\n{df.to_string()}"
-            
-        elif extension in ['.png', '.jpg', '.jpeg']:
+        if upload.is_image:
             content_type = "image"
-            with open(file_path, "rb") as image_file:
-                content = base64.b64encode(image_file.read()).decode('utf-8')
-            print("--- [FILE_PROCESSOR] Successfully encoded image to base64. ---")
-            
-        else:
+            with _timed("Image encoding"):
+                content = _image_data_uri(upload)
+            log.info("FILE_PROCESSOR", "Successfully encoded image to base64.")
+            return {"type": content_type, "content": content}
+
+        if extension not in _TEXT_READERS:
             return {"type": "text", "content": f"Unsupported file type: '{extension}'"}
 
-        return {"type": content_type, "content": content}
+        label, reader = _TEXT_READERS[extension]
+        if thread_id and extension in TABULAR_EXTENSIONS:
+            try:
+                return {"type": content_type, "content": _load_as_table(upload, thread_id, label)}
+            except Exception as e:
+                # Fall back to a text summary; the agent can still answer from it.
+                log.error("FILE_PROCESSOR", f"Table load failed for {filename}, summarizing instead: {e}")
+
+        with _timed("Content hashing"):
+            cache_path = _cache_path(_content_sha256(upload), extension)
+        body = _load_cached(cache_path)
+        if body is not None:
+            log.info("FILE_PROCESSOR", "Parsed-content cache hit.")
+        else:
+            with _timed(f"{label} parsing"):
+                body = reader(upload)
+            _store_cached(cache_path, body)
+
+        if extension == '.txt':
+            return {"type": content_type, "content": body}
+        return {"type": content_type, "content": f"{label} Content from '{filename}':\n\n{body}"}
 
     except Exception as e:
-        print(f"--- [FILE_PROCESSOR_ERROR] Failed to process file {file_path}: {e} ---")
-        return {"type": "text", "content": f"Error reading file {os.path.basename(file_path)}: {e}"}
\ No newline at end of file
+        log.error("FILE_PROCESSOR", f"Failed to process file {filename}: {e}")
+        return {"type": "text", "content": f"Error reading file {filename}: {e}"}
+
+
+def user_content(user_message: str, processed_file: Dict[str, Any]) -> Union[str, List[Dict[str, Any]]]:
+    """
+    The content of the model message for a question asked with a processed upload:
+    text and image parts for an image, the question after the file's text otherwise.
+    """
+    if processed_file["type"] == "image":
+        # The data URI is built once and passed along by reference from here on.
+        return [
+            {"type": "text", "text": user_message},
+            {"type": "image_url", "image_url": {"url": processed_file["content"]}},
+        ]
+    return f"File Content:\n{processed_file['content']}\n\n---\n\nUser Question: {user_message}"
@@ -0,0 +1,376 @@
+import asyncio
+import base64
+import contextvars
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import config
+from lang.state.context import get_thread_id
+from telemetry import get_logger, metrics, record_llm_usage, trace
+
+log = get_logger(__name__)
+
+image_jobs_total = metrics.counter(
+    "text2sql_image_jobs_total", "Image generation requests by outcome.", ["outcome"]
+)
+
+
+class ImageQueueFullError(Exception):
+    """Raised when `max_pending` image jobs are already waiting for a worker."""
+
+
+# --- Model Messages ---
+
+def build_image_request(prompt: str, image_data_uri: Optional[str] = None) -> HumanMessage:
+    """
+    Builds the multimodal message sent to the image model. The reference image's data URI
+    is used as is, so the upload's encoded bytes are not copied again.
+    """
+    content: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+    if image_data_uri:
+        log.debug("IMAGE_TOOL", "Attaching existing image for modification.")
+        if not image_data_uri.startswith("data:"):
+            # Bare base64 (e.g. from a tool call the model wrote itself).
+            image_data_uri = f"data:image/jpeg;base64,{image_data_uri}"
+        content.append({"type": "image_url", "image_url": {"url": image_data_uri}})
+    return HumanMessage(content=content)
+
+
+def _image_base64_from_response(response_message: AIMessage) -> Optional[str]:
+    """Extracts the base64 encoded image data from an AIMessage."""
+    if not isinstance(response_message.content, list):
+        return None
+    for part in response_message.content:
+        if isinstance(part, dict) and "image_url" in part:
+            image_uri = part["image_url"].get("url")
+            if image_uri and isinstance(image_uri, str):
+                return image_uri.partition(",")[2] or image_uri
+    return None
+
+
+# --- Reference Images ---
+
+_pillow_missing_logged = False
+
+
+def prepare_reference_image(image_data_uri: str, max_side: int, quality: int) -> str:
+    """
+    Downscales a reference image to at most `max_side` pixels on its longer side and
+    re-encodes it (JPEG at `quality`, or PNG when it has transparency), keeping the
+    original when that is not smaller. Needs Pillow; without it the image is sent as is.
+    """
+    global _pillow_missing_logged
+    if not image_data_uri.startswith("data:"):
+        return image_data_uri
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_missing_logged:
+            _pillow_missing_logged = True
+            log.warning("IMAGE_TOOL", "Pillow is not installed; reference images are sent without resizing.")
+        return image_data_uri
+
+    raw = base64.b64decode(image_data_uri.partition(",")[2])
+    with Image.open(io.BytesIO(raw)) as image:
+        original_size = image.size
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image.thumbnail((max_side, max_side))
+        resized = image.size != original_size
+        output = io.BytesIO()
+        if has_alpha:
+            image.save(output, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+    if output.tell() >= len(raw) and not resized:
+        return image_data_uri
+    log.info(
+        "IMAGE_TOOL", "Prepared reference image",
+        original=f"{original_size[0]}x{original_size[1]}", sent=f"{image.size[0]}x{image.size[1]}",
+        bytes_before=len(raw), bytes_after=output.tell(),
+    )
+    return f"data:{mime_type};base64,{base64.b64encode(output.getbuffer()).decode('ascii')}"
+
+
+# --- Result Cache ---
+
+class ImageCache:
+    """
+    Generated images stored under their job key, so an identical request (same prompt,
+    same reference image) is answered from disk. Least recently used files are deleted
+    once the directory grows past `max_bytes`; with `max_bytes=0` nothing is reused
+    and every result gets a unique file name.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            # The modification time doubles as the last-used time for eviction.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key) if self.enabled else self._path(f"{key[:16]}_{uuid.uuid4().hex[:12]}")
+        # Write-then-rename so a concurrent reader never sends a partial image.
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self.enabled:
+            self._evict(keep=path)
+        return path
+
+    def _path(self, name: str) -> str:
+        return os.path.abspath(os.path.join(self.directory, f"{name}.png"))
+
+    def _evict(self, keep: str) -> None:
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".png") and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if os.path.abspath(path) == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+# --- Job Queue ---
+
+def image_job_key(prompt: str, image_data_uri: Optional[str]) -> str:
+    """Content address of a request: the image model, the prompt and a hash of the reference image."""
+    reference = hashlib.sha256(image_data_uri.encode("utf-8")).hexdigest() if image_data_uri else ""
+    normalized_prompt = " ".join(prompt.split())
+    return hashlib.sha256(f"{config.IMAGE_MODEL_NAME}\0{normalized_prompt}\0{reference}".encode("utf-8")).hexdigest()
+
+
+class _Job:
+    def __init__(self, key: str, prompt: str, image_data_uri: Optional[str]):
+        self.key = key
+        self.prompt = prompt
+        self.image_data_uri = image_data_uri
+        self.future: Future = Future()
+        self.thread_ids: Set[str] = set()
+        self.enqueued_at = time.monotonic()
+
+
+class ImageJobQueue:
+    """
+    Runs image generations on a dedicated, bounded pool of worker threads.
+
+    Image calls take many seconds; giving them their own workers keeps them from
+    occupying the threads that serve SQL traffic. At most `max_pending` jobs wait for
+    a worker; beyond that new jobs are refused. Identical requests are answered from
+    the `ImageCache`, and one that arrives while the same job is still running waits
+    for that job instead of starting another. Progress (queue position, generating,
+    reused) is reported to the listener watching the job's thread.
+    """
+
+    def __init__(self, cache: ImageCache, max_workers: int = 2, max_pending: int = 20,
+                 reference_max_side: int = 1024, reference_quality: int = 85):
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.reference_max_side = reference_max_side
+        self.reference_quality = reference_quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-job")
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _Job] = {}
+        self._waiting: "OrderedDict[str, _Job]" = OrderedDict()
+        self._listeners: Dict[str, Callable[[str], None]] = {}
+        self._running = 0
+        self._counts = {"generated": 0, "cache_hits": 0, "joined": 0, "rejected": 0, "failed": 0}
+
+    # --- Progress ---
+
+    def watch(self, thread_id: str, listener: Callable[[str], None]) -> None:
+        """Sends progress messages for jobs started from `thread_id` to `listener` (called from any thread)."""
+        with self._lock:
+            self._listeners[thread_id] = listener
+
+    def unwatch(self, thread_id: str) -> None:
+        with self._lock:
+            self._listeners.pop(thread_id, None)
+
+    def _notify(self, job: _Job, text: str, thread_id: Optional[str] = None) -> None:
+        """Reports to every thread waiting on `job`, or only to `thread_id` when given."""
+        with self._lock:
+            thread_ids = [thread_id] if thread_id else list(job.thread_ids)
+            listeners = [self._listeners[t] for t in thread_ids if t in self._listeners]
+        for listener in listeners:
+            try:
+                listener(text)
+            except Exception as e:
+                log.warning("IMAGE_JOBS", f"Progress listener failed: {e}")
+
+    # --- Submission ---
+
+    def submit(self, prompt: str, image_data_uri: Optional[str] = None) -> Future:
+        """
+        Queues a generation and returns a future for the saved image's path. Raises
+        `ImageQueueFullError` when the queue is full.
+        """
+        key = image_job_key(prompt, image_data_uri)
+        thread_id = get_thread_id()
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._count("cache_hits", "cache_hit")
+            log.info("IMAGE_JOBS", "Reusing a cached image", key=key[:12])
+            future: Future = Future()
+            future.set_result(cached)
+            return future
+
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is not None:
+                if thread_id:
+                    job.thread_ids.add(thread_id)
+                joined = True
+            else:
+                if len(self._waiting) >= self.max_pending:
+                    self._counts["rejected"] += 1
+                    image_jobs_total.inc(outcome="rejected")
+                    raise ImageQueueFullError(f"{len(self._waiting)} image jobs are already waiting")
+                job = self._inflight[key] = _Job(key, prompt, image_data_uri)
+                if thread_id:
+                    job.thread_ids.add(thread_id)
+                self._waiting[key] = job
+                position = len(self._waiting) - max(0, self.max_workers - self._running)
+                joined = False
+        if joined:
+            self._count("joined", "joined")
+            if thread_id:
+                self._notify(job, "An identical image is already being generated; waiting for it...", thread_id)
+            return job.future
+        if position > 0:
+            self._notify(job, f"Your image is number {position} in the image queue...")
+        # The worker runs in the submitter's context, so its spans join that request's trace.
+        self._executor.submit(contextvars.copy_context().run, self._work, job)
+        return job.future
+
+    def run(self, prompt: str, image_data_uri: Optional[str] = None) -> str:
+        """Generates (or reuses) an image and blocks until its path is available."""
+        return self.submit(prompt, image_data_uri).result()
+
+    async def arun(self, prompt: str, image_data_uri: Optional[str] = None) -> str:
+        # Shielded: a cancelled request must not cancel a job other requests are waiting for.
+        return await asyncio.shield(asyncio.wrap_future(self.submit(prompt, image_data_uri)))
+
+    # --- Workers ---
+
+    def _work(self, job: _Job) -> None:
+        with self._lock:
+            self._waiting.pop(job.key, None)
+            self._running += 1
+            still_waiting = list(self._waiting.values())
+            free_workers = max(0, self.max_workers - self._running)
+        # Everyone behind this job moved up one place.
+        for position, waiting in enumerate(still_waiting[free_workers:], start=1):
+            self._notify(waiting, f"Your image is number {position} in the image queue...")
+        self._notify(job, "Generating your image...")
+        try:
+            with trace("image.job", queued_seconds=round(time.monotonic() - job.enqueued_at, 3)):
+                path = self._generate_and_store(job)
+        except BaseException as e:
+            self._count("failed", "failed")
+            job.future.set_exception(e)
+        else:
+            self._count("generated", "generated")
+            job.future.set_result(path)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._inflight.pop(job.key, None)
+
+    def _generate_and_store(self, job: _Job) -> str:
+        reference = job.image_data_uri
+        if reference:
+            try:
+                with trace("image.prepare_reference"):
+                    reference = prepare_reference_image(reference, self.reference_max_side, self.reference_quality)
+            except Exception as e:
+                log.warning("IMAGE_TOOL", f"Could not resize the reference image, sending it as is: {e}")
+        message = build_image_request(job.prompt, reference)
+        with trace("llm.call", model="image") as span:
+            response = config.get_image_llm().invoke([message])
+            record_llm_usage(span, "image", response.usage_metadata)
+        generated = _image_base64_from_response(response)
+        if not generated:
+            raise ValueError("The model did not generate an image.")
+        path = self.cache.put(job.key, base64.b64decode(generated))
+        log.info("IMAGE_TOOL", f"Image saved to {path}")
+        return path
+
+    def _count(self, name: str, outcome: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+        image_jobs_total.inc(outcome=outcome)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "running": self._running,
+                "waiting": len(self._waiting),
+                "max_pending": self.max_pending,
+                **self._counts,
+            }
+
+
+_image_jobs: Optional[ImageJobQueue] = None
+_image_jobs_lock = threading.Lock()
+
+
+def get_image_jobs() -> ImageJobQueue:
+    """Returns the process-wide image job queue, creating it on first use."""
+    global _image_jobs
+    if _image_jobs is None:
+        with _image_jobs_lock:
+            if _image_jobs is None:
+                _image_jobs = ImageJobQueue(
+                    ImageCache(config.IMAGE_CACHE_DIR, config.IMAGE_CACHE_MAX_MB * 1024 * 1024),
+                    max_workers=config.IMAGE_WORKERS,
+                    max_pending=config.IMAGE_MAX_PENDING,
+                    reference_max_side=config.IMAGE_REFERENCE_MAX_SIDE,
+                    reference_quality=config.IMAGE_REFERENCE_QUALITY,
+                )
+    return _image_jobs
+
+
+def set_image_jobs(queue: Optional[ImageJobQueue]) -> None:
+    """Replaces the process-wide queue (e.g. with one using a fake model); None rebuilds it from config."""
+    global _image_jobs
+    with _image_jobs_lock:
+        _image_jobs = queue
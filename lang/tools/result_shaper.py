@@ -0,0 +1,102 @@
+import re
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from lang.db.cache import LRUCache, limit_statement, normalize_sql
+
+_SELECT_RE = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+_NUMERIC_TYPES = (int, float, Decimal)
+_MAX_SUMMARY_COLUMNS = 5
+
+
+@dataclass
+class PageCursor:
+    """Where the next page of a thread's last query starts."""
+    query: str
+    offset: int
+    page_size: int
+
+
+def is_pageable(query: str) -> bool:
+    return bool(_SELECT_RE.match(normalize_sql(query)))
+
+
+def page_query(query: str, offset: int, limit: int) -> str:
+    """
+    Rewrites a SELECT so the server returns at most `limit` rows starting at `offset`.
+
+    Statements without their own LIMIT get one appended; for statements that already
+    limit themselves the page is taken from within their LIMIT.
+    """
+    return limit_statement(query, limit, offset)
+
+
+def summary_query(query: str, numeric_columns: List[str]) -> str:
+    """Builds one aggregate query returning the total row count plus min/max/avg of numeric columns."""
+    aggregates = ["COUNT(*) AS `total_rows`"]
+    for column in numeric_columns[:_MAX_SUMMARY_COLUMNS]:
+        quoted = "`" + column.replace("`", "``") + "`"
+        aggregates.append(f"MIN({quoted}) AS `min_{column}`, MAX({quoted}) AS `max_{column}`, AVG({quoted}) AS `avg_{column}`")
+    return f"SELECT {', '.join(aggregates)} FROM ({normalize_sql(query)}) AS _summary"
+
+
+def numeric_columns(rows: List[Dict[str, Any]]) -> List[str]:
+    if not rows:
+        return []
+    return [c for c, v in rows[0].items() if isinstance(v, _NUMERIC_TYPES) and not isinstance(v, bool)]
+
+
+def _cell(value: Any, max_chars: int) -> str:
+    text = "NULL" if value is None else str(value).replace("\n", " ").replace("|", "/")
+    return text if len(text) <= max_chars else text[: max_chars - 1] + "…"
+
+
+def render_table(rows: List[Dict[str, Any]], max_cell_chars: int = 40) -> str:
+    """Renders rows as a compact pipe-separated table: one header line, one line per row."""
+    if not rows:
+        return ""
+    columns = list(rows[0].keys())
+    lines = [" | ".join(columns)]
+    for row in rows:
+        lines.append(" | ".join(_cell(row.get(c), max_cell_chars) for c in columns))
+    return "\n".join(lines)
+
+
+def render_summary(summary: Optional[Dict[str, Any]], columns: List[str]) -> str:
+    """Renders the aggregate row from `summary_query` as short per-column stats."""
+    if not summary:
+        return ""
+    parts = []
+    for column in columns[:_MAX_SUMMARY_COLUMNS]:
+        low, high, avg = summary.get(f"min_{column}"), summary.get(f"max_{column}"), summary.get(f"avg_{column}")
+        if low is None and high is None:
+            continue
+        avg_text = f"{float(avg):,.2f}" if avg is not None else "n/a"
+        parts.append(f"{column}: min {low}, max {high}, avg {avg_text}")
+    return "Column stats over all rows: " + "; ".join(parts) if parts else ""
+
+
+class ResultPageStore:
+    """Per-thread pagination cursors, bounded and expired like any other cache."""
+
+    def __init__(self, max_threads: int = 1000, ttl: float = 1800.0):
+        self._cursors = LRUCache(max_entries=max_threads, name="result_pages")
+        self.ttl = ttl
+
+    def save(self, thread_id: Optional[str], cursor: PageCursor) -> None:
+        if thread_id:
+            self._cursors.set(thread_id, cursor, ttl=self.ttl)
+
+    def load(self, thread_id: Optional[str]) -> Optional[PageCursor]:
+        if not thread_id:
+            return None
+        _, cursor = self._cursors.get(thread_id)
+        return cursor
+
+    def clear(self, thread_id: Optional[str]) -> None:
+        if thread_id:
+            self._cursors.invalidate(thread_id)
+
+
+page_store = ResultPageStore()
@@ -1,139 +1,603 @@
-import json
-import mysql.connector
-from mysql.connector import Error
-from langchain_core.tools import tool
-from langchain_core.messages import AIMessage, HumanMessage
-from typing import List
+import asyncio
+import contextlib
+import functools
+import re
+import time
+import uuid
+from langchain_core.tools import StructuredTool
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime
 import os
-import base64
 
-from config import image_llm, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME
-from utils import export_data_to_excel
+from lang.db.batch import BatchResult, arun_batch, run_batch
+from lang.db.cache import extract_tables, get_query_cache, is_read_only
+from lang.db.guard import (
+    QueryGuardError,
+    await_statement,
+    get_query_guard,
+    statement_tracker,
+    with_max_execution_time,
+)
+from lang.db.pool import DatabaseUnavailableError
+from lang.db.sources import current_source
+from lang.db.schema import get_schema_catalog
+from lang.db.upload_store import get_upload_store
+from lang.tools.artifacts import Artifact, get_artifact_store
+from lang.tools.image_jobs import ImageQueueFullError, get_image_jobs
+from config import (
+    EXPORT_BATCH_SIZE,
+    QUERY_BATCH_MAX_STATEMENTS,
+    QUERY_EXPORT_TIMEOUT,
+    QUERY_STATEMENT_TIMEOUT,
+    RESULT_MAX_CELL_CHARS,
+    RESULT_PAGE_SIZE,
+)
+from lang.state.context import get_thread_id
+from lang.tools.result_shaper import (
+    PageCursor,
+    is_pageable,
+    numeric_columns,
+    page_query,
+    page_store,
+    render_summary,
+    render_table,
+    summary_query,
+)
+from utils import EXPORT_FORMATS, StreamingExportWriter, export_file_path
+from telemetry import get_logger, trace
+
+log = get_logger(__name__)
+
+# What a tool that creates files returns: its text for the model and the files as `Artifact.as_dict()` entries.
+_ArtifactResult = Tuple[str, Optional[List[Dict[str, Any]]]]
 
 # --- Internal Helper Functions ---
-def _get_db_connection():
-    """Establishes a connection to the MySQL database."""
+def _run_query(query: str, dictionary: bool = True) -> List[Any]:
+    """
+    Runs a statement on a pooled connection and returns all rows. The statement is
+    killed once it runs past `QUERY_STATEMENT_TIMEOUT` or its request is cancelled.
+    """
+    thread_id = get_thread_id()
+    source = current_source()
+    # Reads may be served by a replica of the request's data source; writes go to its primary.
+    with trace("db.query", source=source.name) as span, \
+            source.checkout(is_read_only(query), thread_id) as (pool, conn), \
+            statement_tracker.track(pool, conn, thread_id, QUERY_STATEMENT_TIMEOUT):
+        cursor = conn.cursor(dictionary=dictionary)
+        try:
+            cursor.execute(with_max_execution_time(query, QUERY_STATEMENT_TIMEOUT))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        span.set(rows=len(rows))
+        return rows
+
+async def _arun_query(query: str, dictionary: bool = True) -> List[Any]:
+    """Async equivalent of `_run_query`, using the event-loop-native driver."""
+    source = current_source()
+    if not source.supports_async:
+        return await asyncio.to_thread(_run_query, query, dictionary)
+    import aiomysql
+
+    with trace("db.query", source=source.name) as span:
+        async with source.acheckout(is_read_only(query), get_thread_id()) as (pool, conn):
+            cursor_class = aiomysql.DictCursor if dictionary else aiomysql.Cursor
+
+            async def fetch() -> List[Any]:
+                async with conn.cursor(cursor_class) as cursor:
+                    await cursor.execute(with_max_execution_time(query, QUERY_STATEMENT_TIMEOUT))
+                    return list(await cursor.fetchall())
+
+            rows = await await_statement(pool, conn, fetch(), QUERY_STATEMENT_TIMEOUT)
+        span.set(rows=len(rows))
+        return rows
+
+_DDL_RE = re.compile(r"^\s*(CREATE|ALTER|DROP|RENAME|TRUNCATE)\b", re.IGNORECASE)
+
+def _invalidate_schema_on_ddl(query: str) -> None:
+    """Drops the cached schema snapshot after a statement that changes table structure."""
+    if _DDL_RE.match(query):
+        get_schema_catalog().invalidate()
+        get_query_guard().clear_plans()
+
+def _run_cached_query(query: str, bounded: bool = False) -> List[Any]:
+    """
+    Runs a statement through the result cache: reads are served from cache when
+    possible, writes invalidate every cached entry for the tables they touch.
+    Anything that reaches the database passes the query guard first; `bounded`
+    tells it the statement carries its own LIMIT.
+    """
+    cache = get_query_cache()
+    if not is_read_only(query):
+        result = _run_query(get_query_guard().check(query, bounded=False))
+        cache.invalidate_tables(extract_tables(query))
+        _invalidate_schema_on_ddl(query)
+        return result
+    hit, result = cache.get_rows(query)
+    if hit:
+        log.debug("QUERY_CACHE", "Result cache hit.")
+        return result
+    result = _run_query(get_query_guard().check(query, bounded=bounded))
+    cache.put_rows(query, result)
+    return result
+
+async def _arun_cached_query(query: str, bounded: bool = False) -> List[Any]:
+    """Async equivalent of `_run_cached_query`."""
+    cache = get_query_cache()
+    if not is_read_only(query):
+        result = await _arun_query(await get_query_guard().acheck(query, bounded=False))
+        cache.invalidate_tables(extract_tables(query))
+        _invalidate_schema_on_ddl(query)
+        return result
+    hit, result = cache.get_rows(query)
+    if hit:
+        log.debug("QUERY_CACHE", "Result cache hit.")
+        return result
+    result = await _arun_query(await get_query_guard().acheck(query, bounded=bounded))
+    cache.put_rows(query, result)
+    return result
+
+def _traced(name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+    """Runs a tool implementation in a `tool.<name>` span; an "Error: ..." result marks the span as failed."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with trace(f"tool.{name}") as span:
+            result = func(*args, **kwargs)
+            if _tool_text(result).startswith("Error"):
+                span.error = "ToolError"
+            return result
+    return wrapper
+
+def _atraced(name: str, coroutine: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Async equivalent of `_traced`."""
+    @functools.wraps(coroutine)
+    async def wrapper(*args, **kwargs):
+        with trace(f"tool.{name}") as span:
+            result = await coroutine(*args, **kwargs)
+            if _tool_text(result).startswith("Error"):
+                span.error = "ToolError"
+            return result
+    return wrapper
+
+def _tool_text(result: Any) -> str:
+    """The text of a tool result, which is a string or a (text, artifacts) pair."""
+    text = result[0] if isinstance(result, tuple) else result
+    return text if isinstance(text, str) else ""
+
+def _dual_tool(name: str, func: Callable[..., Any], coroutine: Callable[..., Awaitable[Any]],
+               artifacts: bool = False) -> StructuredTool:
+    """
+    Builds a traced tool with both a sync and a native async implementation; the description comes from `func`.
+    With `artifacts`, the implementations return (text, artifact dicts or None): the model sees the text and
+    the files reach the graph state through the tool message's artifact.
+    """
+    return StructuredTool.from_function(
+        func=_traced(name, func), coroutine=_atraced(name, coroutine), name=name,
+        response_format="content_and_artifact" if artifacts else "content",
+    )
+
+def _export_filename(table_name: str, file_format: str = "xlsx") -> str:
+    """Generates a dynamic filename to avoid overwrites."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_table_name = "".join(c for c in table_name if c.isalnum() or c in ('_', '-')).rstrip()
+    # Exports started in the same second must not share a file (or its cleanup).
+    filename = f"{safe_table_name}_{timestamp}_{uuid.uuid4().hex[:8]}.{file_format}"
+    log.debug("TOOL", f"Generated filename: {filename}")
+    return filename
+
+def _export_summary(writer: StreamingExportWriter, artifact: Artifact, elapsed: float) -> str:
+    """Builds the tool result for a finished export, including throughput."""
+    rate = writer.rows_written / elapsed if elapsed > 0 else float(writer.rows_written)
+    log.info("TOOL", f"Exported {writer.rows_written} rows in {elapsed:.2f}s ({rate:,.0f} rows/sec)")
+    sheets = f" across {writer.sheets} sheets" if writer.sheets > 1 else ""
+    return (
+        f"Successfully exported {writer.rows_written:,} rows{sheets} to {artifact.filename} "
+        f"({artifact.size / 1e6:.1f} MB) in {elapsed:.1f}s ({rate:,.0f} rows/sec). The file is attached to the reply."
+    )
+
+def _discard_export(writer: StreamingExportWriter) -> None:
+    """Closes a failed export and deletes what it wrote, if anything (Parquet writes no file until the first rows)."""
+    with contextlib.suppress(Exception):
+        writer.close()
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(writer.file_path)
+
+def _export_notice(query: str, statement: str) -> str:
+    """Tells the user when the query guard capped an export."""
+    if statement == query:
+        return ""
+    return (
+        f" The export was limited to {get_query_guard().rewrite_limit:,} rows because the full query "
+        "was estimated to examine too many rows; add filters to export the rest."
+    )
+
+def _stream_export(query: str, writer: StreamingExportWriter) -> None:
+    """
+    Streams a query's rows into `writer` in `EXPORT_BATCH_SIZE` batches over an unbuffered
+    cursor. The statement is killed once it runs past `QUERY_EXPORT_TIMEOUT`.
+    """
+    thread_id = get_thread_id()
+    with current_source().checkout(is_read_only(query), thread_id) as (pool, conn), \
+            statement_tracker.track(pool, conn, thread_id, QUERY_EXPORT_TIMEOUT):
+        # mysql.connector cursors are unbuffered by default: rows are read off the
+        # socket as they are fetched instead of being materialised client-side.
+        cursor = conn.cursor(buffered=False)
+        try:
+            cursor.execute(with_max_execution_time(query, QUERY_EXPORT_TIMEOUT))
+            writer.write_header([d[0] for d in cursor.description])
+            while True:
+                batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not batch:
+                    break
+                writer.write_rows(batch)
+        finally:
+            cursor.close()
+
+async def _astream_export(query: str, writer: StreamingExportWriter) -> None:
+    """Async equivalent of `_stream_export` using a server-side (`SSCursor`) cursor."""
+    source = current_source()
+    if not source.supports_async:
+        return await asyncio.to_thread(_stream_export, query, writer)
+    import aiomysql
+
+    async with source.acheckout(is_read_only(query), get_thread_id()) as (pool, conn):
+
+        async def stream() -> None:
+            async with conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(with_max_execution_time(query, QUERY_EXPORT_TIMEOUT))
+                writer.write_header([d[0] for d in cursor.description])
+                while True:
+                    batch = await cursor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    # Excel/Parquet encoding is CPU bound; keep it off the event loop.
+                    await asyncio.to_thread(writer.write_rows, batch)
+
+        await await_statement(pool, conn, stream(), QUERY_EXPORT_TIMEOUT)
+
+# --- Agent Tools ---
+
+def _format_page(rows: List[Any], offset: int, has_more: bool, summary: Dict[str, Any] | None) -> str:
+    """Renders one page of results with a row range, optional column stats and a paging hint."""
+    if not rows:
+        return "Query returned no results." if offset == 0 else "There are no more rows."
+    total = summary.get("total_rows") if summary else None
+    range_text = f"Rows {offset + 1}-{offset + len(rows)}"
+    if total is not None:
+        range_text += f" of {total:,}"
+    parts = [f"{range_text}:", render_table(rows, RESULT_MAX_CELL_CHARS)]
+    stats = render_summary(summary, numeric_columns(rows))
+    if stats:
+        parts.append(stats)
+    if has_more:
+        parts.append("More rows are available; call `get_next_page` to show the next page.")
+    return "\n".join(parts)
+
+def _query_page(query: str, offset: int) -> str:
+    """Fetches one capped page of a query's results and remembers the cursor for this thread."""
+    if not is_pageable(query):
+        # SHOW/DESCRIBE and writes cannot be wrapped; cap what is rendered instead.
+        rows = _run_cached_query(query)
+        page_store.clear(get_thread_id())
+        return _format_page(rows[:RESULT_PAGE_SIZE], 0, False, {"total_rows": len(rows)} if rows else None)
+
+    # Ask for one extra row to learn whether another page exists without counting.
+    rows = _run_cached_query(page_query(query, offset, RESULT_PAGE_SIZE + 1), bounded=True)
+    has_more = len(rows) > RESULT_PAGE_SIZE
+    rows = rows[:RESULT_PAGE_SIZE]
+    summary = None
+    if has_more or offset:
+        try:
+            summary = _run_cached_query(summary_query(query, numeric_columns(rows)))[0]
+        except DatabaseUnavailableError:
+            raise
+        except Exception as e:
+            log.warning("TOOL", f"Could not summarize remaining rows: {e}")
+    if has_more:
+        page_store.save(get_thread_id(), PageCursor(query, offset + RESULT_PAGE_SIZE, RESULT_PAGE_SIZE))
+    else:
+        page_store.clear(get_thread_id())
+    return _format_page(rows, offset, has_more, summary)
+
+async def _aquery_page(query: str, offset: int) -> str:
+    """Async equivalent of `_query_page`."""
+    if not is_pageable(query):
+        rows = await _arun_cached_query(query)
+        page_store.clear(get_thread_id())
+        return _format_page(rows[:RESULT_PAGE_SIZE], 0, False, {"total_rows": len(rows)} if rows else None)
+
+    rows = await _arun_cached_query(page_query(query, offset, RESULT_PAGE_SIZE + 1), bounded=True)
+    has_more = len(rows) > RESULT_PAGE_SIZE
+    rows = rows[:RESULT_PAGE_SIZE]
+    summary = None
+    if has_more or offset:
+        try:
+            summary = (await _arun_cached_query(summary_query(query, numeric_columns(rows))))[0]
+        except DatabaseUnavailableError:
+            raise
+        except Exception as e:
+            log.warning("TOOL", f"Could not summarize remaining rows: {e}")
+    if has_more:
+        page_store.save(get_thread_id(), PageCursor(query, offset + RESULT_PAGE_SIZE, RESULT_PAGE_SIZE))
+    else:
+        page_store.clear(get_thread_id())
+    return _format_page(rows, offset, has_more, summary)
+
+def _query_database(query: str) -> str:
+    """
+    Use this to run a SQL query and display results as text. This is the default tool for getting data. Results are paged; only the first page is returned.
+    """
+    log.debug("TOOL_CALLED", "query_database", query=query)
     try:
-        conn = mysql.connector.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
-        if conn.is_connected(): return conn
-    except Error as e:
-        return {"error": str(e)}
-
-def _get_image_base64_from_response(response_message: AIMessage) -> str | None:
-    """Extracts the base64 encoded image data from an AIMessage."""
-    if not isinstance(response_message.content, list): return None
-    for part in response_message.content:
-        if isinstance(part, dict) and "image_url" in part:
-            image_uri = part["image_url"].get("url")
-            if image_uri and isinstance(image_uri, str): return image_uri.split(',')[-1]
-    return None
+        return _query_page(query, 0)
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    except QueryGuardError as e:
+        return f"Error: {e}"
 
-def _generate_or_modify_image(prompt: str, image_data_base64: str | None = None) -> str:
-    """Generates a new image or modifies an existing one using the image model."""
-    print(f"--- [IMAGE_TOOL] Initializing image generation: '{prompt[:50]}...' ---")
+async def _aquery_database(query: str) -> str:
+    log.debug("TOOL_CALLED", "query_database (async)", query=query)
     try:
-        content = [{"type": "text", "text": prompt}]
-        if image_data_base64:
-            print("--- [IMAGE_TOOL] Attaching existing image for modification. ---")
-            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data_base64}"}})
-        message = HumanMessage(content=content)
-        print("--- [IMAGE_TOOL] Invoking image model... ---")
-        response = image_llm.invoke([message])
-        generated_image_base64 = _get_image_base64_from_response(response)
-        if not generated_image_base64: return "Error: The model did not generate an image."
-        print("--- [IMAGE_TOOL] Image received. Saving to file... ---")
-        output_dir = "output"
-        os.makedirs(output_dir, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_path = os.path.abspath(os.path.join(output_dir, f"generated_image_{timestamp}.png"))
-        with open(file_path, "wb") as f:
-            f.write(base64.b64decode(generated_image_base64))
-        print(f"--- [IMAGE_TOOL] Image saved to {file_path} ---")
-        return file_path
-    except Exception as e:
-        print(f"--- [IMAGE_TOOL_ERROR] An unexpected error occurred: {e} ---")
-        return f"Error: An unexpected error occurred during image generation: {e}"
+        return await _aquery_page(query, 0)
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    except QueryGuardError as e:
+        return f"Error: {e}"
 
-# --- Agent Tools ---
+query_database = _dual_tool("query_database", _query_database, _aquery_database)
+
+def _batch_statements(queries: List[str]) -> List[str]:
+    """Caps every SELECT at one page (plus a row to detect truncation) before it is sent."""
+    return [page_query(q, 0, RESULT_PAGE_SIZE + 1) if is_pageable(q) else q for q in queries]
+
+def _format_batch(queries: List[str], batch: BatchResult) -> str:
+    """Renders every statement's rows or error, then the timing of the batch and its critical path."""
+    parts = []
+    for query, statement in zip(queries, batch.statements):
+        timing = "cached" if statement.cached else f"{statement.elapsed:.2f}s"
+        header = f"Query {statement.index + 1} ({timing}): {query}"
+        if statement.error:
+            parts.append(f"{header}\nError: {statement.error}")
+        elif not statement.rows:
+            parts.append(f"{header}\nNo results.")
+        else:
+            rows = statement.rows[:RESULT_PAGE_SIZE]
+            note = f"\nShowing the first {len(rows)} rows only." if len(statement.rows) > RESULT_PAGE_SIZE else ""
+            parts.append(f"{header}\n{render_table(rows, RESULT_MAX_CELL_CHARS)}{note}")
+    critical = batch.critical
+    if critical is not None:
+        parts.append(
+            f"Ran {len(batch.statements)} statement(s) in {batch.wall:.2f}s "
+            f"({batch.serial_time:.2f}s if run one after another); slowest path: query {critical.index + 1} "
+            f"(waited {critical.queued:.2f}s, ran {critical.elapsed:.2f}s)."
+        )
+    return "\n\n".join(parts)
 
-@tool
-def query_database(query: str) -> str:
+def _check_batch(queries: List[str]) -> str | None:
+    if not queries:
+        return "Error: Provide at least one SQL statement."
+    if len(queries) > QUERY_BATCH_MAX_STATEMENTS:
+        return f"Error: A batch may contain at most {QUERY_BATCH_MAX_STATEMENTS} statements; split the work or combine queries."
+    return None
+
+def _query_database_batch(queries: List[str]) -> str:
     """
-    Use this to run a SQL query and display results as text. This is the default tool for getting data.
+    Use this instead of several `query_database` calls when a question needs multiple independent read-only queries (e.g. comparing two metrics). The statements run concurrently and each result is returned with its timing. Results are not paged; aggregate or filter in SQL.
     """
-    print(f"--- [TOOL_CALLED] query_database with query: '{query}' ---")
-    conn = _get_db_connection()
-    if isinstance(conn, dict): return f"Error connecting to database: {conn['error']}"
+    log.debug("TOOL_CALLED", "query_database_batch", statements=len(queries))
+    error = _check_batch(queries)
+    if error:
+        return error
+    return _format_batch(queries, run_batch(_batch_statements(queries), thread_id=get_thread_id()))
+
+async def _aquery_database_batch(queries: List[str]) -> str:
+    log.debug("TOOL_CALLED", "query_database_batch (async)", statements=len(queries))
+    error = _check_batch(queries)
+    if error:
+        return error
+    return _format_batch(queries, await arun_batch(_batch_statements(queries)))
+
+query_database_batch = _dual_tool("query_database_batch", _query_database_batch, _aquery_database_batch)
+
+def _get_next_page() -> str:
+    """Use this when the user asks for the next page or more rows of the previous query result."""
+    log.debug("TOOL_CALLED", "get_next_page")
+    cursor = page_store.load(get_thread_id())
+    if cursor is None:
+        return "There is no earlier query with more rows in this conversation."
     try:
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(query)
-        result = cursor.fetchall()
-        return json.dumps(result, indent=2, default=str) if result else "Query returned no results."
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
+        return _query_page(cursor.query, cursor.offset)
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    except QueryGuardError as e:
+        return f"Error: {e}"
+
+async def _aget_next_page() -> str:
+    log.debug("TOOL_CALLED", "get_next_page (async)")
+    cursor = page_store.load(get_thread_id())
+    if cursor is None:
+        return "There is no earlier query with more rows in this conversation."
+    try:
+        return await _aquery_page(cursor.query, cursor.offset)
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    except QueryGuardError as e:
+        return f"Error: {e}"
 
-@tool
-def export_to_excel(query: str, table_name: str) -> str:
+get_next_page = _dual_tool("get_next_page", _get_next_page, _aget_next_page)
+
+def _export_to_excel(query: str, table_name: str, file_format: str = "xlsx") -> _ArtifactResult:
     """
-    Use ONLY when the user asks to 'export' or get an 'excel' file. You must provide the table_name from the user's query. The filename will be generated automatically.
+    Use ONLY when the user asks to 'export' or get an 'excel' file. You must provide the table_name from the user's query. The filename will be generated automatically. Leave file_format as 'xlsx' unless the user explicitly asks for 'csv' or 'parquet'.
     """
-    print(f"--- [TOOL_CALLED] export_to_excel for table: '{table_name}' ---")
-    conn = _get_db_connection()
-    if isinstance(conn, dict): return f"Error connecting to database: {conn['error']}"
+    log.debug("TOOL_CALLED", "export_to_excel", table=table_name, format=file_format)
+    if file_format not in EXPORT_FORMATS:
+        return f"Error: Unsupported export format '{file_format}'. Use one of: {', '.join(EXPORT_FORMATS)}.", None
+    try:
+        writer = StreamingExportWriter(export_file_path(_export_filename(table_name, file_format)), file_format)
+    except ValueError as e:
+        return f"Error: {e}", None
+
+    started = time.perf_counter()
+    written = False
     try:
-        # Generate a dynamic filename to avoid overwrites.
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_table_name = "".join(c for c in table_name if c.isalnum() or c in ('_', '-')).rstrip()
-        filename = f"{safe_table_name}_{timestamp}.xlsx"
-        print(f"--- [TOOL] Generated filename: {filename} ---")
-        
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(query)
-        data = cursor.fetchall()
-        if not data: return "Query returned no data to export."
-        
-        # Use the utility function to export the data.
-        file_path = export_data_to_excel(data, filename)
-        return f"Successfully exported data to {file_path}"
+        statement = get_query_guard().check(query, bounded=False)
+        _stream_export(statement, writer)
+        writer.close()
+        written = True
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}", None
+    except QueryGuardError as e:
+        return f"Error: {e}", None
     finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
+        # No partial file is left in the output directory, whatever the error.
+        if not written:
+            _discard_export(writer)
+    if not writer.rows_written:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(writer.file_path)
+        return "Query returned no data to export.", None
+    artifact = get_artifact_store().register(writer.file_path, "export")
+    text = _export_summary(writer, artifact, time.perf_counter() - started) + _export_notice(query, statement)
+    return text, [artifact.as_dict()]
 
-@tool
-def get_database_tables() -> str:
-    """Use this to list all available tables in the database."""
-    print("--- [TOOL_CALLED] get_database_tables ---")
-    conn = _get_db_connection()
-    if isinstance(conn, dict): return f"Error connecting to database: {conn['error']}"
+async def _aexport_to_excel(query: str, table_name: str, file_format: str = "xlsx") -> _ArtifactResult:
+    log.debug("TOOL_CALLED", "export_to_excel (async)", table=table_name, format=file_format)
+    if file_format not in EXPORT_FORMATS:
+        return f"Error: Unsupported export format '{file_format}'. Use one of: {', '.join(EXPORT_FORMATS)}.", None
     try:
-        cursor = conn.cursor()
-        cursor.execute("SHOW TABLES;")
-        tables = [table[0] for table in cursor.fetchall()]
-        return f"Available tables: {', '.join(tables)}" if tables else "No tables were found."
+        writer = StreamingExportWriter(export_file_path(_export_filename(table_name, file_format)), file_format)
+    except ValueError as e:
+        return f"Error: {e}", None
+
+    started = time.perf_counter()
+    written = False
+    try:
+        statement = await get_query_guard().acheck(query, bounded=False)
+        await _astream_export(statement, writer)
+        await asyncio.to_thread(writer.close)
+        written = True
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}", None
+    except QueryGuardError as e:
+        return f"Error: {e}", None
     finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
+        if not written:
+            await asyncio.shield(asyncio.to_thread(_discard_export, writer))
+    if not writer.rows_written:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(writer.file_path)
+        return "Query returned no data to export.", None
+    # Zipping a large CSV is CPU bound; keep it off the event loop.
+    artifact = await asyncio.to_thread(get_artifact_store().register, writer.file_path, "export")
+    text = _export_summary(writer, artifact, time.perf_counter() - started) + _export_notice(query, statement)
+    return text, [artifact.as_dict()]
+
+export_to_excel = _dual_tool("export_to_excel", _export_to_excel, _aexport_to_excel, artifacts=True)
 
-@tool
-def generate_image(prompt: str, base64_image_data: str | None = None) -> str:
+def _get_database_tables() -> str:
+    """Use this to list all available tables in the database."""
+    log.debug("TOOL_CALLED", "get_database_tables")
+    try:
+        tables = [table[0] for table in _run_query("SHOW TABLES;", dictionary=False)]
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    return f"Available tables: {', '.join(tables)}" if tables else "No tables were found."
+
+async def _aget_database_tables() -> str:
+    log.debug("TOOL_CALLED", "get_database_tables (async)")
+    try:
+        tables = [table[0] for table in await _arun_query("SHOW TABLES;", dictionary=False)]
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    return f"Available tables: {', '.join(tables)}" if tables else "No tables were found."
+
+get_database_tables = _dual_tool("get_database_tables", _get_database_tables, _aget_database_tables)
+
+def _describe_table(table_name: str) -> str:
+    """Use this to see the columns, types, primary key and foreign keys of a table that is not already described in your instructions."""
+    log.debug("TOOL_CALLED", "describe_table", table=table_name)
+    try:
+        table = get_schema_catalog().get_table(table_name)
+    except DatabaseUnavailableError as e:
+        return f"Error connecting to database: {e}"
+    return table.render() if table else f"Table '{table_name}' does not exist."
+
+async def _adescribe_table(table_name: str) -> str:
+    # Served from the in-memory catalog; only a stale snapshot touches the database.
+    return await asyncio.to_thread(_describe_table, table_name)
+
+describe_table = _dual_tool("describe_table", _describe_table, _adescribe_table)
+
+def _query_uploaded_data(query: str) -> str:
+    """
+    Use this to answer questions about a CSV or Excel file the user uploaded in this conversation.
+    The file is loaded as a SQLite table; write SQLite SELECT queries against the uploaded tables listed in the conversation.
+    """
+    log.debug("TOOL_CALLED", "query_uploaded_data", query=query)
+    started = time.perf_counter()
+    try:
+        rows, has_more = get_upload_store().query(get_thread_id(), query, RESULT_PAGE_SIZE)
+    except (LookupError, PermissionError) as e:
+        return f"Error: {e}"
+    except Exception as e:
+        return f"Error executing query on uploaded data: {e}"
+    log.info("UPLOAD_STORE", f"Query returned {len(rows)} row(s) in {time.perf_counter() - started:.3f}s")
+    if not rows:
+        return "Query executed successfully, but returned no results."
+    table = render_table(rows, RESULT_MAX_CELL_CHARS)
+    if has_more:
+        return f"{table}\n\nShowing the first {len(rows)} rows only; aggregate or filter in SQL to narrow the result."
+    return table
+
+async def _aquery_uploaded_data(query: str) -> str:
+    # SQLite runs in-process; keep it off the event loop.
+    return await asyncio.to_thread(_query_uploaded_data, query)
+
+query_uploaded_data = _dual_tool("query_uploaded_data", _query_uploaded_data, _aquery_uploaded_data)
+
+def _image_result(file_path: str) -> _ArtifactResult:
+    # Cached images are named by a long hash; the user gets a shorter name.
+    artifact = get_artifact_store().register(file_path, "image", filename=f"image_{os.path.basename(file_path)[:12]}.png")
+    return "Successfully generated the image. It is attached to the reply.", [artifact.as_dict()]
+
+def _generate_image(prompt: str, image_data_uri: str | None = None) -> _ArtifactResult:
     """
     Use this to generate or modify an image based on a text description.
+    To modify an image, pass it as a data URI in `image_data_uri`.
     """
-    print(f"--- [TOOL_CALLED] generate_image with prompt: '{prompt[:50]}...' ---")
-    file_path = _generate_or_modify_image(prompt, base64_image_data)
-    if "Error:" in file_path:
-        return file_path
-    return f"Successfully generated image and saved it to the following path: {file_path}"
+    log.debug("TOOL_CALLED", "generate_image", prompt=prompt)
+    try:
+        # The job runs on the image workers; identical requests are served from the image cache.
+        file_path = get_image_jobs().run(prompt, image_data_uri)
+    except ImageQueueFullError:
+        return "Error: The image generator is busy right now. Please try again in a minute.", None
+    except Exception as e:
+        log.error("IMAGE_TOOL", f"An unexpected error occurred: {e}")
+        return f"Error: An unexpected error occurred during image generation: {e}", None
+    return _image_result(file_path)
+
+async def _agenerate_image(prompt: str, image_data_uri: str | None = None) -> _ArtifactResult:
+    log.debug("TOOL_CALLED", "generate_image (async)", prompt=prompt)
+    try:
+        file_path = await get_image_jobs().arun(prompt, image_data_uri)
+    except ImageQueueFullError:
+        return "Error: The image generator is busy right now. Please try again in a minute.", None
+    except Exception as e:
+        log.error("IMAGE_TOOL", f"An unexpected error occurred: {e}")
+        return f"Error: An unexpected error occurred during image generation: {e}", None
+    return _image_result(file_path)
+
+generate_image = _dual_tool("generate_image", _generate_image, _agenerate_image, artifacts=True)
 
 # A list of all tools that the agent can use.
 all_tools = [
     query_database,
+    query_database_batch,
+    get_next_page,
     export_to_excel,
     get_database_tables,
+    describe_table,
+    query_uploaded_data,
     generate_image,
-]
\ No newline at end of file
+]
@@ -0,0 +1,583 @@
+"""
+A layer around the model clients so the bot does not pay twice for the same answer.
+
+- Single-flight: identical requests that are in flight at the same time share one
+  model call. The first caller (the leader) calls the model and the others wait for
+  its response.
+- Response cache: responses are kept in a bounded LRU with a TTL, keyed by the model,
+  the normalized messages and the schemas of the bound tools, and optionally in a
+  SQLite file that survives restarts and is shared by the worker processes.
+- Accounting: the tokens and estimated cost of every model call per guild, plus how
+  many calls the cache and single-flight answered and how much model time that saved.
+
+`CachedChatModel` wraps any LangChain chat model; config.py wraps the Gemini clients
+with `cached_chat_model`.
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, ToolMessage, message_chunk_to_message
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+import config
+from lang.db.cache import LRUCache
+from lang.state.context import get_guild_id
+from telemetry import get_logger, metrics
+
+log = get_logger(__name__)
+
+llm_requests_total = metrics.counter(
+    "text2sql_llm_requests_total", "Model requests by how they were answered.", ["model", "outcome"]
+)
+llm_saved_seconds = metrics.counter(
+    "text2sql_llm_saved_seconds_total", "Model time avoided by cache hits and coalesced requests.", ["model"]
+)
+guild_llm_tokens = metrics.counter(
+    "text2sql_guild_llm_tokens_total", "Model tokens spent per guild.", ["guild", "kind"]
+)
+guild_llm_cost = metrics.counter(
+    "text2sql_guild_llm_cost_usd_total", "Estimated model cost per guild, in US dollars.", ["guild"]
+)
+
+# Finish reasons of a complete answer; anything else (length, safety, errors) is not cached.
+_COMPLETE_FINISH_REASONS = {None, "STOP", "stop", "end_turn", "tool_calls"}
+# Call options that are part of the tool schema key rather than the request key.
+_TOOL_OPTIONS = {"tools", "tool_config", "tool_choice", "functions"}
+
+
+def parse_prices(spec: str) -> Dict[str, Tuple[float, float]]:
+    """Parses `"gemini-2.5-flash=0.30/2.50"` into `{"gemini-2.5-flash": (0.30, 2.50)}` (USD per million tokens)."""
+    prices = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, pair = item.partition("=")
+        input_price, _, output_price = pair.partition("/")
+        prices[model.strip()] = (float(input_price), float(output_price or input_price))
+    return prices
+
+
+# --- Cache Keys ---
+
+def _normalize_content(content: Any) -> Any:
+    if isinstance(content, str):
+        return " ".join(content.split())
+    if isinstance(content, list):
+        return [_normalize_content(part) for part in content]
+    if isinstance(content, dict):
+        return {key: _normalize_content(value) for key, value in content.items() if key != "id"}
+    return content
+
+
+def _message_key(message: BaseMessage) -> Dict[str, Any]:
+    """
+    What of a message decides the model's answer. Message and tool call ids differ
+    between conversations and are left out; tool results follow their calls in order.
+    """
+    key: Dict[str, Any] = {"type": message.type, "content": _normalize_content(message.content)}
+    if isinstance(message, AIMessage) and message.tool_calls:
+        key["tool_calls"] = [[call["name"], call["args"]] for call in message.tool_calls]
+    if isinstance(message, ToolMessage):
+        key["name"] = message.name
+    return key
+
+
+def request_key(model: str, tools_key: str, messages: Sequence[BaseMessage], options: Dict[str, Any]) -> str:
+    """Hash of everything that decides a response: model, tool schemas, normalized messages and call options."""
+    payload = {
+        "model": model,
+        "tools": tools_key,
+        "messages": [_message_key(m) for m in messages],
+        "options": {k: v for k, v in options.items() if k not in _TOOL_OPTIONS},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def tools_key(tools: Sequence[Any], options: Dict[str, Any]) -> str:
+    schemas = [convert_to_openai_tool(tool) for tool in tools]
+    payload = json.dumps({"tools": schemas, "options": options}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# --- Response Cache ---
+
+class ResponseCache:
+    """
+    Model responses by request key, with the seconds the original call took. Entries
+    live in a bounded in-memory LRU for `ttl` seconds and, with `db_path`, also in a
+    SQLite table, so they survive a restart and are shared by the processes using it.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0, db_path: str = ""):
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries=max_entries, name="llm_responses")
+        self.db_path = db_path
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._disk_hits = 0
+
+    def get(self, key: str) -> Optional[Tuple[AIMessage, float]]:
+        hit, value = self.memory.get(key)
+        if hit:
+            return value
+        if not self.db_path:
+            return None
+        row = self._db_get(key)
+        if row is None:
+            return None
+        message_json, latency, created_at = row
+        remaining = self.ttl - (time.time() - created_at) if self.ttl else 0
+        if self.ttl and remaining <= 0:
+            return None
+        value = (AIMessage(**json.loads(message_json)), latency)
+        self.memory.set(key, value, ttl=remaining)
+        with self._db_lock:
+            self._disk_hits += 1
+        return value
+
+    def put(self, key: str, message: AIMessage, latency: float) -> None:
+        self.memory.set(key, (message, latency), ttl=self.ttl)
+        if self.db_path:
+            try:
+                self._db_put(key, json.dumps(message.model_dump(), default=str), latency)
+            except sqlite3.Error as e:
+                log.warning("LLM_CACHE", f"Could not persist a response: {e}")
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.db_path:
+            with self._db_lock:
+                self._connection().execute("DELETE FROM llm_responses")
+                self._connection().commit()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.memory.stats()
+        with self._db_lock:
+            stats["disk_hits"] = self._disk_hits
+        return stats
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses "
+                "(key TEXT PRIMARY KEY, message TEXT NOT NULL, latency REAL NOT NULL, created_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _db_get(self, key: str) -> Optional[Tuple[str, float, float]]:
+        try:
+            with self._db_lock:
+                return self._connection().execute(
+                    "SELECT message, latency, created_at FROM llm_responses WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            log.warning("LLM_CACHE", f"Could not read the response cache: {e}")
+            return None
+
+    def _db_put(self, key: str, message_json: str, latency: float) -> None:
+        now = time.time()
+        with self._db_lock:
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, message, latency, created_at) VALUES (?, ?, ?, ?)",
+                (key, message_json, latency, now),
+            )
+            if self.ttl:
+                db.execute("DELETE FROM llm_responses WHERE created_at < ?", (now - self.ttl,))
+            db.commit()
+
+
+# --- Single-Flight ---
+
+class _LeaderGone(Exception):
+    """The leader's call was cancelled; its followers make their own."""
+
+
+class SingleFlight:
+    """Identical requests in flight: the first caller leads, later ones wait for its future."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+
+    def join(self, key: str) -> Tuple[bool, Future]:
+        """Returns (True, future) to the caller that must make the call, (False, future) to the others."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return False, future
+            future = self._calls[key] = Future()
+            return True, future
+
+    def finish(self, key: str, future: Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is None:
+            future.set_result(result)
+        else:
+            # Followers share an error from the model, but not the leader's cancellation.
+            future.set_exception(error if isinstance(error, Exception) else _LeaderGone())
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+# --- Accounting ---
+
+class LLMUsage:
+    """Model calls, tokens and cost per guild, and per model how calls were answered."""
+
+    def __init__(self, prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.prices = prices or {}
+        self._lock = threading.Lock()
+        self._guilds: Dict[str, Dict[str, float]] = {}
+        self._models: Dict[str, Dict[str, float]] = {}
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+    def record_call(self, model: str, usage: Optional[Dict[str, Any]], seconds: float) -> None:
+        input_tokens, output_tokens = _tokens(usage)
+        cost = self.cost(model, input_tokens, output_tokens)
+        guild = str(get_guild_id() or "")
+        with self._lock:
+            self._add(self._guild(guild), calls=1, input_tokens=input_tokens, output_tokens=output_tokens, cost=cost)
+            self._add(self._model(model), calls=1, model_seconds=seconds)
+        llm_requests_total.inc(model=model, outcome="called")
+        guild_llm_tokens.inc(input_tokens, guild=guild, kind="input")
+        guild_llm_tokens.inc(output_tokens, guild=guild, kind="output")
+        guild_llm_cost.inc(cost, guild=guild)
+
+    def record_saved(self, model: str, outcome: str, usage: Optional[Dict[str, Any]], seconds: float) -> None:
+        """A request answered without a model call: `outcome` is "cache_hit" or "coalesced"."""
+        input_tokens, output_tokens = _tokens(usage)
+        saved_cost = self.cost(model, input_tokens, output_tokens)
+        with self._lock:
+            self._add(self._guild(str(get_guild_id() or "")), **{outcome: 1}, saved_cost=saved_cost)
+            self._add(self._model(model), **{outcome: 1}, saved_seconds=seconds, saved_tokens=input_tokens + output_tokens)
+        llm_requests_total.inc(model=model, outcome=outcome)
+        llm_saved_seconds.inc(seconds, model=model)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        with self._lock:
+            return {
+                "guilds": {guild: dict(values) for guild, values in self._guilds.items()},
+                "models": {model: dict(values) for model, values in self._models.items()},
+            }
+
+    def _guild(self, guild: str) -> Dict[str, float]:
+        return self._guilds.setdefault(guild, {})
+
+    def _model(self, model: str) -> Dict[str, float]:
+        return self._models.setdefault(model, {})
+
+    @staticmethod
+    def _add(values: Dict[str, float], **amounts: float) -> None:
+        for name, amount in amounts.items():
+            values[name] = values.get(name, 0) + amount
+
+
+def _tokens(usage: Optional[Dict[str, Any]]) -> Tuple[int, int]:
+    usage = usage or {}
+    return usage.get("input_tokens") or 0, usage.get("output_tokens") or 0
+
+
+def merge_usage(snapshots: Iterable[Dict[str, Dict[str, Dict[str, float]]]]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Adds up `LLMUsage.snapshot()`s, e.g. the bot's and those its worker processes report."""
+    merged: Dict[str, Dict[str, Dict[str, float]]] = {"guilds": {}, "models": {}}
+    for snapshot in snapshots:
+        for section in ("guilds", "models"):
+            for name, values in (snapshot or {}).get(section, {}).items():
+                LLMUsage._add(merged[section].setdefault(name, {}), **values)
+    return merged
+
+
+# --- Chat Model Wrapper ---
+
+def _served(message: AIMessage, outcome: str) -> AIMessage:
+    """
+    A copy of a shared response for one caller; it cost no tokens of its own. Its tool
+    calls get fresh ids, so no two conversations hold calls with the same id.
+    """
+    return message.model_copy(update={
+        "tool_calls": [{**call, "id": f"call_{uuid.uuid4().hex}"} for call in message.tool_calls],
+        "usage_metadata": None,
+        "response_metadata": {**message.response_metadata, "served_by": outcome},
+    })
+
+
+def _as_chunk(message: AIMessage) -> ChatGenerationChunk:
+    return ChatGenerationChunk(message=AIMessageChunk(
+        content=message.content,
+        tool_calls=message.tool_calls,
+        response_metadata=message.response_metadata,
+        id=message.id,
+    ))
+
+
+class CachedChatModel(BaseChatModel):
+    """
+    Wraps a chat model with single-flight, an optional response cache and usage
+    accounting. `bind_tools` binds the wrapped model's tool options to this wrapper,
+    so the tool schemas become part of the cache key. Streaming is passed through;
+    a cached or coalesced response arrives as one chunk.
+    """
+
+    inner: Any
+    model_name: str
+    response_cache: Any = None
+    flights: Any = None
+    usage: Any = None
+    tools_key: str = ""
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cached-{self.inner._llm_type}"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+        bound = self.inner.bind_tools(tools, **kwargs)
+        options = getattr(bound, "kwargs", {})
+        return self.model_copy(update={"tools_key": tools_key(tools, kwargs)}).bind(**options)
+
+    # --- Sync ---
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                  **kwargs: Any) -> ChatResult:
+        key, served = self._lookup(messages, stop, kwargs)
+        if served is not None:
+            return ChatResult(generations=[ChatGeneration(message=served)])
+        leader, flight = self._join(key)
+        if not leader:
+            waited = time.perf_counter()
+            try:
+                return ChatResult(generations=[ChatGeneration(message=self._follow(flight.result(), waited))])
+            except _LeaderGone:
+                pass
+        started = time.perf_counter()
+        try:
+            message = self.inner.invoke(messages, stop=stop, **kwargs)
+        except BaseException as e:
+            self._abandon(key, flight, leader, e)
+            raise
+        self._complete(key, flight, leader, message, time.perf_counter() - started)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        key, served = self._lookup(messages, stop, kwargs)
+        if served is None:
+            leader, flight = self._join(key)
+            if not leader:
+                waited = time.perf_counter()
+                try:
+                    served = self._follow(flight.result(), waited)
+                except _LeaderGone:
+                    leader = False
+        if served is not None:
+            chunk = _as_chunk(served)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        started = time.perf_counter()
+        full = None
+        try:
+            for chunk in self.inner.stream(messages, stop=stop, **kwargs):
+                full = chunk if full is None else full + chunk
+                generation = ChatGenerationChunk(message=chunk)
+                if run_manager:
+                    run_manager.on_llm_new_token(generation.text, chunk=generation)
+                yield generation
+        except BaseException as e:
+            self._abandon(key, flight, leader, e)
+            raise
+        self._complete(key, flight, leader, message_chunk_to_message(full or AIMessageChunk(content="")),
+                       time.perf_counter() - started)
+
+    # --- Async ---
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                         **kwargs: Any) -> ChatResult:
+        key, served = await self._alookup(messages, stop, kwargs)
+        if served is not None:
+            return ChatResult(generations=[ChatGeneration(message=served)])
+        leader, flight = self._join(key)
+        if not leader:
+            waited = time.perf_counter()
+            try:
+                result = await asyncio.shield(asyncio.wrap_future(flight))
+                return ChatResult(generations=[ChatGeneration(message=self._follow(result, waited))])
+            except _LeaderGone:
+                pass
+        started = time.perf_counter()
+        try:
+            message = await self.inner.ainvoke(messages, stop=stop, **kwargs)
+        except BaseException as e:
+            self._abandon(key, flight, leader, e)
+            raise
+        await self._acomplete(key, flight, leader, message, time.perf_counter() - started)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        key, served = await self._alookup(messages, stop, kwargs)
+        if served is None:
+            leader, flight = self._join(key)
+            if not leader:
+                waited = time.perf_counter()
+                try:
+                    served = self._follow(await asyncio.shield(asyncio.wrap_future(flight)), waited)
+                except _LeaderGone:
+                    leader = False
+        if served is not None:
+            chunk = _as_chunk(served)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+            return
+        started = time.perf_counter()
+        full = None
+        try:
+            async for chunk in self.inner.astream(messages, stop=stop, **kwargs):
+                full = chunk if full is None else full + chunk
+                generation = ChatGenerationChunk(message=chunk)
+                if run_manager:
+                    await run_manager.on_llm_new_token(generation.text, chunk=generation)
+                yield generation
+        except BaseException as e:
+            self._abandon(key, flight, leader, e)
+            raise
+        await self._acomplete(key, flight, leader, message_chunk_to_message(full or AIMessageChunk(content="")),
+                              time.perf_counter() - started)
+
+    # --- Shared Steps ---
+
+    def _key(self, messages: Sequence[BaseMessage], stop: Optional[List[str]], options: Dict[str, Any]) -> str:
+        return request_key(self.model_name, self.tools_key, messages, {**options, "stop": stop})
+
+    def _lookup(self, messages, stop, options) -> Tuple[str, Optional[AIMessage]]:
+        key = self._key(messages, stop, options)
+        if self.response_cache is None:
+            return key, None
+        cached = self.response_cache.get(key)
+        if cached is None:
+            return key, None
+        message, latency = cached
+        self._record_saved("cache_hit", message, latency)
+        return key, _served(message, "cache")
+
+    async def _alookup(self, messages, stop, options) -> Tuple[str, Optional[AIMessage]]:
+        if self.response_cache is not None and self.response_cache.db_path:
+            # A memory miss reads SQLite; keep that off the event loop.
+            return await asyncio.to_thread(self._lookup, messages, stop, options)
+        return self._lookup(messages, stop, options)
+
+    def _join(self, key: str) -> Tuple[bool, Optional[Future]]:
+        if self.flights is None:
+            return True, None
+        return self.flights.join(key)
+
+    def _follow(self, result: Tuple[AIMessage, float], waited_since: float) -> AIMessage:
+        message, latency = result
+        self._record_saved("coalesced", message, max(0.0, latency - (time.perf_counter() - waited_since)))
+        return _served(message, "single_flight")
+
+    def _record_saved(self, outcome: str, message: AIMessage, seconds: float) -> None:
+        if self.usage is not None:
+            self.usage.record_saved(self.model_name, outcome, message.usage_metadata, seconds)
+        log.debug("LLM_CACHE", f"Answered a {self.model_name} request by {outcome}", saved_seconds=round(seconds, 3))
+
+    def _abandon(self, key: str, flight: Optional[Future], leader: bool, error: BaseException) -> None:
+        if leader and flight is not None:
+            self.flights.finish(key, flight, error=error)
+
+    def _store(self, key: str, message: AIMessage, latency: float) -> None:
+        if self.usage is not None:
+            self.usage.record_call(self.model_name, message.usage_metadata, latency)
+        if self.response_cache is not None and _cacheable(message):
+            self.response_cache.put(key, message, latency)
+
+    def _complete(self, key: str, flight: Optional[Future], leader: bool, message: AIMessage, latency: float) -> None:
+        try:
+            self._store(key, message, latency)
+        finally:
+            if leader and flight is not None:
+                self.flights.finish(key, flight, result=(message, latency))
+
+    async def _acomplete(self, key: str, flight: Optional[Future], leader: bool, message: AIMessage,
+                         latency: float) -> None:
+        try:
+            if self.response_cache is not None and self.response_cache.db_path:
+                await asyncio.to_thread(self._store, key, message, latency)
+            else:
+                self._store(key, message, latency)
+        finally:
+            if leader and flight is not None:
+                self.flights.finish(key, flight, result=(message, latency))
+
+
+def _cacheable(message: AIMessage) -> bool:
+    """Only complete answers are reused: text or tool calls, ended normally."""
+    if not (message.content or message.tool_calls) or message.invalid_tool_calls:
+        return False
+    return message.response_metadata.get("finish_reason") in _COMPLETE_FINISH_REASONS
+
+
+# --- Shared Instances ---
+
+_lock = threading.Lock()
+_response_cache: Optional[ResponseCache] = None
+_flights = SingleFlight()
+_usage: Optional[LLMUsage] = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """The process-wide response cache, or None when `LLM_CACHE_ENABLED` is off."""
+    global _response_cache
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    with _lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                max_entries=config.LLM_CACHE_MAX_ENTRIES, ttl=config.LLM_CACHE_TTL, db_path=config.LLM_CACHE_DB_PATH
+            )
+        return _response_cache
+
+
+def get_llm_usage() -> LLMUsage:
+    global _usage
+    with _lock:
+        if _usage is None:
+            _usage = LLMUsage(parse_prices(config.LLM_PRICES))
+        return _usage
+
+
+def cached_chat_model(inner: BaseChatModel, model_name: str, cache: bool = True) -> CachedChatModel:
+    """
+    Wraps a model client with the shared single-flight table and usage accounting, and
+    with the response cache when `cache` is set and caching is enabled.
+    """
+    return CachedChatModel(
+        inner=inner,
+        model_name=model_name,
+        response_cache=get_response_cache() if cache else None,
+        flights=_flights if config.LLM_COALESCE_ENABLED else None,
+        usage=get_llm_usage(),
+    )
+
+
+def llm_cache_stats() -> Dict[str, Any]:
+    cache = get_response_cache()
+    return {"cache": cache.stats() if cache is not None else None, "in_flight": _flights.in_flight()}
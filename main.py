@@ -1,40 +1,95 @@
 import discord
 from discord.ext import commands
+import io
 import os
 import asyncio
-from config import DISCORD_TOKEN
-from lang.graph.graph import app
-from lang.tools.file_processor import process_uploaded_file
+import contextvars
+from cluster import Job, get_job_dispatcher
+from config import (
+    DISCORD_SHARD_COUNT, DISCORD_TOKEN, GRAPH_EXECUTION_MODE, METRICS_PORT, OUTPUT_DIR, STARTUP_PREWARM, STREAM_RESPONSES,
+    UPLOAD_DIR,
+)
+from lang.graph.graph import app, checkpointer
+from lang.graph.router import ROUTE_IMAGE, classify
+from lang.tools.artifacts import artifacts_from_state, get_artifact_store
+from lang.tools.image_jobs import get_image_jobs
+from lang.tools.file_processor import (
+    AttachmentTooLargeError, process_uploaded_file, read_attachment, remove_spooled_uploads, user_content
+)
+from lang.db.pool import DatabaseUnavailableError
+from lang.db.sources import get_data_sources
+from lang.db.cache import get_query_cache
+from lang.db.guard import get_query_guard, statement_tracker
+from lang.db.upload_store import get_upload_store
 from langchain_core.messages import HumanMessage
-from utils import find_excel_path_in_response, find_image_path_in_response
+from llm_cache import get_llm_usage, get_response_cache, llm_cache_stats, merge_usage
+from registry import registry
+from scheduler import Priority, RateLimitedError, SchedulerBusyError, ThreadTurns, get_scheduler
+from streaming import ProgressiveReply, token_streams
+from telemetry import current_span, get_logger, start_metrics_server, start_trace, trace
+from utils import split_message
+
+log = get_logger(__name__)
 
 # --- Bot Initialization ---
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Sharded, so one process can hold the gateway connections of many servers; with worker
+# processes (BOT_WORKERS / JOB_TRANSPORT) it only receives mentions and posts replies.
+bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=DISCORD_SHARD_COUNT)
+
+# The task handling the request currently running in each thread, so `!cancel` can stop it.
+running_requests = {}
+# One request per thread at a time.
+thread_turns = ThreadTurns()
 
 @bot.event
 async def on_ready():
     """
     Handles the event when the bot successfully connects to Discord.
     """
-    print(f"------- BOT IS ONLINE -------")
-    print(f"Logged in as: {bot.user.name}")
-    print(f"Bot ID: {bot.user.id}")
-    if not os.path.exists("uploads"):
-        os.makedirs("uploads")
-        print("--- [MAIN] Created 'uploads' directory. ---")
-    if not os.path.exists("output"):
-        os.makedirs("output")
-        print("--- [MAIN] Created 'output' directory. ---")
-    print("-----------------------------")
+    log.info("MAIN", f"Bot is online, logged in as {bot.user.name} (id {bot.user.id})")
+    if not os.path.exists(UPLOAD_DIR):
+        os.makedirs(UPLOAD_DIR)
+        log.info("MAIN", f"Created '{UPLOAD_DIR}' directory.")
+    removed = remove_spooled_uploads()
+    if removed:
+        log.info("MAIN", f"Removed {removed} upload file(s) left over from the previous run.")
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+        log.info("MAIN", f"Created '{OUTPUT_DIR}' directory.")
+    # Exports and images from earlier runs are deleted once past their age and size limits.
+    asyncio.get_event_loop().run_in_executor(None, get_artifact_store().collect)
+    if METRICS_PORT:
+        try:
+            start_metrics_server()
+        except OSError as e:
+            log.error("MAIN", f"Could not start the metrics endpoint: {e}")
+    # Worker processes open their own database pools and model clients.
+    dispatcher = get_job_dispatcher()
+    if dispatcher is not None:
+        await dispatcher.start()
+        log.info("MAIN", "Requests are handed to worker processes.")
+        return
+    # Open the minimum number of pooled DB connections of every data source without blocking the event loop.
+    # In async mode the driver pools open on first checkout from the event loop instead.
+    if GRAPH_EXECUTION_MODE != "async":
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, get_data_sources().warm)
+            log.info("MAIN", "Database connection pools warmed.")
+        except (DatabaseUnavailableError, ValueError) as e:
+            log.error("MAIN", f"Could not warm database connection pools: {e}")
+    # Build model clients and the agent in the background; the bot already answers meanwhile.
+    if STARTUP_PREWARM:
+        asyncio.get_event_loop().run_in_executor(None, registry.prewarm, STARTUP_PREWARM)
+        log.info("MAIN", f"Pre-warming in the background: {', '.join(STARTUP_PREWARM)}")
 
 @bot.command(name="helpme")
 async def help_command(ctx):
     """
     Displays a help message with instructions on how to use the bot.
     """
-    print(f"--- [COMMAND] !help executed by {ctx.author} ---")
+    log.info("COMMAND", f"!help executed by {ctx.author}")
     help_text = """
     **Hello! I am an AI assistant.**
 
@@ -53,6 +108,195 @@ async def help_command(ctx):
     """
     await ctx.send(help_text)
 
+@bot.command(name="poolstats")
+async def pool_stats_command(ctx):
+    """
+    Displays the connection pool metrics of every data source endpoint.
+    """
+    log.info("COMMAND", f"!poolstats executed by {ctx.author}")
+    lines = []
+    for name, source in get_data_sources().sources.items():
+        lines.append(f"**Data source `{name}`**")
+        pools = source.pool_metrics(GRAPH_EXECUTION_MODE == "async")
+        for endpoint in source.status():
+            state = "up" if endpoint["up"] else f"down ({endpoint['last_error']})"
+            lines.append(
+                f"- `{endpoint['label']}` ({endpoint['driver']}): {state}, {endpoint['in_flight']} in flight, "
+                f"{endpoint['checkouts']} checkouts, {endpoint['failures']} failures"
+            )
+            stats = pools.get(endpoint["label"])
+            if stats is None:
+                lines.append("  - Pool not opened yet")
+                continue
+            lines.append(f"  - Size: {stats['size']}/{stats['max_size']} (in use: {stats['in_use']}, idle: {stats['idle']})")
+            lines.append(f"  - Checkouts: {stats['checkouts']} (timeouts: {stats['checkout_timeouts']})")
+            lines.append(f"  - Wait time: avg {stats['wait_time_avg'] * 1000:.1f} ms, max {stats['wait_time_max'] * 1000:.1f} ms")
+            lines.append(f"  - Failed handshakes: {stats['failed_handshakes']}, health check failures: {stats.get('health_check_failures', 0)}")
+            lines.append(f"  - Idle evictions: {stats.get('idle_evictions', 0)}")
+            lines.append(f"  - Statements interrupted (timeouts/cancellations): {stats['interrupts']}")
+    # Many sources and replicas can outgrow one Discord message.
+    for chunk in split_message("\n".join(lines)):
+        await ctx.send(chunk)
+
+@bot.command(name="cachestats")
+async def cache_stats_command(ctx):
+    """
+    Displays hit/miss counters for the question and result caches.
+    """
+    log.info("COMMAND", f"!cachestats executed by {ctx.author}")
+    lines = ["**Query cache**"]
+    for level in get_query_cache().stats().values():
+        lines.append(
+            f"- `{level['name']}`: {level['hits']} hits, {level['misses']} misses "
+            f"({level['hit_rate']:.0%} hit rate), {level['entries']} entries, "
+            f"{level['evictions']} evictions, {level['invalidations']} invalidations"
+        )
+    lines.append("**Model responses**")
+    llm = llm_cache_stats()
+    if llm["cache"] is not None:
+        cache = llm["cache"]
+        lines.append(
+            f"- Response cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%} hit rate), "
+            f"{cache['entries']} entries, {cache['disk_hits']} from disk"
+        )
+    for model, counts in _llm_usage()["models"].items():
+        answered = counts.get("calls", 0) + counts.get("cache_hit", 0) + counts.get("coalesced", 0)
+        saved = counts.get("cache_hit", 0) + counts.get("coalesced", 0)
+        lines.append(
+            f"- `{model}`: {int(answered)} requests, {int(counts.get('calls', 0))} model calls, "
+            f"{int(counts.get('cache_hit', 0))} cached, {int(counts.get('coalesced', 0))} coalesced "
+            f"({saved / answered if answered else 0:.0%} saved), {counts.get('saved_seconds', 0):.1f}s of model time saved"
+        )
+    await ctx.send("\n".join(lines))
+
+@bot.command(name="usage")
+async def usage_command(ctx):
+    """
+    Displays the model tokens and estimated cost this server has used since the bot started.
+    """
+    log.info("COMMAND", f"!usage executed by {ctx.author}")
+    guild_id = str(ctx.guild.id) if ctx.guild else f"dm-{ctx.author.id}"
+    usage = _llm_usage()["guilds"].get(guild_id, {})
+    await ctx.send(
+        "**Model usage for this server**\n"
+        f"- Model calls: {int(usage.get('calls', 0))} "
+        f"(plus {int(usage.get('cache_hit', 0))} cached and {int(usage.get('coalesced', 0))} shared answers)\n"
+        f"- Tokens: {int(usage.get('input_tokens', 0)):,} in, {int(usage.get('output_tokens', 0)):,} out\n"
+        f"- Estimated cost: ${usage.get('cost', 0):.4f} (saved: ${usage.get('saved_cost', 0):.4f})"
+    )
+
+def _llm_usage():
+    """Model usage of this process and, in the scale-out deployment, of every worker."""
+    snapshots = [get_llm_usage().snapshot()]
+    dispatcher = get_job_dispatcher()
+    if dispatcher is not None:
+        snapshots += [worker["llm"] for worker in dispatcher.stats()["per_worker"].values()]
+    return merge_usage(snapshots)
+
+@bot.command(name="clearcache")
+async def clear_cache_command(ctx, *tables):
+    """
+    Invalidates cached questions and results, optionally only for the given tables.
+    """
+    log.info("COMMAND", f"!clearcache executed by {ctx.author}")
+    if tables:
+        get_query_cache().invalidate_tables(tables)
+        await ctx.send(f"Cleared cached results for: {', '.join(tables)}")
+    else:
+        get_query_cache().clear()
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            await asyncio.to_thread(response_cache.clear)
+        await ctx.send("Cleared all cached questions, results and model responses.")
+
+@bot.command(name="queuestats")
+async def queue_stats_command(ctx):
+    """
+    Displays request scheduler, image job and worker metrics: running and queued requests, rejections and wait times.
+    """
+    log.info("COMMAND", f"!queuestats executed by {ctx.author}")
+    metrics = get_scheduler().metrics()
+    queued = metrics["queued_by_priority"]
+    images = get_image_jobs().stats()
+    dispatcher = get_job_dispatcher()
+    workers = ""
+    if dispatcher is not None:
+        jobs = dispatcher.stats()
+        workers = (
+            f"\n**Workers**\n"
+            f"- Live: {jobs['workers']} ({jobs['slots']} slots), running: {jobs['running']}, waiting for a worker: {jobs['waiting']}\n"
+            f"- Completed: {jobs['completed']}, failed: {jobs['failed']}, redelivered: {jobs['redelivered']} "
+            f"(duplicate results: {jobs['duplicates']}), workers lost: {jobs['lost_workers']}, restarted: {jobs['restarts']}"
+        )
+    await ctx.send(
+        "**Request scheduler**\n"
+        f"- Running: {metrics['running']}/{metrics['max_concurrency']} ({metrics['running_images']} image)\n"
+        f"- Queued: {metrics['queued']} ({queued['text']} text, {queued['image']} image)\n"
+        f"- Completed: {metrics['completed']}, rate limited: {metrics['rate_limited']}, "
+        f"rejected (queue full): {metrics['rejected_busy']}\n"
+        f"- Wait time: avg {metrics['wait_time_avg'] * 1000:.1f} ms, max {metrics['wait_time_max'] * 1000:.1f} ms\n"
+        f"**Image jobs**\n"
+        f"- Running: {images['running']}/{images['workers']}, waiting: {images['waiting']}/{images['max_pending']}\n"
+        f"- Generated: {images['generated']}, reused: {images['cache_hits']} cached + {images['joined']} in flight, "
+        f"failed: {images['failed']}, rejected: {images['rejected']}"
+        + workers
+    )
+
+@bot.command(name="guardstats")
+async def guard_stats_command(ctx):
+    """
+    Displays query guardrail counters: plan estimates, rewrites and rejections.
+    """
+    log.info("COMMAND", f"!guardstats executed by {ctx.author}")
+    stats = get_query_guard().metrics()
+    lines = ["**Query guardrails**"]
+    lines.append(f"- Checked: {stats['checked']} (allowed: {stats['allowed']}, limited: {stats['rewritten']}, rejected: {stats['rejected']})")
+    if stats["rejections"]:
+        lines.append("- Rejections: " + ", ".join(f"{reason} {count}" for reason, count in sorted(stats["rejections"].items())))
+    lines.append(
+        f"- EXPLAIN: {stats['explained']} run, avg {stats['explain_time_avg'] * 1000:.1f} ms, "
+        f"{stats['plan_cache']['hits']} plan cache hits, {stats['explain_failures']} failures"
+    )
+    lines.append(f"- Largest estimate: {stats['estimated_rows_max']:,} rows examined")
+    await ctx.send("\n".join(lines))
+
+@bot.command(name="forget")
+async def forget_command(ctx):
+    """
+    Clears the conversation memory and uploaded tables of the current thread.
+    """
+    log.info("COMMAND", f"!forget executed by {ctx.author}")
+    if not isinstance(ctx.channel, discord.Thread):
+        await ctx.send("Use this command inside a conversation thread.")
+        return
+    if GRAPH_EXECUTION_MODE == "async":
+        await checkpointer.adelete_thread(str(ctx.channel.id))
+    else:
+        await asyncio.get_event_loop().run_in_executor(None, checkpointer.delete_thread, str(ctx.channel.id))
+    get_upload_store().drop_thread(str(ctx.channel.id))
+    dispatcher = get_job_dispatcher()
+    if dispatcher is not None:
+        # Uploaded tables live in the worker that loaded them.
+        dispatcher.broadcast({"type": "forget", "thread_id": str(ctx.channel.id)})
+    await ctx.send("I have forgotten this conversation.")
+
+@bot.command(name="cancel")
+async def cancel_command(ctx):
+    """
+    Cancels the request running in the current thread and kills its database queries.
+    """
+    log.info("COMMAND", f"!cancel executed by {ctx.author}")
+    thread_id = str(ctx.channel.id)
+    task = running_requests.get(thread_id)
+    if task is None or task.done():
+        await ctx.send("There is no request running in this thread.")
+        return
+    # Thread mode: the graph keeps running on its worker thread, so kill its statements directly.
+    # Async mode: cancelling the task cancels the awaiting statements, which kill themselves.
+    killed = statement_tracker.cancel_thread(thread_id)
+    task.cancel()
+    await ctx.send(f"Request cancelled ({killed} running quer{'y' if killed == 1 else 'ies'} stopped).")
+
 @bot.event
 async def on_message(message):
     """
@@ -62,92 +306,251 @@ async def on_message(message):
     if message.author == bot.user:
         return
 
+    # Overriding on_message disables command dispatch, so hand `!` commands over explicitly.
+    if message.content.startswith(bot.command_prefix):
+        await bot.process_commands(message)
+        return
+
+    # Replies inside a thread the bot opened continue that conversation without a mention.
+    in_thread = isinstance(message.channel, discord.Thread)
+    in_bot_thread = in_thread and message.channel.owner_id == bot.user.id
+
     # Process messages where the bot is mentioned.
-    if bot.user.mentioned_in(message):
-        # Extract the user's message, removing the bot's mention.
-        user_message = message.content.replace(f"<@{bot.user.id}>", "").strip()
-        print(f"--- [ON_MESSAGE] Received mention from {message.author}: '{user_message}' ---")
-
-        # Create a new thread for the conversation to keep the channel clean.
-        thread = await message.channel.create_thread(
-            name=f"Responding to {message.author.display_name}",
-            type=discord.ChannelType.public_thread
-        )
-        
+    if bot.user.mentioned_in(message) or in_bot_thread:
+        # Every request is one trace: receive, download, file processing, routing, model and
+        # tool calls, queries and the reply to Discord are its spans.
+        with start_trace("discord.request", mode=GRAPH_EXECUTION_MODE):
+            await handle_mention(message, in_thread)
+
+async def handle_mention(message, in_thread: bool):
+    """
+    Answers a mention (or a reply in one of the bot's threads) through the LangGraph workflow.
+    """
+    # Extract the user's message, removing the bot's mention.
+    user_message = message.content.replace(f"<@{bot.user.id}>", "").strip()
+    log.info("ON_MESSAGE", f"Received mention from {message.author}", chars=len(user_message))
+    log.debug("ON_MESSAGE", "Mention text", text=user_message)
+
+    # Rate limits apply before any work (thread creation, downloads) is done for the request.
+    user_id = str(message.author.id)
+    guild_id = str(message.guild.id) if message.guild else f"dm-{user_id}"
+    current_span().set(guild=guild_id)
+    try:
+        get_scheduler().check_rate(user_id, guild_id)
+    except RateLimitedError as e:
+        await message.reply(f"You are sending requests too quickly. Please try again in {e.retry_after:.0f} seconds.")
+        return
+
+    with trace("discord.acknowledge"):
+        if in_thread:
+            # Continue in the existing thread; its id keys the conversation memory.
+            thread = message.channel
+        else:
+            # Create a new thread for the conversation to keep the channel clean.
+            thread = await message.channel.create_thread(
+                name=f"Responding to {message.author.display_name}",
+                type=discord.ChannelType.public_thread
+            )
+
         # Send an initial status message to acknowledge the request.
         status_message = await thread.send("Processing your request...")
 
-        # Initialize the content to be sent to the language model.
-        final_user_content = user_message
+    # Requests in one thread share its conversation and listeners; a reply sent while the
+    # previous request still runs waits for it.
+    thread_id = str(thread.id)
+    waited = thread_turns.busy(thread_id)
+    if waited:
+        await status_message.edit(content="Waiting for the previous request in this thread to finish...")
+    async with thread_turns.turn(thread_id):
+        if waited:
+            await status_message.edit(content="Processing your request...")
+        await answer_request(message, thread, status_message, user_message, user_id, guild_id, in_thread)
 
-        try:
-            # --- Attachment Handling ---
-            if message.attachments:
-                print(f"--- [ON_MESSAGE] Found {len(message.attachments)} attachment(s). ---")
-                attachment = message.attachments[0]
-                file_path = os.path.join("uploads", attachment.filename)
-                await attachment.save(file_path)
-                print(f"--- [ON_MESSAGE] Saved attachment to {file_path} ---")
-
-                # Process the uploaded file to extract its content.
-                processed_file = process_uploaded_file(file_path)
-
-                # Prepare the input for the language model based on the file type.
-                if processed_file['type'] == 'image':
-                    image_data = processed_file['content']
-                    final_user_content = [
-                        {"type": "text", "text": user_message},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                    ]
-                    print("--- [ON_MESSAGE] Prepared multimodal input for LLM (image). ---")
-                else:
-                    # For text-based files, prepend the content to the user's message.
-                    file_text_content = processed_file['content']
-                    final_user_content = f"File Content:\n{file_text_content}\n\n---\n\nUser Question: {user_message}"
-                    print("--- [ON_MESSAGE] Prepended text file content to user message. ---")
-
-            # --- LangGraph Invocation ---
+async def answer_request(message, thread, status_message, user_message: str, user_id: str, guild_id: str, in_thread: bool):
+    """
+    Runs one request through the graph (or a worker) and replies in its thread. Only one
+    runs per thread at a time (`thread_turns`).
+    """
+    thread_id = str(thread.id)
+    statement_tracker.reset(thread_id)
+    running_requests[thread_id] = asyncio.current_task()
+
+    # Image jobs report their queue position and progress from worker threads; edit the status on the loop.
+    loop = asyncio.get_running_loop()
+    get_image_jobs().watch(
+        thread_id, lambda text: asyncio.run_coroutine_threadsafe(status_message.edit(content=text), loop)
+    )
+    # The answer is shown while the model writes it; tokens may arrive from the graph's worker thread.
+    reply = ProgressiveReply(thread, status_message)
+    if STREAM_RESPONSES:
+        token_streams.watch(thread_id, lambda text: loop.call_soon_threadsafe(reply.feed, text))
+
+    # Initialize the content to be sent to the language model.
+    final_user_content = user_message
+    has_image = False
+    # With worker processes, the request (and its attachment) is handed to one of them as a job.
+    dispatcher = get_job_dispatcher()
+    job_attachment = None
+
+    try:
+        # --- Attachment Handling ---
+        if message.attachments:
+            log.info("ON_MESSAGE", f"Found {len(message.attachments)} attachment(s).")
+            attachment = message.attachments[0]
+            try:
+                # Small attachments stay in memory; large ones go to a uniquely named file.
+                with trace("discord.attachment_download", bytes=attachment.size):
+                    upload = await read_attachment(attachment)
+            except AttachmentTooLargeError as e:
+                await reply.finish(f"That file is too large to process ({e.size / 1e6:.1f} MB, the limit is {e.limit / 1e6:.0f} MB).", answer=False)
+                return
+            log.info("ON_MESSAGE", f"Received attachment {upload.filename}", bytes=upload.size, in_memory=upload.data is not None)
+
+            if dispatcher is not None:
+                # The worker parses the file; only its bytes travel with the job.
+                has_image = upload.is_image
+                try:
+                    with upload.open() as f:
+                        job_attachment = (upload.filename, f.read())
+                finally:
+                    upload.discard()
+            else:
+                # Process the uploaded file to extract its content. Spreadsheets are bulk-loaded
+                # into the thread's SQL store, so keep the potentially long load off the event loop.
+                # The copied context keeps the worker's spans in this request's trace.
+                try:
+                    with trace("file.process"):
+                        processed_file = await asyncio.get_event_loop().run_in_executor(
+                            None, contextvars.copy_context().run, process_uploaded_file, upload, str(thread.id)
+                        )
+                finally:
+                    upload.discard()
+
+                # Prepare the input for the language model based on the file type:
+                # text and image parts for an image, the file's text before the question otherwise.
+                has_image = processed_file['type'] == 'image'
+                final_user_content = user_content(user_message, processed_file)
+                log.info("ON_MESSAGE", "Prepared model input from the attachment.", image=has_image)
+
+        # --- LangGraph Invocation ---
+        # The thread id selects the conversation checkpoint and per-thread state such as result pagination.
+        # The data source is picked by the channel (or the thread's parent channel) and the guild.
+        data_source = get_data_sources().resolve(
+            guild_id, str(message.channel.id), str(message.channel.parent_id) if in_thread else None
+        )
+        
+        # Text queries are cheap and go ahead of image generation in the queue.
+        priority = Priority.IMAGE if classify(user_message, has_image) == ROUTE_IMAGE else Priority.TEXT
+        was_queued = False
+
+        async def show_queue_position(position: int) -> None:
+            nonlocal was_queued
+            was_queued = True
+            await status_message.edit(content=f"The bot is busy. Your request is number {position} in the queue...")
+
+        def show_worker_progress(event: dict) -> None:
+            if event["type"] == "tokens" and STREAM_RESPONSES:
+                reply.feed(event["text"])
+            elif event["type"] == "status":
+                asyncio.create_task(status_message.edit(content=event["text"]))
+
+        async def invoke_graph():
+            if was_queued:
+                await status_message.edit(content="Processing your request...")
+            if dispatcher is not None:
+                log.info("ON_MESSAGE", "Sending the request to a worker process...")
+                job = Job(
+                    thread_id, user_message, data_source, job_attachment,
+                    guild_id=guild_id, max_file_bytes=getattr(message.guild, "filesize_limit", None),
+                )
+                with trace("worker.dispatch"):
+                    return await dispatcher.run(job, on_event=show_worker_progress)
             # Prepare the final input for the LangGraph agent.
             inputs = {"messages": [HumanMessage(content=final_user_content)]}
-            
-            print("--- [ON_MESSAGE] Invoking LangGraph with prepared inputs... ---")
-            # Run the synchronous LangGraph agent in a separate thread to avoid blocking.
-            loop = asyncio.get_event_loop()
-            final_state = await loop.run_in_executor(None, lambda: app.invoke(inputs))
-            
-            # Extract the final response from the agent's state.
-            print("--- [ON_MESSAGE] LangGraph invocation finished. Processing final state. ---")
-            response_content = str(final_state['messages'][-1].content).strip()
-
-            # --- Response Handling ---
-            # Check if the response contains a path to an Excel or image file.
-            excel_file_path = find_excel_path_in_response(response_content)
-            image_file_path = find_image_path_in_response(response_content)
-
-            if excel_file_path:
-                # If an Excel file was generated, send it as an attachment.
-                print(f"--- [ON_MESSAGE] Sending Excel file: {excel_file_path} ---")
-                await status_message.edit(content="Here is the Excel file you requested:")
-                await thread.send(file=discord.File(excel_file_path))
-            elif image_file_path:
-                # If an image file was generated, send it as an attachment.
-                print(f"--- [ON_MESSAGE] Sending Image file: {image_file_path} ---")
-                await status_message.edit(content="Here is your generated image:")
-                await thread.send(file=discord.File(image_file_path))
-            else:
-                # Otherwise, send the text-based response.
-                print(f"--- [ON_MESSAGE] No file path found. Sending text response. ---")
-                await status_message.edit(content=response_content)
+            run_config = {"configurable": {"thread_id": thread_id, "data_source": data_source, "guild_id": guild_id}}
+            log.info("ON_MESSAGE", f"Invoking LangGraph ({GRAPH_EXECUTION_MODE} mode) with prepared inputs...")
+            with trace("graph.invoke"):
+                if GRAPH_EXECUTION_MODE == "async":
+                    # Run the graph natively on the event loop; no thread is held while waiting on I/O.
+                    return await app.ainvoke(inputs, run_config)
+                # Run the synchronous LangGraph agent in a separate thread to avoid blocking.
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(None, contextvars.copy_context().run, app.invoke, inputs, run_config)
+
+        try:
+            outcome = await get_scheduler().run(
+                invoke_graph, user_id=user_id, guild_id=guild_id, priority=priority, on_position=show_queue_position
+            )
+        except SchedulerBusyError:
+            await reply.finish("The bot is too busy right now. Please try again in a minute.", answer=False)
+            return
+        
+        # Extract the final response and the files the tools created: from the worker's result,
+        # which carries the files themselves, or from the artifacts in the agent's final state.
+        log.info("ON_MESSAGE", "LangGraph invocation finished. Processing final state.")
+        if dispatcher is not None:
+            response_content = outcome["text"]
+            # Files over the upload limit come without their data; `send_files` names them instead.
+            files = [
+                (f["filename"], f["size"], io.BytesIO(f["data"]) if f["data"] is not None else None)
+                for f in outcome.get("files", [])
+            ]
+        else:
+            response_content = str(outcome['messages'][-1].content).strip()
+            files = [(artifact.filename, artifact.size, artifact.path) for artifact in artifacts_from_state(outcome)]
+
+        # --- Response Handling ---
+        # Uploading a file back to Discord can take longer than the query that produced it.
+        if not response_content and files:
+            response_content = "Here are the files you requested:"
+        with trace("discord.reply", files=len(files)):
+            # Replaces the streamed draft; long answers are split across messages or sent as a file.
+            await reply.finish(response_content)
+            if files:
+                log.info("ON_MESSAGE", f"Sending {len(files)} file(s): {', '.join(name for name, _, _ in files)}")
+                await send_files(thread, files)
 
-        except Exception as e:
-            # --- Error Handling ---
-            print(f"--- [ON_MESSAGE_ERROR] An unexpected error occurred: {e} ---")
-            await status_message.edit(content=f"An unexpected error occurred. Please check the logs.")
+    except asyncio.CancelledError:
+        log.info("ON_MESSAGE", f"Request in thread {thread_id} was cancelled.")
+        await reply.finish("Request cancelled.", answer=False)
+        raise
+    except Exception as e:
+        # --- Error Handling ---
+        log.error("ON_MESSAGE", f"An unexpected error occurred: {e}")
+        await reply.finish("An unexpected error occurred. Please check the logs.", answer=False)
+    finally:
+        if running_requests.get(thread_id) is asyncio.current_task():
+            del running_requests[thread_id]
+            get_image_jobs().unwatch(thread_id)
+            token_streams.unwatch(thread_id)
+
+# Discord accepts at most this many attachments per message.
+_FILES_PER_MESSAGE = 10
+
+async def send_files(channel, files):
+    """
+    Uploads a reply's files as (filename, size, source) entries, ten per message. A path
+    is opened off the event loop, and the upload reads it in chunks on executor threads.
+    A file over the server's upload limit is named in a message instead.
+    """
+    limit = getattr(channel.guild, "filesize_limit", None)
+    uploads = []
+    for filename, size, source in files:
+        if source is None or (limit and size > limit):
+            log.warning("ON_MESSAGE", f"{filename} is over the upload limit", bytes=size, limit=limit)
+            await channel.send(
+                f"`{filename}` is too large to upload here ({size / 1e6:.1f} MB, the limit is {(limit or 0) / 1e6:.0f} MB)."
+            )
+            continue
+        fp = await asyncio.to_thread(open, source, "rb") if isinstance(source, str) else source
+        uploads.append(discord.File(fp, filename=filename))
+    for start in range(0, len(uploads), _FILES_PER_MESSAGE):
+        await channel.send(files=uploads[start:start + _FILES_PER_MESSAGE])
 
 # --- Run the Bot ---
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
-        print("--- [FATAL_ERROR] DISCORD_TOKEN is not set. Please check your .env file. ---")
+        log.error("FATAL", "DISCORD_TOKEN is not set. Please check your .env file.")
     else:
-        print("--- [MAIN] Starting bot... ---")
+        log.info("MAIN", "Starting bot...")
         bot.run(DISCORD_TOKEN)
\ No newline at end of file
@@ -0,0 +1,92 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+
+class _Entry:
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.instance: Any = None
+        self.ready = False
+
+
+class LazyRegistry:
+    """
+    Named components that are built on first use instead of at import time.
+
+    `get` is thread-safe: concurrent first callers block on a per-component lock
+    and the factory runs exactly once. A factory that raises leaves the component
+    unbuilt, so the next caller retries instead of caching the failure.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        with self._lock:
+            self._entries[name] = _Entry(factory)
+
+    def get(self, name: str) -> Any:
+        entry = self._entry(name)
+        if entry.ready:
+            return entry.instance
+        with entry.lock:
+            if not entry.ready:
+                started = time.perf_counter()
+                entry.instance = entry.factory()
+                entry.ready = True
+                log.info("REGISTRY", f"Initialized '{name}' in {time.perf_counter() - started:.2f}s")
+        return entry.instance
+
+    def is_ready(self, name: str) -> bool:
+        return self._entry(name).ready
+
+    def override(self, name: str, instance: Any) -> None:
+        """Replaces a component with a ready-made instance (e.g. a fake in a benchmark)."""
+        entry = self._entry(name)
+        with entry.lock:
+            entry.instance, entry.ready = instance, True
+
+    def reset(self, name: str) -> None:
+        """Drops a built component so the next `get` rebuilds it."""
+        entry = self._entry(name)
+        with entry.lock:
+            entry.instance, entry.ready = None, False
+
+    def prewarm(self, names: Optional[Iterable[str]] = None) -> Dict[str, Optional[str]]:
+        """
+        Builds the given components (all registered ones by default) and returns
+        an error message per component that failed, or None for those that succeeded.
+        """
+        with self._lock:
+            targets = list(names) if names is not None else list(self._entries)
+        results: Dict[str, Optional[str]] = {}
+        for name in targets:
+            try:
+                self.get(name)
+                results[name] = None
+            except Exception as e:
+                log.error("REGISTRY", f"Pre-warming '{name}' failed: {e}")
+                results[name] = str(e)
+        return results
+
+    def status(self) -> Dict[str, bool]:
+        with self._lock:
+            return {name: entry.ready for name, entry in self._entries.items()}
+
+    def _entry(self, name: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(f"No component named '{name}' is registered.")
+        return entry
+
+
+# Process-wide registry for model clients and other expensive components.
+registry = LazyRegistry()
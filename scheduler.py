@@ -0,0 +1,319 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+import config
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+T = TypeVar("T")
+PositionCallback = Callable[[int], Awaitable[None]]
+
+# Idle buckets are pruned once this many are tracked; a pruned bucket is simply full again.
+_MAX_TRACKED_BUCKETS = 10_000
+
+
+class Priority(IntEnum):
+    """Request classes; lower values are dispatched first."""
+    TEXT = 0
+    IMAGE = 1
+
+
+class RateLimitedError(Exception):
+    """Raised when a user or guild has used up its request budget."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"{scope} rate limit exceeded; retry in {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class SchedulerBusyError(Exception):
+    """Raised when the wait queue is full."""
+
+
+class TokenBucket:
+    """Allows `capacity` requests at once, refilled at `rate` requests per second."""
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 if one is available now)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass(eq=False)
+class _Ticket:
+    user_id: str
+    guild_id: str
+    priority: Priority
+    enqueued_at: float
+    ready: asyncio.Future
+    on_position: Optional[PositionCallback]
+    last_position: Optional[int] = None
+    last_notified: float = 0.0
+
+
+class RequestScheduler:
+    """
+    Admission control and fair queuing in front of the graph invocation.
+
+    - `check_rate` applies per-user and per-guild token buckets before any work starts.
+    - `run` waits for one of `max_concurrency` slots. Waiting requests are kept in one
+      queue per guild and priority; guilds take turns (round robin) so a busy guild
+      cannot starve the others, and text requests go before image requests. Images
+      also have their own smaller concurrency cap, and an image that has waited
+      `image_aging` seconds is dispatched ahead of text so it cannot starve either.
+    - Waiting requests are told their queue position through an optional callback.
+    """
+
+    def __init__(self, *, max_concurrency: int, max_image_concurrency: int, max_queue: int,
+                 user_rate: float, user_burst: float, guild_rate: float, guild_burst: float,
+                 image_aging: float = 30.0, position_update_interval: float = 2.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.max_image_concurrency = min(max_image_concurrency, max_concurrency)
+        self.max_queue = max_queue
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.guild_rate, self.guild_burst = guild_rate, guild_burst
+        self.image_aging = image_aging
+        self.position_update_interval = position_update_interval
+        self._clock = clock
+
+        self._user_buckets: Dict[str, TokenBucket] = {}
+        self._guild_buckets: Dict[str, TokenBucket] = {}
+        # priority -> guild -> waiting tickets; the first guild in each dict is next in turn.
+        self._queues: Dict[Priority, "OrderedDict[str, Deque[_Ticket]]"] = {p: OrderedDict() for p in Priority}
+        self._queued = 0
+        self._running: Dict[Priority, int] = {p: 0 for p in Priority}
+        self._notify_tasks: set = set()
+
+        self._completed = 0
+        self._rate_limited = 0
+        self._rejected_busy = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    # --- Admission ---
+
+    def check_rate(self, user_id: str, guild_id: str) -> None:
+        """Consumes one token from the user's and the guild's bucket, or raises RateLimitedError."""
+        now = self._clock()
+        user_bucket = self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst, now)
+        guild_bucket = self._bucket(self._guild_buckets, guild_id, self.guild_rate, self.guild_burst, now)
+        for scope, bucket in (("User", user_bucket), ("Server", guild_bucket)):
+            wait = bucket.wait_time(now)
+            if wait > 0:
+                self._rate_limited += 1
+                log.info("SCHEDULER", f"{scope} rate limit hit (user {user_id}, guild {guild_id}); retry in {wait:.1f}s")
+                raise RateLimitedError(scope, wait)
+        user_bucket.take()
+        guild_bucket.take()
+
+    async def run(self, job: Callable[[], Awaitable[T]], *, user_id: str, guild_id: str,
+                  priority: Priority = Priority.TEXT, on_position: Optional[PositionCallback] = None) -> T:
+        """Waits for a slot according to priority and guild fairness, then runs `job`."""
+        if self._queued >= self.max_queue:
+            self._rejected_busy += 1
+            raise SchedulerBusyError(f"{self._queued} requests are already waiting.")
+
+        loop = asyncio.get_running_loop()
+        ticket = _Ticket(user_id, guild_id, priority, self._clock(), loop.create_future(), on_position)
+        self._queues[priority].setdefault(guild_id, deque()).append(ticket)
+        self._queued += 1
+        self._dispatch()
+
+        try:
+            await ticket.ready
+        except asyncio.CancelledError:
+            if ticket.ready.done() and not ticket.ready.cancelled():
+                # Granted a slot but cancelled before using it: hand the slot on.
+                self._release(ticket)
+            else:
+                self._remove(ticket)
+            raise
+
+        waited = self._clock() - ticket.enqueued_at
+        self._wait_time_total += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
+        if waited >= 0.5:
+            log.info("SCHEDULER", f"{priority.name.lower()} request from guild {guild_id} started after waiting {waited:.2f}s")
+        try:
+            return await job()
+        finally:
+            self._completed += 1
+            self._release(ticket)
+
+    # --- Queue Management ---
+
+    def _bucket(self, buckets: Dict[str, TokenBucket], key: str, rate: float, burst: float, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= _MAX_TRACKED_BUCKETS:
+                for stale in [k for k, b in buckets.items() if b.is_full(now)]:
+                    del buckets[stale]
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        if sum(self._running.values()) >= self.max_concurrency:
+            return None
+        image_allowed = self._running[Priority.IMAGE] < self.max_image_concurrency
+        image_queue = self._queues[Priority.IMAGE]
+        if image_allowed and image_queue:
+            head = next(iter(image_queue.values()))[0]
+            if self._clock() - head.enqueued_at >= self.image_aging:
+                return self._pop(Priority.IMAGE)
+        for priority in Priority:
+            if priority == Priority.IMAGE and not image_allowed:
+                continue
+            if self._queues[priority]:
+                return self._pop(priority)
+        return None
+
+    def _pop(self, priority: Priority) -> _Ticket:
+        """Takes the next ticket of the guild whose turn it is and moves that guild to the back."""
+        guilds = self._queues[priority]
+        guild_id, tickets = next(iter(guilds.items()))
+        ticket = tickets.popleft()
+        if tickets:
+            guilds.move_to_end(guild_id)
+        else:
+            del guilds[guild_id]
+        self._queued -= 1
+        return ticket
+
+    def _remove(self, ticket: _Ticket) -> None:
+        guilds = self._queues[ticket.priority]
+        tickets = guilds.get(ticket.guild_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            self._queued -= 1
+            if not tickets:
+                del guilds[ticket.guild_id]
+        self._notify_positions()
+
+    def _release(self, ticket: _Ticket) -> None:
+        self._running[ticket.priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while True:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            self._running[ticket.priority] += 1
+            ticket.ready.set_result(None)
+        self._notify_positions()
+
+    def _queue_order(self) -> List[_Ticket]:
+        """Waiting tickets in the order they would be dispatched if nothing else arrived."""
+        order: List[_Ticket] = []
+        for priority in Priority:
+            for round_ in itertools.zip_longest(*self._queues[priority].values()):
+                order.extend(t for t in round_ if t is not None)
+        return order
+
+    def _notify_positions(self) -> None:
+        now = self._clock()
+        for position, ticket in enumerate(self._queue_order(), start=1):
+            if ticket.on_position is None or position == ticket.last_position:
+                continue
+            # Position updates become message edits; throttle them per request.
+            if ticket.last_position is not None and now - ticket.last_notified < self.position_update_interval:
+                continue
+            ticket.last_position, ticket.last_notified = position, now
+            task = asyncio.ensure_future(ticket.on_position(position))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._on_notified)
+
+    def _on_notified(self, task: asyncio.Future) -> None:
+        self._notify_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("SCHEDULER", f"Queue position update failed: {task.exception()}")
+
+    def metrics(self) -> Dict[str, Any]:
+        started = self._completed + sum(self._running.values())
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": sum(self._running.values()),
+            "running_images": self._running[Priority.IMAGE],
+            "queued": self._queued,
+            "queued_by_priority": {p.name.lower(): sum(len(q) for q in self._queues[p].values()) for p in Priority},
+            "completed": self._completed,
+            "rate_limited": self._rate_limited,
+            "rejected_busy": self._rejected_busy,
+            "wait_time_max": self._wait_time_max,
+            "wait_time_avg": self._wait_time_total / started if started else 0.0,
+        }
+
+
+class ThreadTurns:
+    """
+    Runs one request per conversation thread at a time. Per-thread state (the token
+    and image listeners, tracked statements, the checkpoint) is keyed by thread id, so
+    a message sent while the thread's previous request is still running waits for it.
+    """
+
+    def __init__(self):
+        # thread id -> [lock, requests holding or waiting for it]
+        self._turns: Dict[str, List[Any]] = {}
+
+    def busy(self, thread_id: str) -> bool:
+        return thread_id in self._turns
+
+    @asynccontextmanager
+    async def turn(self, thread_id: str) -> AsyncIterator[None]:
+        entry = self._turns.setdefault(thread_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._turns[thread_id]
+
+
+_scheduler: Optional[RequestScheduler] = None
+
+
+def get_scheduler() -> RequestScheduler:
+    """Returns the process-wide scheduler, creating it from config on first use."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = RequestScheduler(
+            max_concurrency=config.SCHEDULER_MAX_CONCURRENCY,
+            max_image_concurrency=config.SCHEDULER_MAX_IMAGE_CONCURRENCY,
+            max_queue=config.SCHEDULER_MAX_QUEUE,
+            user_rate=config.SCHEDULER_USER_RATE_PER_MIN / 60,
+            user_burst=config.SCHEDULER_USER_BURST,
+            guild_rate=config.SCHEDULER_GUILD_RATE_PER_MIN / 60,
+            guild_burst=config.SCHEDULER_GUILD_BURST,
+            image_aging=config.SCHEDULER_IMAGE_AGING_SECONDS,
+        )
+    return _scheduler
@@ -0,0 +1,182 @@
+"""
+Shows the agent's answer in Discord while the model is still writing it.
+
+The agent node streams its model calls and hands the text written so far to the
+listener watching the request's thread (`token_streams`). `ProgressiveReply` turns
+that stream into a few message edits and writes the final answer, split across
+messages or attached as a file when it is long.
+"""
+import asyncio
+import io
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from config import RESPONSE_MAX_MESSAGES, STREAM_EDIT_INTERVAL
+from telemetry import current_span, get_logger, metrics
+from utils import DISCORD_MESSAGE_LIMIT, split_message
+
+log = get_logger(__name__)
+
+time_to_first_token = metrics.histogram(
+    "text2sql_time_to_first_token_seconds",
+    "Time from a mention to the first answer text visible in Discord.",
+    ["mode"],
+)
+
+# Longest wait between edits after Discord refused or delayed them.
+_MAX_EDIT_INTERVAL = 5.0
+
+
+class TokenStreams:
+    """
+    The listener for each Discord thread's partial answers. The agent node streams
+    its model call only when the thread has one; the listener gets the text of the
+    current model step so far and may be called from a worker thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners: Dict[str, Callable[[str], None]] = {}
+
+    def watch(self, thread_id: str, listener: Callable[[str], None]) -> None:
+        with self._lock:
+            self._listeners[thread_id] = listener
+
+    def unwatch(self, thread_id: str) -> None:
+        with self._lock:
+            self._listeners.pop(thread_id, None)
+
+    def listener(self, thread_id: Optional[str]) -> Optional[Callable[[str], None]]:
+        with self._lock:
+            return self._listeners.get(thread_id)
+
+
+token_streams = TokenStreams()
+
+
+def _answer_file(text: str):
+    import discord
+
+    return discord.File(io.BytesIO(text.encode("utf-8")), filename="answer.md")
+
+
+class ProgressiveReply:
+    """
+    The bot's reply to one request, starting from its status message.
+
+    `feed` may be called for every token: only the latest text is kept, and the
+    messages are edited at most once per `interval` seconds, so a burst of tokens
+    costs one edit. The next edit is timed from the end of the previous one, so an
+    edit that discord.py holds back for a rate limit delays the following one too,
+    and a failed edit doubles the interval. Text beyond one message continues in new
+    messages split at line boundaries. `finish` writes the final answer, or its first
+    part plus the whole answer as a file when it would take more than `max_messages`.
+
+    All methods run on the event loop.
+    """
+
+    CURSOR = " ▌"
+    # Shown instead of an empty final answer, which Discord refuses as message content.
+    EMPTY_ANSWER = "I don't have an answer to that. Please try rephrasing your request."
+
+    def __init__(self, channel, status_message, interval: float = STREAM_EDIT_INTERVAL,
+                 max_messages: int = RESPONSE_MAX_MESSAGES):
+        self.channel = channel
+        self.interval = interval
+        self.max_messages = max(1, max_messages)
+        self.messages = [status_message]
+        self.edits = 0
+        # What each message shows; the status message may have been edited elsewhere.
+        self._shown: List[Optional[str]] = [None]
+        self._latest = ""
+        self._wake = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._rendering = False
+        self._closed = False
+        self._last_edit = 0.0
+        # Time to first token is measured from the start of the request's trace.
+        self._span = current_span()
+        self._started = self._span.start if self._span else time.perf_counter()
+        self._visible = False
+
+    def feed(self, text: str) -> None:
+        """Replaces the partial answer shown to the user with `text`."""
+        if self._closed or not text.strip():
+            return
+        self._latest = text
+        self._wake.set()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def finish(self, text: str, answer: bool = True) -> None:
+        """
+        Stops streaming and shows `text` as the reply. Pass `answer=False` for an error
+        or cancellation notice, which does not count towards time to first token.
+        """
+        self._closed = True
+        if self._flusher is not None:
+            # An edit in flight completes first, so no message it sends goes untracked.
+            if not self._rendering:
+                self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        chunks = split_message(text if text.strip() else self.EMPTY_ANSWER)
+        if len(chunks) > self.max_messages:
+            log.info("STREAM", f"Answer needs {len(chunks)} messages; sending it as a file.", chars=len(text))
+            await self._render(chunks[:1])
+            await self.channel.send("The full answer is attached.", file=_answer_file(text))
+        else:
+            await self._render(chunks)
+        if answer:
+            self._mark_visible("final")
+
+    async def _flush(self) -> None:
+        while not self._closed:
+            await self._wake.wait()
+            # Let tokens pile up until the next edit is due.
+            delay = self._last_edit + self.interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._wake.clear()
+            limit = DISCORD_MESSAGE_LIMIT - len(self.CURSOR)
+            chunks = split_message(self._latest, limit)[:self.max_messages]
+            chunks[-1] += self.CURSOR
+            self._rendering = True
+            try:
+                await self._render(chunks)
+                self._mark_visible("streamed")
+            except Exception as e:
+                self.interval = min(max(self.interval, 0.5) * 2, _MAX_EDIT_INTERVAL)
+                log.warning("STREAM", f"Could not update the streamed reply: {e}", interval=self.interval)
+            finally:
+                self._rendering = False
+                self._last_edit = time.perf_counter()
+
+    async def _render(self, chunks: List[str]) -> None:
+        """Makes the reply's messages show `chunks`, editing only the ones that changed."""
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                if self._shown[index] != chunk:
+                    await self.messages[index].edit(content=chunk)
+                    self._shown[index] = chunk
+                    self.edits += 1
+            else:
+                self.messages.append(await self.channel.send(chunk))
+                self._shown.append(chunk)
+        # A later model step (or the final answer) can be shorter than what was streamed.
+        while len(self.messages) > len(chunks):
+            message = self.messages.pop()
+            self._shown.pop()
+            await message.delete()
+
+    def _mark_visible(self, mode: str) -> None:
+        if self._visible:
+            return
+        self._visible = True
+        elapsed = time.perf_counter() - self._started
+        time_to_first_token.observe(elapsed, mode=mode)
+        if self._span is not None:
+            self._span.set(ttft=round(elapsed, 3), ttft_mode=mode)
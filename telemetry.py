@@ -0,0 +1,446 @@
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# --- Structured Logging ---
+
+_LEVEL_SUFFIXES = {logging.WARNING: "_WARNING", logging.ERROR: "_ERROR", logging.CRITICAL: "_ERROR"}
+
+
+# `config` is imported inside the functions that read it: config imports the registry,
+# which logs through this module, so a module-level import is circular.
+
+def _clip(value: Any) -> str:
+    import config
+
+    text = str(value)
+    limit = config.LOG_MAX_FIELD_CHARS
+    return text if limit <= 0 or len(text) <= limit else f"{text[:limit]}... ({len(text)} chars)"
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever `sys.stdout` is at the time, like the `print` calls it replaced."""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class _TextFormatter(logging.Formatter):
+    """The bot's classic `--- [TAG] message key='value' ---` lines; warnings and errors get a `_WARNING`/`_ERROR` tag."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        tag = getattr(record, "tag", record.name) + _LEVEL_SUFFIXES.get(record.levelno, "")
+        fields = "".join(
+            f" {key}={value}" if isinstance(value, (int, float)) else f" {key}={_clip(value)!r}"
+            for key, value in getattr(record, "fields", {}).items()
+        )
+        return f"--- [{tag}] {record.getMessage()}{fields} ---"
+
+
+class _JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the trace and span ids of the request that logged it."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "tag": getattr(record, "tag", record.name),
+            "msg": record.getMessage(),
+        }
+        span = _current_span.get()
+        if span is not None:
+            entry["trace_id"], entry["span_id"] = span.trace_id, span.span_id
+        for key, value in getattr(record, "fields", {}).items():
+            entry[key] = value if isinstance(value, (int, float, bool)) or value is None else _clip(value)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class StructuredLogger:
+    """
+    Leveled logger taking a tag, a message and structured fields:
+    `log.info("TOOL_CALLED", "query_database", rows=12)`.
+
+    Fields are only formatted when the level is enabled, so payloads such as SQL
+    or model output passed as DEBUG fields cost nothing at the default INFO level.
+    """
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(f"text2sql.{name}")
+
+    def is_enabled(self, level: int) -> bool:
+        if not _configured:
+            configure_logging()
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, tag: str, message: str, **fields: Any) -> None:
+        self._log(logging.DEBUG, tag, message, fields)
+
+    def info(self, tag: str, message: str, **fields: Any) -> None:
+        self._log(logging.INFO, tag, message, fields)
+
+    def warning(self, tag: str, message: str, **fields: Any) -> None:
+        self._log(logging.WARNING, tag, message, fields)
+
+    def error(self, tag: str, message: str, **fields: Any) -> None:
+        self._log(logging.ERROR, tag, message, fields)
+
+    def _log(self, level: int, tag: str, message: str, fields: Dict[str, Any]) -> None:
+        if self.is_enabled(level):
+            self._logger.log(level, message, extra={"tag": tag, "fields": fields})
+
+
+_configured = False
+
+
+def configure_logging(level: Optional[str] = None, fmt: Optional[str] = None) -> None:
+    """
+    (Re)configures the bot's log handler. The first log call does this with
+    `LOG_LEVEL` and `LOG_FORMAT`; it is not done on import because `config` itself
+    imports modules that create loggers.
+    """
+    import config
+
+    global _configured
+    _configured = True
+    root = logging.getLogger("text2sql")
+    root.setLevel(getattr(logging, (level or config.LOG_LEVEL).upper(), logging.INFO))
+    root.propagate = False
+    handler = _StdoutHandler()
+    handler.setFormatter(_JsonFormatter() if (fmt or config.LOG_FORMAT) == "json" else _TextFormatter())
+    root.handlers[:] = [handler]
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(name)
+
+
+log = get_logger("telemetry")
+
+
+# --- Metrics ---
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(tuple(str(labels.get(name, "")) for name in self.labelnames), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram, rendered like a Prometheus client's."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def series(self) -> List[Tuple[Dict[str, str], int, float]]:
+        """`(labels, count, sum)` of every series observed so far."""
+        with self._lock:
+            return [(dict(zip(self.labelnames, key)), s[2], s[1]) for key, s in sorted(self._series.items())]
+
+    def quantile(self, q: float, **labels: Any) -> float:
+        """Estimates a quantile by interpolating inside its bucket, like PromQL's `histogram_quantile`."""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None or series[2] == 0:
+                return 0.0
+            counts, total = list(series[0]), series[2]
+        rank, seen = q * total, 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total:.6f}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Any] = {}
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(name, lambda: Counter(name, help_text, labelnames))
+
+    def histogram(
+        self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def _get_or_create(self, name: str, factory) -> Any:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+
+metrics = MetricsRegistry()
+span_duration = metrics.histogram(
+    "text2sql_span_duration_seconds", "Duration of traced operations.", ["span"]
+)
+span_errors = metrics.counter("text2sql_span_errors_total", "Traced operations that raised.", ["span"])
+llm_tokens = metrics.counter("text2sql_llm_tokens_total", "Tokens sent to and received from the models.", ["model", "kind"])
+
+
+# --- Tracing ---
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    end: Optional[float] = None
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+
+class _Trace:
+    # A runaway tool loop must not grow a trace without bound.
+    MAX_SPANS = 1000
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self._lock = threading.Lock()
+        self.spans: List[Span] = []
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            if len(self.spans) < self.MAX_SPANS:
+                self.spans.append(span)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar("current_trace", default=None)
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+@contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Times an operation as a child of the current span. Its duration always goes
+    into the `span` histogram; it only appears in a logged breakdown when it runs
+    inside a request started with `start_trace`. Works in sync and async code:
+    the current span is a context variable, so tasks and threads started with a
+    copied context nest their spans under it.
+    """
+    parent = _current_span.get()
+    current = _current_trace.get()
+    span = Span(
+        name,
+        trace_id=current.trace_id if current else "",
+        span_id=_new_id(),
+        parent_id=parent.span_id if parent else None,
+        start=time.perf_counter(),
+        attributes=attributes,
+    )
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = type(e).__name__
+        span_errors.inc(span=name)
+        raise
+    finally:
+        span.end = time.perf_counter()
+        _current_span.reset(token)
+        span_duration.observe(span.end - span.start, span=name)
+        if current is not None:
+            current.add(span)
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Starts a request's root span. A `TRACE_SAMPLE_RATE` share of requests, plus
+    every request slower than `TRACE_SLOW_SECONDS`, logs a per-span breakdown when
+    it ends, which is where p99 outliers show what they spent their time on.
+    """
+    import config
+
+    current = _Trace(_new_id(), sampled=random.random() < config.TRACE_SAMPLE_RATE)
+    trace_token = _current_trace.set(current)
+    span_token = _current_span.set(None)
+    root: Optional[Span] = None
+    try:
+        with trace(name, **attributes) as root:
+            yield root
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        if root is not None and (current.sampled or root.duration >= config.TRACE_SLOW_SECONDS):
+            _log_trace(current, root)
+
+
+def _log_trace(current: _Trace, root: Span) -> None:
+    import config
+
+    totals: Dict[str, List[float]] = {}
+    tokens = 0
+    for span in current.spans:
+        if span is not root:
+            entry = totals.setdefault(span.name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += span.duration
+            tokens += span.attributes.get("input_tokens", 0) + span.attributes.get("output_tokens", 0)
+    breakdown = ", ".join(
+        f"{name} {count}x {total:.3f}s" for name, (count, total) in sorted(totals.items(), key=lambda item: -item[1][1])
+    )
+    reason = "slow" if root.duration >= config.TRACE_SLOW_SECONDS else "sampled"
+    fields = dict(root.attributes, trace_id=current.trace_id, tokens=tokens)
+    if root.error:
+        fields["error"] = root.error
+    log.info("TRACE", f"{root.name} took {root.duration:.3f}s ({reason}): {breakdown or 'no child spans'}", **fields)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def record_llm_usage(span: Span, model: str, usage: Optional[Dict[str, Any]]) -> None:
+    """Adds a model response's token usage (LangChain `usage_metadata`) to its span and the token counters."""
+    if not usage:
+        return
+    input_tokens, output_tokens = usage.get("input_tokens") or 0, usage.get("output_tokens") or 0
+    span.set(input_tokens=input_tokens, output_tokens=output_tokens)
+    llm_tokens.inc(input_tokens, model=model, kind="input")
+    llm_tokens.inc(output_tokens, model=model, kind="output")
+
+
+# --- Metrics Endpoint ---
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(host: Optional[str] = None, port: Optional[int] = None):
+    """
+    Serves `GET /metrics` in the Prometheus text format from a daemon thread.
+    Returns the running server; calling it again (e.g. on a gateway reconnect) is a no-op.
+    """
+    import config
+
+    global _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with _server_lock:
+        if _server is None:
+            host = config.METRICS_HOST if host is None else host
+            port = config.METRICS_PORT if port is None else port
+            _server = ThreadingHTTPServer((host, port), _Handler)
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+            log.info("METRICS", f"Serving Prometheus metrics on http://{host}:{_server.server_address[1]}/metrics")
+    return _server
+
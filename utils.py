@@ -1,7 +1,135 @@
-import pandas as pd
-from typing import List, Dict
+import csv
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from typing import Any, Dict, List, Sequence
 import os
-import re
+from config import OUTPUT_DIR
+from telemetry import get_logger
+
+log = get_logger(__name__)
+
+# Excel's hard limit is 1,048,576 rows per sheet; one of them holds the header.
+EXCEL_MAX_DATA_ROWS_PER_SHEET = 1_048_575
+
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+
+_EXCEL_NATIVE_TYPES = (str, int, float, bool, Decimal, date, datetime, time, timedelta, type(None))
+
+
+class StreamingExportWriter:
+    """
+    Writes rows to an `.xlsx`, `.csv` or `.parquet` file batch by batch, so memory
+    stays constant regardless of how many rows are exported.
+
+    Excel output uses an openpyxl write-only workbook and rolls over to a new sheet
+    whenever the 1,048,576-row sheet limit is reached. Parquet output requires the
+    optional `pyarrow` package.
+
+    Usage:
+        writer = StreamingExportWriter(path, "xlsx")
+        writer.write_header(columns)
+        for batch in batches:
+            writer.write_rows(batch)
+        writer.close()
+    """
+
+    def __init__(self, file_path: str, file_format: str = "xlsx"):
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{file_format}'. Use one of: {', '.join(EXPORT_FORMATS)}.")
+        self.file_path = file_path
+        self.file_format = file_format
+        self.rows_written = 0
+        self.sheets = 0
+        self._columns: List[str] = []
+        self._sheet_rows = 0
+
+        if file_format == "xlsx":
+            from openpyxl import Workbook
+
+            self._workbook = Workbook(write_only=True)
+            self._sheet = None
+        elif file_format == "csv":
+            self._file = open(file_path, "w", newline="", encoding="utf-8")
+            self._csv = csv.writer(self._file)
+        else:
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ValueError("Parquet export requires the 'pyarrow' package to be installed.")
+            self._parquet_writer = None
+            self._text_columns = set()
+
+    def write_header(self, columns: Sequence[str]) -> None:
+        self._columns = list(columns)
+        if self.file_format == "csv":
+            self._csv.writerow(self._columns)
+
+    def write_rows(self, rows: Sequence[Sequence[Any]]) -> None:
+        """Appends a batch of rows (tuples in header order)."""
+        if not rows:
+            return
+        if self.file_format == "xlsx":
+            self._write_excel_rows(rows)
+        elif self.file_format == "csv":
+            self._csv.writerows(rows)
+        else:
+            self._write_parquet_rows(rows)
+        self.rows_written += len(rows)
+
+    def close(self) -> None:
+        if self.file_format == "xlsx":
+            if self._sheet is None:
+                # Always produce a valid workbook, even for an empty result.
+                self._new_sheet()
+            self._workbook.save(self.file_path)
+        elif self.file_format == "csv":
+            self._file.close()
+        elif self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+    def _new_sheet(self) -> None:
+        self.sheets += 1
+        self._sheet = self._workbook.create_sheet(title="Sheet1" if self.sheets == 1 else f"Sheet{self.sheets}")
+        self._sheet.append(self._columns)
+        self._sheet_rows = 0
+
+    def _write_excel_rows(self, rows: Sequence[Sequence[Any]]) -> None:
+        for row in rows:
+            if self._sheet is None or self._sheet_rows >= EXCEL_MAX_DATA_ROWS_PER_SHEET:
+                self._new_sheet()
+            self._sheet.append([v if isinstance(v, _EXCEL_NATIVE_TYPES) else str(v) for v in row])
+            self._sheet_rows += 1
+
+    def _write_parquet_rows(self, rows: Sequence[Sequence[Any]]) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = list(zip(*rows))
+        if self._parquet_writer is None:
+            table = pa.table({name: list(values) for name, values in zip(self._columns, columns)})
+            # The schema is fixed by the first batch. A column that is all NULL there would be
+            # typed null and reject later values, so it is written as text instead.
+            self._text_columns = {field.name for field in table.schema if pa.types.is_null(field.type)}
+            schema = pa.schema([
+                pa.field(field.name, pa.string()) if field.name in self._text_columns else field for field in table.schema
+            ])
+            self._parquet_writer = pq.ParquetWriter(self.file_path, schema)
+        schema = self._parquet_writer.schema
+        table = pa.table({
+            name: pa.array(
+                [None if v is None else str(v) for v in values] if name in self._text_columns else list(values),
+                type=schema.field(name).type,
+            )
+            for name, values in zip(self._columns, columns)
+        }, schema=schema)
+        self._parquet_writer.write_table(table)
+
+
+def export_file_path(filename: str) -> str:
+    """Returns the absolute path for `filename` inside the output directory, creating it if needed."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    return os.path.abspath(os.path.join(OUTPUT_DIR, filename))
+
 
 def export_data_to_excel(data: List[Dict], filename: str = "query_result.xlsx") -> str:
     """
@@ -13,57 +141,38 @@ def export_data_to_excel(data: List[Dict], filename: str = "query_result.xlsx")
 
     Returns:
         The absolute path to the newly created Excel file.
-        
+
     Raises:
         ValueError: If the input data is empty or not in the expected format.
     """
     if not data or not isinstance(data, list) or not isinstance(data[0], dict):
         raise ValueError("Invalid or empty data provided for Excel export.")
 
-    df = pd.DataFrame(data)
-    
-    output_dir = "output"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    file_path = os.path.abspath(os.path.join(output_dir, filename))
-    
-    df.to_excel(file_path, index=False)
-    
-    print(f"--- [UTILS] Data successfully exported to {file_path} ---")
+    file_path = export_file_path(filename)
+
+    columns = list(data[0].keys())
+    writer = StreamingExportWriter(file_path, "xlsx")
+    writer.write_header(columns)
+    writer.write_rows([tuple(row.get(c) for c in columns) for row in data])
+    writer.close()
+
+    log.info("UTILS", f"Data successfully exported to {file_path}")
     return file_path
 
-def find_excel_path_in_response(response_text: str) -> str | None:
-    """
-    Searches the agent's final text response for an Excel file path.
-    """
-    print(f"--- [UTILS] Searching for Excel path in: '{response_text}' ---")
-    # Regex to find Excel file paths (absolute or relative) in the 'output' directory.
-    match = re.search(r"([a-zA-Z]:[\\/]|[/]|[\\/])?[\w\\/.-]*output[\\/][\w\\/.-]+\.xlsx", response_text, re.IGNORECASE)
-    
-    if match:
-        os_specific_path = os.path.normpath(match.group(0).strip(".,'\"()"))
-        print(f"--- [UTILS] Regex found potential Excel path: {os_specific_path} ---")
-        if os.path.exists(os_specific_path):
-            print(f"--- [UTILS] Excel path confirmed to exist. ---")
-            return os_specific_path
-            
-    print(f"--- [UTILS] No valid .xlsx file path found in response. ---")
-    return None
-
-def find_image_path_in_response(response_text: str) -> str | None:
+# Discord rejects messages longer than 2000 characters.
+DISCORD_MESSAGE_LIMIT = 2000
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
     """
-    Searches the agent's final text response for an image file path.
+    Splits text into chunks of at most `limit` characters, preferring line boundaries.
     """
-    print(f"--- [UTILS] Searching for image path in: '{response_text}' ---")
-    # Regex to find image file paths (absolute or relative) in the 'output' directory.
-    match = re.search(r"([a-zA-Z]:[\\/]|[/]|[\\/])?[\w\\/.-]*output[\\/][\w\\/.-]+\.(png|jpg|jpeg)", response_text, re.IGNORECASE)
-    
-    if match:
-        os_specific_path = os.path.normpath(match.group(0).strip(".,'\"()"))
-        print(f"--- [UTILS] Regex found potential image path: {os_specific_path} ---")
-        if os.path.exists(os_specific_path):
-            print(f"--- [UTILS] Image path confirmed to exist. ---")
-            return os_specific_path
-            
-    print(f"--- [UTILS] No valid image file path found in response. ---")
-    return None
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
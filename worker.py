@@ -0,0 +1,227 @@
+"""
+A worker process of the scale-out deployment (see `cluster.py`): runs the LangGraph
+app for the jobs the bot's gateway process sends it.
+
+With the local transport the bot starts its workers itself (`BOT_WORKERS`). With an
+external broker (`JOB_TRANSPORT`), start more on any machine that shares the
+database, conversation store and broker:
+
+    python -m worker --id node2-0
+"""
+import argparse
+import asyncio
+import contextvars
+import importlib
+import multiprocessing
+import os
+import socket
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import HumanMessage
+
+from cluster import Job, JobTransport, load_transport
+from config import (
+    GRAPH_EXECUTION_MODE,
+    JOB_TRANSPORT,
+    STARTUP_PREWARM,
+    WORKER_CONCURRENCY,
+    WORKER_HEARTBEAT_SECONDS,
+)
+from lang.db.guard import statement_tracker
+from lang.db.sources import get_data_sources
+from lang.db.upload_store import get_upload_store
+from lang.graph.graph import app
+from lang.tools.artifacts import Artifact, artifacts_from_state
+from lang.tools.file_processor import Upload, process_uploaded_file, user_content
+from lang.tools.image_jobs import get_image_jobs
+from llm_cache import get_llm_usage
+from registry import registry
+from scheduler import ThreadTurns
+from streaming import token_streams
+from telemetry import get_logger, start_trace, trace
+
+log = get_logger(__name__)
+
+# Partial answers are forwarded at most this often; the bot shows the final text anyway.
+_TOKEN_EVENT_INTERVAL = 0.25
+
+
+class Worker:
+    """Receives jobs, runs up to `concurrency` of them at once and reports back through the transport."""
+
+    def __init__(self, transport: JobTransport, worker_id: str, concurrency: int = WORKER_CONCURRENCY):
+        self.transport = transport
+        self.worker_id = worker_id
+        self.concurrency = max(1, concurrency)
+        self.completed = 0
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._turns = ThreadTurns()
+        self._stopping = False
+
+    async def serve(self) -> None:
+        log.info("WORKER", f"Worker {self.worker_id} started", pid=os.getpid(), mode=GRAPH_EXECUTION_MODE)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        heartbeat = asyncio.create_task(self._heartbeat())
+        await self._prewarm()
+        parent = multiprocessing.parent_process()
+        try:
+            while not self._stopping:
+                message = await asyncio.to_thread(self.transport.receive, self.worker_id, 0.5)
+                if message is not None:
+                    self._handle(message)
+                elif parent is not None and not parent.is_alive():
+                    log.warning("WORKER", "The bot process is gone; stopping.")
+                    break
+        finally:
+            heartbeat.cancel()
+            for task in self._tasks.values():
+                task.cancel()
+            self._publish({"type": "bye"})
+
+    def _handle(self, message: Dict[str, Any]) -> None:
+        kind = message["type"]
+        if kind == "job":
+            job = Job.from_message(message)
+            self._tasks[job.job_id] = asyncio.create_task(self._run(job))
+        elif kind == "cancel":
+            task = self._tasks.get(message["job_id"])
+            if task is not None:
+                # As in the bot: thread mode kills the statements, async mode cancels the awaiting task.
+                statement_tracker.cancel_thread(message["thread_id"])
+                task.cancel()
+        elif kind == "forget":
+            get_upload_store().drop_thread(message["thread_id"])
+        elif kind == "stop":
+            self._stopping = True
+
+    async def _run(self, job: Job) -> None:
+        try:
+            # The thread's listeners and checkpoint are keyed by its id: one job per thread
+            # runs at a time, and a waiting one does not hold a slot.
+            async with self._turns.turn(job.thread_id), self._slots:
+                self._publish({"type": "started", "job_id": job.job_id})
+                result = await self._execute(job)
+            self.completed += 1
+            self._publish({"type": "result", "job_id": job.job_id, **result})
+        except asyncio.CancelledError:
+            log.info("WORKER", f"Job {job.job_id} was cancelled.")
+        finally:
+            self._tasks.pop(job.job_id, None)
+
+    async def _execute(self, job: Job) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        last_tokens = 0.0
+
+        def forward_tokens(text: str) -> None:
+            # Called on the graph's thread in thread mode; the transport is thread-safe.
+            nonlocal last_tokens
+            now = time.monotonic()
+            if now - last_tokens >= _TOKEN_EVENT_INTERVAL:
+                last_tokens = now
+                self._publish({"type": "tokens", "job_id": job.job_id, "text": text})
+
+        token_streams.watch(job.thread_id, forward_tokens)
+        get_image_jobs().watch(job.thread_id, lambda text: self._publish({"type": "status", "job_id": job.job_id, "text": text}))
+        with start_trace("worker.job", worker=self.worker_id, attempt=job.attempt, mode=GRAPH_EXECUTION_MODE):
+            try:
+                content = job.text
+                if job.attachment is not None:
+                    filename, data = job.attachment
+                    # Parsing is CPU-bound; the copied context keeps its spans in this job's trace.
+                    with trace("file.process"):
+                        processed_file = await loop.run_in_executor(
+                            None, contextvars.copy_context().run, process_uploaded_file, Upload(filename, data=data), job.thread_id
+                        )
+                    content = user_content(job.text, processed_file)
+                inputs = {"messages": [HumanMessage(content=content)]}
+                run_config = {"configurable": {"thread_id": job.thread_id, "data_source": job.data_source, "guild_id": job.guild_id}}
+                with trace("graph.invoke"):
+                    if GRAPH_EXECUTION_MODE == "async":
+                        final_state = await app.ainvoke(inputs, run_config)
+                    else:
+                        final_state = await loop.run_in_executor(
+                            None, contextvars.copy_context().run, app.invoke, inputs, run_config
+                        )
+                text = str(final_state["messages"][-1].content).strip()
+                files = await asyncio.to_thread(_reply_files, artifacts_from_state(final_state), job.max_file_bytes)
+                return {"ok": True, "text": text, "files": files}
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("WORKER", f"Job {job.job_id} failed: {e}")
+                return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            finally:
+                token_streams.unwatch(job.thread_id)
+                get_image_jobs().unwatch(job.thread_id)
+
+    async def _heartbeat(self) -> None:
+        host = socket.gethostname()
+        while True:
+            self._publish({
+                "type": "heartbeat",
+                "slots": self.concurrency,
+                "running": len(self._tasks),
+                "completed": self.completed,
+                "host": host,
+                "pid": os.getpid(),
+                "llm": get_llm_usage().snapshot(),
+            })
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+
+    async def _prewarm(self) -> None:
+        loop = asyncio.get_running_loop()
+        # In async mode the driver pools open on first checkout from the event loop instead.
+        if GRAPH_EXECUTION_MODE != "async":
+            try:
+                await loop.run_in_executor(None, get_data_sources().warm)
+            except Exception as e:
+                log.error("WORKER", f"Could not warm database connection pools: {e}")
+        if STARTUP_PREWARM:
+            loop.run_in_executor(None, registry.prewarm, STARTUP_PREWARM)
+
+    def _publish(self, event: Dict[str, Any]) -> None:
+        try:
+            self.transport.publish({"worker": self.worker_id, **event})
+        except Exception as e:
+            log.error("WORKER", f"Could not publish a {event.get('type')} event: {e}")
+
+
+def _reply_files(artifacts: List[Artifact], max_bytes: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    The files the run produced, read so the bot can upload them from another machine.
+    A file over `max_bytes` could not be uploaded anyway; it is described but not read.
+    """
+    files = []
+    for artifact in artifacts:
+        described = {"filename": artifact.filename, "size": artifact.size, "kind": artifact.kind, "data": None}
+        if max_bytes and artifact.size > max_bytes:
+            files.append(described)
+            continue
+        with open(artifact.path, "rb") as f:
+            files.append({**described, "data": f.read()})
+    return files
+
+
+def run_worker(transport: Optional[JobTransport], worker_id: str, setup: Optional[str] = None) -> None:
+    """Process entry point; without a transport, the one named by `JOB_TRANSPORT` is built."""
+    if setup:
+        module_name, _, function_name = setup.partition(":")
+        getattr(importlib.import_module(module_name), function_name)()
+    if transport is None:
+        transport = load_transport(JOB_TRANSPORT)
+    asyncio.run(Worker(transport, worker_id).serve())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--id", default=f"{socket.gethostname()}-{os.getpid()}", help="Unique id of this worker.")
+    args = parser.parse_args()
+    if JOB_TRANSPORT == "local":
+        parser.error("JOB_TRANSPORT is 'local': the bot starts its own workers (BOT_WORKERS). "
+                     "Set JOB_TRANSPORT to an external broker to run workers separately.")
+    run_worker(None, args.id)
+
+
+if __name__ == "__main__":
+    main()